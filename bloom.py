@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+
+# Bloom filters for rsync-checkpoint
+#
+# A filter is a bit array of <bits> bits with <hashes> bit positions per key. Positions come from the
+# MD5 digest of the key split into two 64-bit halves h1 and h2, as (h1 + i * h2) mod bits for i < hashes.
+# Keys are byte strings; unicode keys are encoded as UTF-8 first.
+
+import hashlib, math, struct
+
+class BloomFilter(object):
+    
+    # Filter sized for <capacity> keys at a false positive rate of <error_rate>, or rebuilt from the
+    # <bits>, <hashes> and raw bit array <data> of a published filter
+    def __init__(self, capacity = 1000, error_rate = 0.01, bits = None, hashes = None, data = None):
+        if bits == None:
+            capacity = max(capacity, 1)
+            bits = int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+            hashes = max(1, int(round(float(bits) / capacity * math.log(2))))
+        self.bits = bits
+        self.hashes = hashes
+        if data == None:
+            self.data = bytearray((bits + 7) // 8)
+        else:
+            self.data = bytearray(data)
+        self.count = 0
+    
+    def positions(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        h1, h2 = struct.unpack('>QQ', hashlib.md5(key).digest())
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+    
+    def add(self, key):
+        for position in self.positions(key):
+            self.data[position >> 3] = self.data[position >> 3] | (1 << (position & 7))
+        self.count = self.count + 1
+    
+    def __contains__(self, key):
+        for position in self.positions(key):
+            if not self.data[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+    
+    def tostring(self):
+        return str(self.data)
@@ -11,12 +11,13 @@
 # status: {'state': 'error', 'detail': 'error reason'}
 # status: {'state': 'ok', 'detail': None}
 # status: {'state': 'ok', 'detail': 'possibly corrupted'}
+# status: {'state': 'ok', 'detail': 'content mismatch'}  (set by synccheck.py --verify-content)
 # status: {'state': 'moved', 'detail': new_location[0]['id']}
 # status: {'state': 'deleted', 'detail': int(time.time())}
 
 # Prep
 import json, base64, sys, hashlib, time, re
-import os, logging, argparse
+import os, logging, argparse, tempfile, itertools
 
 from datetime import datetime
 from cloudant.client import Cloudant
@@ -28,6 +29,9 @@ from cloudant import cloudant
 
 import requests # Still needed for a few specific Cloudant queries. Hopefully not for long
 
+import manifest, bloom, scheduler
+from fileschema import file_map, compact_file_doc, expand_file_doc, file_field, query_field, document_id, directory_id_prefix, id_prefix_length
+
 logging_levels = dict(
         CRITICAL = 50,
         ERROR = 40,
@@ -80,17 +84,74 @@ config = dict(
     is_source = True,
     # Ultra-scan option. As in ULTRA-SLOW.  But performs 100% certainty of data integrity
     ultra_scan = False,
+    # Fingerprint option (--fingerprint): hash each file's size and a few sampled blocks (see file_fingerprint),
+    # catching truncation and most corruption for a few reads per file
+    fingerprint_scan = False,
+    # Number of blocks sampled by a fingerprint (the first, the last and evenly spaced ones between), and their size in bytes
+    fingerprint_blocks = 8,
+    fingerprint_block_size = 65536,
     # Time threshold to being writing to a new scan database in seconds (default is 30 days) #OBSOLETE WITH NEW ROLLOVER STRATEGY?
     db_rollover = 2592000,
     # Time threshold to retain older scan databases for in seconds (default is 90 days)
     db_max_age = 7776000,
     # Version number of the views in use by this script
-    viewversion = 0.043,
+    viewversion = 0.17,
+    # First view version with the scan database views consolidated into a few design documents
+    consolidated_viewversion = 0.05,
     # Maximum number of keys to post to a view (for URI length limitation controls)
     # This can be increased once Cloudant-Python Issue #90 is resolved
-    post_threshold = 2000
+    post_threshold = 2000,
+    # Seconds to keep waiting for a view index to build (see build_indexes) before giving up
+    index_build_timeout = 3600,
+    # Schema version of the file documents this script writes (see fileschema.py)
+    file_schema = 2,
+    # Document ID scheme of the relationship, from its document (see fileschema.py)
+    id_scheme = 'hash',
+    # How scans are stored: 'documents' (one per file in the scan database) or 'manifest' (compressed
+    # manifest chunks attached to the scan document, see FileScan.manifest_sweep)
+    storage_mode = 'documents',
+    # False positive rate of the Bloom filter of the source's files published for the target (see FileScan.run)
+    sync_filter_error_rate = 0.01,
+    # Number of files to size that filter for when the source has no previous successful scan
+    sync_filter_files = 100000,
+    # Reconcile the target's sync state with the source's files (see reconcile) after every scan
+    auto_reconcile = True,
+    # Number of scans in a verification cycle (--verify-slice). Each scan checksums one slice of the tree by
+    # ID prefix, plus new and changed files, so every file is verified once per cycle. 0 is off
+    verify_cycle = 0,
+    # Scan I/O budget (see scheduler.py): files stat'ed and bytes checksummed per second. 0 is unlimited
+    max_files_per_second = 0,
+    max_bytes_per_second = 0,
+    # Pause a scan while the load average per CPU, or the percentage of CPU time waiting on I/O, is above these. 0 never pauses
+    pause_load = 0,
+    pause_iowait = 0,
+    # Priority the scanner gives itself: a nice increment, and an ionice class ('idle', 'besteffort' or None)
+    scan_nice = 0,
+    scan_ionice = None,
+    # Directory for the lock files that keep scans of a relationship from overlapping
+    lock_dir = tempfile.gettempdir()
 )
 
+# Settings that a configuration file may override, e.g. "max_bytes_per_second": 52428800
+optional_settings = ['fingerprint_blocks', 'fingerprint_block_size', 'max_files_per_second', 'max_bytes_per_second', 'pause_load', 'pause_iowait', 'scan_nice', 'scan_ionice', 'lock_dir']
+
+# Upper bounds (exclusive, in bytes) of the file size buckets tallied in each scan's summary
+# Format is [<label>, <upper bound>]. Anything larger falls into the last bucket
+summary_size_buckets = [
+    ['0 bytes', 1],
+    ['< 4 KB', 4096],
+    ['< 64 KB', 65536],
+    ['< 1 MB', 1048576],
+    ['< 16 MB', 16777216],
+    ['< 256 MB', 268435456],
+    ['< 4 GB', 4294967296],
+    ['>= 4 GB', None]
+]
+
+# Itemized change lines from rsync --itemize-changes, --out-format="%i %n" or a --log-file.
+# Group 1 is the change (11-character YXcstpoguax string, or *deleting), group 2 the path
+rsync_itemize_pattern = re.compile(r'^(?:\d{4}/\d{2}/\d{2} \d{2}:\d{2}:\d{2} \[\d+\] )?(\*deleting|[<>ch.][fdLDS][.+?a-zA-Z ]{9}) +(.+?)[\r\n]*$')
+
 # Views in main database
 # Format is <view> = [<ddocname>,<viewname>,<mapfunction>,<reducefunction>]
 maindb_views = dict(
@@ -111,90 +172,192 @@ maindb_views = dict(
 # Views in scan database(s)
 # Format is <view> = [<ddocname>,<viewname>,<mapfunction>,<reducefunction>]
 # MAKE SURE DDOC NAME INCLUDES LEADING "_design/"!
+# Views are grouped into a few design documents by query pattern, since Cloudant maps every
+# document once per design document:
+#   scanstats - per-host scan totals and errors read for the status report
+#   syncstatus - joins and listings comparing the source with the target
+#   housekeeping - lookups dirscan itself makes while scanning, and content checks
+# Map functions are built with file_map so they index both file document schema versions (see fileschema.py).
+# Version 2 documents have no scanID, so the views that carry one in their keys are queried across all of it
 scandb_views = dict(
     file_types = [
-        '_design/filetypes',
+        '_design/scanstats',
         'types',
-        'function (doc) {if (doc.type === "file" && doc.goodscan === true) { filetype = doc.name.substr((~-doc.name.lastIndexOf(".") >>> 0) + 2); emit([doc.host, doc.relationship, filetype], doc.size); } }',
+        file_map('if (f.type === "file" && f.goodscan === true && f.status.state !== "deleted") { var filetype = f.name.substr((~-f.name.lastIndexOf(".") >>> 0) + 2); emit([f.host, f.scanID, filetype], f.size); }'),
         '_stats'
     ],
-    problem_files = [ 
-        '_design/problemfiles',
+    problem_files = [
+        '_design/scanstats',
         'problemfiles',
-        'function (doc) {if (doc.type === "file" && doc.status.state !== "ok") {emit([doc.scanID,doc.path,doc.name], doc.status.detail);}}',
+        file_map('if (f.type === "file" && f.goodscan === false && f.status.state !== "deleted") { emit([f.host, f.path, f.name], f.status.detail); }'),
         '_count'
     ],
+    scanned_files = [
+        '_design/scanstats',
+        'scanned',
+        file_map('if (f.type === "file" && f.goodscan === true) { emit(doc._id, f.size); }'),
+        '_stats'
+    ],
+    file_statuses = [
+        '_design/scanstats',
+        'bystatedetail',
+        file_map('if (f.type === "file" && f.goodscan === true && f.status) { emit([f.status.state, f.status.detail, doc._id], f.size); }'),
+        '_stats'
+    ],
     source_files = [
-        '_design/sourcefiles',
+        '_design/syncstatus',
         'sourcefiles',
-        'function (doc) { if (doc.type === "file" && doc.goodscan === true && doc.source === true) {emit(doc._id, doc.datemodified); }}',
+        file_map('if (f.type === "file" && f.goodscan === true) { emit([f.host, doc._id], f.datemodified); }'),
         None
     ],
-    check_for_delete = [
-        '_design/deleted',
-        'expected',
-        'function (doc) { if (doc.type === "file" && doc.status.state === "ok") { emit([doc.host,doc.path,doc.name],doc.datemodified); } }',
+    source_prefixes = [
+        '_design/syncstatus',
+        'prefixes',
+        file_map('if (f.type === "file" && f.goodscan === true && f.status.state !== "deleted") { emit([f.host, f.IDprefix], f.datemodified); }'),
         '_count'
     ],
+    sync_targets = [
+        '_design/syncstatus',
+        'targets',
+        file_map('if (f.type === "file" && f.goodscan === true && f.status.state !== "deleted" && f.syncIDprefix) { emit([f.host, f.syncIDprefix], [f.orphaned, f.sourcemodified, f.datemodified]); }'),
+        None
+    ],
+    content_sources = [
+        '_design/syncstatus',
+        'contentsources',
+        file_map('if (f.type === "file" && f.goodscan === true && f.status.state !== "deleted" && (f.checksum || f.fingerprint)) { emit([f.host, f.IDprefix], [f.checksum, f.fingerprint, f.syncpath, f.datemodified]); }'),
+        None
+    ],
+    content_targets = [
+        '_design/syncstatus',
+        'contenttargets',
+        file_map('if (f.type === "file" && f.goodscan === true && f.status.state !== "deleted" && f.syncIDprefix && (f.checksum || f.fingerprint)) { emit([f.host, f.syncIDprefix], [f.checksum, f.fingerprint, f.syncpath, f.datemodified, f.status.detail]); }'),
+        None
+    ],
+    sync = [
+        '_design/syncstatus',
+        'sync',
+        file_map('if (f.type === "file" && f.goodscan === true) { emit([f.IDprefix, f.syncIDprefix], f.datemodified); }'),
+        '_stats'
+    ],
+    sync_tree = [
+        '_design/syncstatus',
+        'tree',
+        file_map('if (f.type === "file" && f.goodscan === true && f.status.state !== "deleted") { var s = f.size; var up = (f.orphaned === "no" && f.datemodified >= f.sourcemodified) ? 1 : 0; var stale = (f.orphaned === "no" && f.datemodified < f.sourcemodified) ? 1 : 0; var orphan = (f.orphaned === "yes") ? 1 : 0; emit([f.host].concat(f.syncpath.split("/").filter(function (c) { return c.length > 0; })), [1, s, up, up * s, stale, stale * s, orphan, orphan * s]); }'),
+        '_sum'
+    ],
+    files_by_size = [
+        '_design/syncstatus',
+        'bysize',
+        file_map('if (f.type === "file" && f.goodscan === true && f.status.state !== "deleted") { var state = null; if (f.orphaned === "yes") { state = "orphaned"; } else if (f.orphaned === "no") { state = (f.datemodified < f.sourcemodified) ? "stale" : "uptodate"; } else if (f.orphaned === "unknown") { state = "unknown"; } emit([f.host, state, -f.size, f.syncpath], f.name); }'),
+        None
+    ],
     missing_files = [
-        '_design/syncstate',
+        '_design/syncstatus',
         'missing',
-        'function (doc) {if (doc.type === "file") {emit([doc.syncpath,doc.name,doc.host],doc.size); } }',
+        file_map('if (f.type === "file" && f.status.state !== "deleted") { emit([f.syncpath, f.name, f.host], f.size); }'),
         '_stats'
     ],
-    checksums = [
-        '_design/heavyscan',
-        'checksums',
-        'function (doc) {if (doc.type === "file" && doc.goodscan === true && doc.checksum) {emit(doc._id,doc.checksum); } }',
-        None
+    uptodate_files = [
+        '_design/syncstatus',
+        'uptodate',
+        file_map('if (f.type === "file" && f.goodscan === true && f.status.state !== "deleted" && f.orphaned === "no" && (f.datemodified >= f.sourcemodified)) { emit([f.host, f.scanID, f.datemodified], f.size); }'),
+        '_stats'
     ],
-    scanned_files = [
-        '_design/files',
-        'scanned',
-        'function (doc) {if (doc.type === "file" && doc.goodscan === true) { emit(doc._id,doc.size); } }',
+    stale_files = [
+        '_design/syncstatus',
+        'stale',
+        file_map('if (f.type === "file" && f.goodscan === true && f.status.state !== "deleted" && f.orphaned === "no" && (f.datemodified < f.sourcemodified)) { emit([f.host, f.scanID, f.datemodified, f.syncpath], f.size); }'),
         '_stats'
     ],
-    sync = [
-        '_design/sync',
-        'sync',
-        'function (doc) { if (doc.type === "file" && doc.goodscan === true) { emit([doc.IDprefix,doc.syncIDprefix],doc.datemodified); }}',
+    orphaned_files = [
+        '_design/syncstatus',
+        'orphaned',
+        file_map('if (f.type === "file" && f.goodscan === true && f.status.state !== "deleted" && f.orphaned === "yes") { emit([f.host, f.scanID, f.datemodified, f.syncpath], f.size); }'),
+        '_stats'
+    ],
+    unknown_files = [
+        '_design/syncstatus',
+        'unknown',
+        file_map('if (f.type === "file" && f.goodscan === true && f.status.state !== "deleted" && f.orphaned === "unknown") { emit([f.host, f.scanID, f.datemodified], f.size); }'),
         '_stats'
     ],
+    manifest_entries = [
+        '_design/syncstatus',
+        'entries',
+        file_map('if (f.type === "file" && f.status.state !== "deleted") { if (f.goodscan === true) { emit([f.host, f.syncpath], [f.size, f.datemodified, f.checksum]); } else { emit([f.host, f.syncpath], null); } }'),
+        None
+    ],
+    check_for_delete = [
+        '_design/housekeeping',
+        'expected',
+        file_map('if (f.type === "file" && f.status.state === "ok") { emit([f.host, f.path, f.name], f.datemodified); }'),
+        '_count'
+    ],
+    checksums = [
+        '_design/housekeeping',
+        'checksums',
+        file_map('if (f.type === "file" && f.goodscan === true && f.checksum) { emit(doc._id, f.checksum); }'),
+        None
+    ],
     duplicate_files = [
-        '_design/duplicates',
+        '_design/housekeeping',
         'duplicates',
-        'function (doc) { if (doc.type === "file" && doc.goodscan === true && doc.checksum && doc.status.state === "ok") { emit([doc.name,doc.datemodified,doc.checksum,doc.size,doc.host],doc.path); } }',
+        file_map('if (f.type === "file" && f.goodscan === true && f.checksum && f.status.state === "ok") { emit([f.name, f.datemodified, f.checksum, f.size, f.host], f.path); }'),
         '_count'
     ],
-    file_statuses = [
-        '_design/statuses',
-        'bystatedetail',
-        'function (doc) { if (doc.type === "file" && doc.goodscan === true && doc.status) { emit([doc.status.state,doc.status.detail,doc._id],doc.size); } }',
-        '_stats'
+    size_groups = [
+        '_design/housekeeping',
+        'sizes',
+        file_map('if (f.type === "file" && f.goodscan === true && f.status.state !== "deleted" && f.size > 0) { emit([f.host, f.size], [f.syncpath, f.checksum, f.fingerprint, f.datemodified]); }'),
+        None
     ]
 )
 
+# Design documents holding the scan database views before they were consolidated (view names are unchanged).
+# Scan databases older than config['consolidated_viewversion'] keep serving from these until the
+# consolidated indexes have been built, then they're removed
+legacy_scandb_ddocs = dict(
+    file_types = '_design/filetypes',
+    problem_files = '_design/problemfiles',
+    source_files = '_design/sourcefiles',
+    check_for_delete = '_design/deleted',
+    missing_files = '_design/syncstate',
+    checksums = '_design/heavyscan',
+    scanned_files = '_design/files',
+    sync = '_design/sync',
+    duplicate_files = '_design/duplicates',
+    file_statuses = '_design/statuses',
+    manifest_entries = '_design/manifest'
+)
+
 # Search design documents
+# Format is <index> = [<ddocname>,<indexfunction>,<analyzer>]
+# File names, sync paths and host IDs are indexed whole (keyword analyzer) so they can be matched
+# exactly or with wildcards. The stored fields give each file's sync state without reading its document
 search_indexes = dict(
     files = [
         '_design/filesearch',
-        'function (doc) {if (doc.type === "file") {index("name", doc.name, {"store": true}); index("path", doc.path);}}'
+        file_map('if (f.type === "file" && f.status.state !== "deleted") { index("name", f.name, {"store": true}); index("path", f.path); index("syncpath", f.syncpath, {"store": true}); index("host", f.host, {"store": true}); index("state", f.status.state, {"store": true}); if (f.goodscan === true) { index("size", f.size, {"store": true}); index("datemodified", f.datemodified, {"store": true}); } if (f.orphaned) { index("orphaned", f.orphaned, {"store": true}); } if (f.sourcemodified) { index("sourcemodified", f.sourcemodified, {"store": true}); } }'),
+        {"name": "perfield", "default": "standard", "fields": {"name": "keyword", "syncpath": "keyword", "host": "keyword"}}
     ],
     hosts = [
         '_design/hostsearch',
-        'function (doc) {if (doc.type === "host") {index("hostname", doc.hostname, {"store": true});}}'
+        'function (doc) {if (doc.type === "host") {index("hostname", doc.hostname, {"store": true});}}',
+        "standard"
     ]
 )
 
-# Cloudant Query indexes
-scan_index = dict(
-    fields = [
-        {'datemodified': 'desc'},
-        'IDprefix',
-        'syncIDprefix',
-        'size',
-        'checksum'
-    ]
+# Cloudant Query (JSON) indexes in scan database(s), for the document lookups dirscan and synccheck make
+# Format is <index> = [<ddocname>,<indexname>,<fields>]
+# All share one design document so they're built in a single pass over the database. Indexes ending
+# in _v2 cover the short field names of version 2 file documents
+scandb_json_indexes = dict(
+    status_by_host = ['_design/fileindexes', 'status-by-host', ['host', 'status.state']],
+    sync_prefixes = ['_design/fileindexes', 'sync-prefixes', ['IDprefix', 'syncIDprefix']],
+    files_by_path = ['_design/fileindexes', 'files-by-path', ['host', 'path']],
+    status_by_host_v2 = ['_design/fileindexes', 'status-by-host-v2', ['h', 'st.state']],
+    files_by_path_v2 = ['_design/fileindexes', 'files-by-path-v2', ['h', 'p']]
 )
 
 # Main execution code
@@ -226,14 +389,68 @@ def main():
             with cloudant(config['cloudant_user'],config['cloudant_auth'],account=config['cloudant_account']) as client:
                 purge_old_dbs(client)
                 
+        elif myargs.ingest_rsync_log != None:
+            try:
+                logfile = open(myargs.ingest_rsync_log)
+            except IOError as e:
+                print "I/O error({0}): {1}".format(e.errno, e.strerror)
+                sys.exit(2)
+            lock = scan_lock()
+            try:
+                with cloudant(config['cloudant_user'],config['cloudant_auth'],account=config['cloudant_account']) as client:
+                    this_ingest = FileScan(client, maindb_views, scandb_views, config, 'ingest')
+                    this_ingest.ingest_rsync_log(logfile)
+                    ver(" Ingested {0} changed and {1} deleted files.".format(this_ingest.scandoc['filecount'], this_ingest.scandoc['deletedcount']))
+            finally:
+                lock.release()
+            logfile.close()
+                
+        elif myargs.benchmark_indexes:
+            with cloudant(config['cloudant_user'],config['cloudant_auth'],account=config['cloudant_account']) as client:
+                benchmark_indexes(client)
+                
+        elif myargs.migrate_schema:
+            with cloudant(config['cloudant_user'],config['cloudant_auth'],account=config['cloudant_account']) as client:
+                migrate_file_schema(client)
+                
+        elif myargs.migrate_ids:
+            lock = scan_lock()
+            try:
+                with cloudant(config['cloudant_user'],config['cloudant_auth'],account=config['cloudant_account']) as client:
+                    migrate_document_ids(client)
+            finally:
+                lock.release()
+                
+        elif myargs.reconcile:
+            lock = scan_lock()
+            try:
+                with cloudant(config['cloudant_user'],config['cloudant_auth'],account=config['cloudant_account']) as client:
+                    reconcile(client)
+            finally:
+                lock.release()
+                
+        elif myargs.duplicates:
+            with cloudant(config['cloudant_user'],config['cloudant_auth'],account=config['cloudant_account']) as client:
+                find_duplicates(client)
+                
+        elif myargs.export_manifest != None:
+            with cloudant(config['cloudant_user'],config['cloudant_auth'],account=config['cloudant_account']) as client:
+                export_manifest(client, myargs.export_manifest)
+                
         else:
             # Initiate scan
             ver(" Initiating scan...")
-            with cloudant(config['cloudant_user'],config['cloudant_auth'],account=config['cloudant_account']) as client:
-                # Create scan object and execute
-                this_scan = FileScan(client, maindb_views, scandb_views, config)
-                elapsed_time = this_scan.run()
-                ver(" Scan completed at {0} on {1} files.".format(this_scan.scandoc['ended'],this_scan.scandoc['filecount']))
+            lock = scan_lock()
+            try:
+                with cloudant(config['cloudant_user'],config['cloudant_auth'],account=config['cloudant_account']) as client:
+                    # Create scan object and execute
+                    this_scan = FileScan(client, maindb_views, scandb_views, config)
+                    elapsed_time = this_scan.run()
+                    ver(" Scan completed at {0} on {1} files.".format(this_scan.scandoc['ended'],this_scan.scandoc['filecount']))
+                    if config['auto_reconcile'] and (config['storage_mode'] == 'documents'):
+                        reconcile(client)
+            finally:
+                lock.release()
 
         # We're done here
         sys.exit()
@@ -263,7 +480,7 @@ def config_check():
                 check_views(db, client, maindb_views)
                 insert_search_indexes(db, client, search_indexes['hosts'])
             elif db[:7] == 'scandb-':
-                check_views(db, client, scandb_views)
+                check_views(db, client, scandb_views, legacy_scandb_ddocs, scandb_json_indexes)
                 insert_search_indexes(db, client, search_indexes['files'])
     client.disconnect()
 
@@ -316,7 +533,7 @@ def create_initial_config(config_file):
                 
         # Insert design documents for required indexes in main db
         # Check each ddoc for existence before inserting
-        check_views(config['main_db_name'], maindb_views)
+        check_views(config['main_db_name'], client, maindb_views)
     
     # Begin process of collecting data
     relationship_status = ''
@@ -475,6 +692,9 @@ def load_config(config_file):
     config['relationship'] = config_json['relationship']
     config['host_id'] = config_json['host_id']
     config['doc_threshold'] = config_json['threshold']
+    for setting in optional_settings:
+        if setting in config_json:
+            config[setting] = config_json[setting]
     
     # Connect to database
     with cloudant(config['cloudant_user'], config['cloudant_auth'], account=config['cloudant_user']) as client:
@@ -488,6 +708,7 @@ def load_config(config_file):
             config['rsync_target'] = relationshipdoc['targethost']
             config['rsync_source_dir'] = relationshipdoc['sourcedir']
             config['rsync_target_dir'] = relationshipdoc['targetdir']
+            config['id_scheme'] = relationshipdoc.get('idscheme', 'hash')
         
         # Get hosts' IP addresses
         with Document(db, config['rsync_source']) as sourcedoc:
@@ -534,6 +755,11 @@ def get_args():
         action='store_true',
         help='Update an existing configuration'
         ) # Right now, this does nothing
+    group.add_argument(
+        '--reconcile',
+        action='store_true',
+        help='Fill in the sync state of the target\'s files from both hosts\' latest scans, then exit'
+        )
     argparser.add_argument(
         '-l',
         metavar='logging level',
@@ -543,6 +769,22 @@ def get_args():
         default = 'WARNING',
         type=str
         )
+    argparser.add_argument(
+        '--manifest-storage',
+        action='store_true',
+        help='Store the scan as compressed manifest chunks attached to the scan document instead of one document per file. Meant for very large trees'
+        )
+    argparser.add_argument(
+        '--fingerprint',
+        action='store_true',
+        help='Hash each file\'s size and a few sampled blocks, and compare them with the previous scan\'s to catch truncation and corruption that keeps the size and modified date'
+        )
+    argparser.add_argument(
+        '--verify-slice',
+        metavar='N',
+        type=int,
+        help='Checksum a rotating 1/N of the files each scan, plus new and changed files, and compare them with their stored checksums. Every file is verified once every N scans'
+        )
     argparser.add_argument(
         '--deep',
         action='store_true',
@@ -558,11 +800,48 @@ def get_args():
         action='store_true',
         help='Flush any old or stale scan databases from the Cloudant account, then exit.'
         )
+    group.add_argument(
+        '--ingest-rsync-log',
+        metavar='file',
+        type=str,
+        help='Update this host\'s scan database from an rsync --itemize-changes log of a transfer into this host\'s sync directory, instead of rescanning. Paths must be relative to the sync directory'
+        )
+    group.add_argument(
+        '--export-manifest',
+        metavar='file',
+        type=str,
+        help='Write this host\'s last scan to a compact binary manifest sorted by sync path, then exit'
+        )
+    group.add_argument(
+        '--migrate-schema',
+        action='store_true',
+        help='Rewrite the file documents of this host\'s scan database in the compact version 2 schema while it stays in use, then exit'
+        )
+    group.add_argument(
+        '--migrate-ids',
+        action='store_true',
+        help='Move both hosts\' scan databases to document IDs that keep each directory\'s files together, and switch the relationship over to them, then exit. Run it between scans'
+        )
+    group.add_argument(
+        '--duplicates',
+        action='store_true',
+        help='List the files of this host\'s last scan that have identical content and the space removing the extra copies would reclaim, then exit'
+        )
+    group.add_argument(
+        '--benchmark-indexes',
+        action='store_true',
+        help='Compare index build time and query latency of JavaScript views and JSON indexes on this host\'s scan database, then exit'
+        )
     
     myargs = argparser.parse_args()
     
     config['be_verbose'] = myargs.v
     config['ultra_scan'] = myargs.deep
+    config['fingerprint_scan'] = myargs.fingerprint
+    if myargs.verify_slice != None:
+        config['verify_cycle'] = max(myargs.verify_slice, 0)
+    if myargs.manifest_storage:
+        config['storage_mode'] = 'manifest'
     
     # Input any excludes for this scan, if passed during configuration stage
     if myargs.x != None:
@@ -583,12 +862,32 @@ class FileScan(object):
                 client,
                 maindb_views,
                 scandb_views,
-                config_dict
+                config_dict,
+                scan_type = 'scan'
             ):
         
         # base variables
         self.file_doc_batch = dict()
+        self.dir_doc_batch = dict()
+        # Merkle digests of directories whose parent hasn't been reached yet by the bottom-up sweep
+        self.dir_digests = dict()
         self.missing_files = []
+        # Slice of the tree checksummed by a --verify-slice scan (see run), and what its checksums found
+        self.verify_position = None
+        self.verify_totals = dict(files = 0, bytes = 0, mismatches = 0, unreadable = 0)
+        self.fingerprint_totals = dict(files = 0, bytes = 0, mismatches = 0)
+        # I/O budget of the stat and checksum stages, and pauses while the system is busy (see scheduler.py)
+        self.file_budget = scheduler.TokenBucket(config_dict['max_files_per_second'])
+        self.byte_budget = scheduler.TokenBucket(config_dict['max_bytes_per_second'])
+        self.governor = scheduler.LoadGovernor(config_dict['pause_load'], config_dict['pause_iowait'])
+        # Bloom filter of the source's files: built while scanning the source, loaded from the source's
+        # last scan while scanning the target (see run)
+        self.sync_filter = None
+        self.sync_filter_db = None
+        # Existing documents the scan changed (sync state, newly recorded checksums) awaiting a bulk write,
+        # and target (syncIDprefix, document) pairs awaiting a sync state lookup
+        self.updated_docs = dict()
+        self.pending_sync_tags = []
         self.complete = False
         self.client = client
         self.maindb_views = maindb_views
@@ -596,6 +895,13 @@ class FileScan(object):
         self.verbose = config_dict['be_verbose']
         self.config = config_dict
         self.speed = 0
+        # Counts and bytes per status, extension and size bucket, tallied during the sweep
+        self.summary = dict(
+            files = dict(count = 0, sum = 0),
+            statuses = dict(),
+            extensions = dict(),
+            sizes = dict()
+        )
         
         # Open main database. Order is important here.
         self.maindb = client[config_dict['main_db_name']]
@@ -615,6 +921,20 @@ class FileScan(object):
             self.scandb = client[self.scan_db_name]
             self.scandoc['firstscan'] = True
         
+        # Bring the views of an existing database up to the current version
+        if self.scandoc['firstscan'] == False:
+            self.check_views(self.scan_db_name, self.scandb_views)
+        
+        # File document schema versions this database may hold, including the one written from now on.
+        # Databases from before version 2 documents existed only hold version 1
+        versiondoc = Document(self.scandb, document_id="scanversion")
+        versiondoc.fetch()
+        self.file_schemas = versiondoc.get('fileschemas', [1])
+        if self.config['file_schema'] not in self.file_schemas:
+            self.file_schemas = self.file_schemas + [self.config['file_schema']]
+            versiondoc['fileschemas'] = self.file_schemas
+            versiondoc.save()
+        
         self.scandoc.create()
         self.scandoc['started'] = 0
         self.scandoc['ended'] = 0
@@ -623,12 +943,13 @@ class FileScan(object):
         self.scandoc['filecount'] = 0
         self.scandoc['errorcount'] = 0
         self.scandoc['directorysize'] = 0
-        self.scandoc['type'] = 'scan'
+        self.scandoc['type'] = scan_type
         self.scandoc['success'] = False
         self.scandoc['hostID'] = self.config['host_id']
         self.scandoc['previousscanID'] = ''
         self.scandoc['database'] = self.scan_db_name
         self.scandoc['deepscan'] = self.config['ultra_scan']
+        self.scandoc['storage'] = self.config['storage_mode']
         if (config['is_source']):
             self.scandoc['directory'] = self.config['rsync_source_dir']
         else:
@@ -657,12 +978,14 @@ class FileScan(object):
         
         # Populate scandb views
         self.check_views(new_scan_db_name, scandb_views)
-        # self.insert_search_indexes(new_scan_db_name, client, search_indexes['files'])
+        # The file search index is left until the first scan has loaded its documents (see run), so it's
+        # built in one pass instead of alongside every bulk insert
         
         # insert viewversion document
         with Document(new_scan_db,document_id="scanversion") as versiondoc:
             versiondoc['current'] = self.config['viewversion']
             versiondoc['history']= []
+            versiondoc['fileschemas'] = [self.config['file_schema']]
         
         # Set database name for this_scan
         return new_scan_db_name
@@ -700,22 +1023,54 @@ class FileScan(object):
         logging.info("Scan started at " + datetime.utcnow().isoformat(' ') + " UTC")
         self.ver("  Scan database: {0} Excluding: {1}".format(self.scandoc['database'], self.config['rsync_excluded']))
         
+        # Verify the slice after the one the previous scan verified
+        if (self.config['verify_cycle'] > 0) and (self.config['ultra_scan'] != True):
+            self.verify_position = self.next_verify_position()
+            self.ver("  Verifying slice {0} of {1}".format(self.verify_position + 1, self.config['verify_cycle']))
+        
+        # The source publishes a filter of its files for the target's next scan to test its own files against
+        if self.config['is_source']:
+            self.sync_filter = self.new_sync_filter()
+        elif self.config['storage_mode'] == 'documents':
+            self.sync_filter = self.load_sync_filter()
+        
         # Iterate through filesystem
-        self.sweep()
+        if self.config['storage_mode'] == 'manifest':
+            self.manifest_sweep()
+        else:
+            self.sweep()
+            
+            # Process files in DB that are no longer found at their previous locations on the filesystem
+            self.check_missing()
         
-        # Process files in DB that are no longer found at their previous locations on the filesystem
-        self.check_missing()
+        if self.config['is_source']:
+            self.publish_sync_filter()
             
         # Update scan document with final results
+        self.scandoc['summary'] = self.summary
+        self.scandoc['rootdigest'] = self.dir_digests.get(self.scandoc['directory'])
         if self.scandoc['errorcount'] == 0:
             self.scandoc['success'] = True
         self.scandoc['ended'] = int(time.time())
         if self.scandoc['ended'] == self.scandoc['started']:
                 self.scandoc['ended'] = self.scandoc['ended'] + 1
+        self.scandoc['pausedseconds'] = self.governor.paused
+        if self.verify_position != None:
+            self.scandoc['verify'] = dict(cycle = self.config['verify_cycle'], position = self.verify_position, **self.verify_totals)
+        if self.config['fingerprint_scan'] == True:
+            self.scandoc['fingerprint'] = dict(blocks = self.config['fingerprint_blocks'], blocksize = self.config['fingerprint_block_size'], **self.fingerprint_totals)
         
         # Save scan document    
         self.scandoc.save()
         
+        # Readers only use the sync filter and manifest of a host's latest successful scan
+        if self.scandoc['success'] == True:
+            self.prune_scan_attachments()
+        
+        # Deferred from new_scan_db. Only written when missing or out of date, so later scans don't rebuild it
+        if self.config['storage_mode'] == 'documents':
+            insert_search_indexes(self.scan_db_name, self.client, search_indexes['files'])
+        
         # Record completion time and speed
         self.speed = round(self.scandoc['filecount']  / ((self.scandoc['ended'] - self.scandoc['started']) / float(60)),1)
         logging.info("Rate of scan: {0} files per minute".format(self.speed))
@@ -727,6 +1082,92 @@ class FileScan(object):
         # Return time elapsed
         return self.scandoc['ended'] - self.scandoc['started']
   
+    # Apply an rsync itemized-change log to the scan database instead of walking the whole tree.
+    # Transferred files are stat'ed and written through the normal batch path. Deleted files, and the
+    # previous versions of files whose modified date changed, are marked as deleted
+    def ingest_rsync_log(self, logfile):
+        self.scandoc['started'] = int(time.time())
+        self.scandoc['deletedcount'] = 0
+        logging.info("Ingesting rsync log into database: " + self.scandoc['database'])
+        
+        # (path, name) of each changed file -> _id of its current version, or None when deleted
+        changed_files = dict()
+        for line in logfile:
+            change = parse_rsync_itemized(line)
+            if change == None:
+                continue
+            root = os.path.join(self.scandoc['directory'], os.path.dirname(change[1]))
+            name = os.path.basename(change[1])
+            if self.check_excluded(os.path.join(root,name)) == True:
+                continue
+            if change[0] == 'deleted':
+                changed_files[(unicode_name(root), unicode_name(name))] = None
+                self.scandoc['deletedcount'] = self.scandoc['deletedcount'] + 1
+            else:
+                thisfile = self.get_filesystem_metadata(root, name)
+                self.file_doc_batch[thisfile['_id']] = thisfile
+                changed_files[(unicode_name(root), unicode_name(name))] = thisfile['_id']
+                self.scandoc['filecount'] = self.scandoc['filecount'] + 1
+            
+            if len(self.file_doc_batch) >= self.config['doc_threshold']:
+                self.batch_process()
+            if len(changed_files) >= self.config['post_threshold']:
+                self.retire_versions(changed_files)
+        
+        if len(self.file_doc_batch) > 0:
+            self.batch_process()
+        if len(changed_files) > 0:
+            self.retire_versions(changed_files)
+        
+        if self.scandoc['errorcount'] == 0:
+            self.scandoc['success'] = True
+        self.scandoc['ended'] = int(time.time())
+        self.scandoc.save()
+        self.complete = True
+        return self.scandoc['ended'] - self.scandoc['started']
+    
+    # Mark as deleted every "ok" document for the given files other than their current version
+    def retire_versions(self, changed_files):
+        keys = [[self.config['host_id'], f[0], f[1]] for f in changed_files.keys()]
+        retired = []
+        now = int(time.time())
+        for row in self.view_docs_by_keys(self.scandb_views['check_for_delete'], keys):
+            if (row.get('doc') == None) or (row['id'] == changed_files.get((row['key'][1], row['key'][2]))):
+                continue
+            row['doc'][file_field(row['doc'], 'status')] = {'state': 'deleted', 'detail': now}
+            retired.append(row['doc'])
+            self.ver("  {0}/{1} replaced or deleted, marking as deleted.".format(row['key'][1], row['key'][2]))
+        if len(retired) > 0:
+            self.scandb.bulk_docs(retired)
+        changed_files.clear()
+    
+    # Rows (with documents unless <include_docs> is False) of a view in this scan's database, or <dbname>,
+    # for an exact list of keys, posting at most post_threshold keys per request
+    def view_docs_by_keys(self, view, keys, include_docs = True, dbname = None):
+        myurl = 'https://{0}.cloudant.com/{1}/{2}/_view/{3}'.format(
+            self.config['cloudant_account'],
+            dbname or self.scan_db_name,
+            view[0],
+            view[1]
+        )
+        my_header = {'Content-Type': 'application/json'}
+        rows = []
+        for start in range(0, len(keys), self.config['post_threshold']):
+            try:
+                r = requests.post(
+                    myurl,
+                    headers = my_header,
+                    params = {'include_docs': str(include_docs).lower(), 'reduce': 'false'},
+                    auth = (self.config['cloudant_user'], self.config['cloudant_auth']),
+                    data = json.dumps({'keys': keys[start:start + self.config['post_threshold']]})
+                )
+                r.raise_for_status()
+                rows.extend(r.json()['rows'])
+            except Exception as e:
+                logging.fatal("Unable to execute HTTP POST: {0}".format(e))
+                sys.exit("Unable to execute HTTP POST: {0}".format(e))
+        return rows
+    
     # Check all files in batch against existing DB entries.
     # Found entries are checked for corruption, then removed from the batch
     # Corrupted entries in DB updated whenever found
@@ -764,12 +1205,6 @@ class FileScan(object):
         result = new_method()
         #self.ver("  DB op time: {0} sec".format(time.time() - post_start))
             
-        # If the deep scan is enabled, validate checksums against existing files in DB. Otherwise use date/size
-        if self.config['ultra_scan'] == True:
-            check_field = 'checksum'
-        else:
-            check_field = 'size'
-            
         # If we've found some matching file IDs, check them for any change in size or checksum
         # The file's ID should be changed if the content has updated because it's tied to the update date.
         # If it hasn't, there's something likely wrong with the file
@@ -779,28 +1214,70 @@ class FileScan(object):
                 # If in the rare case a file's doc was deleted in the database, skip over it to re-insert
                 if f['doc'] == None:
                         continue
-                # If the contents of the file have changed locally:
-                if f['doc'][check_field] != self.file_doc_batch[f['key']][check_field]:
-                    self.ver("  {0}/{1} has changed locally without change to modified date. Possibly corrupted!".format(f['doc']['path'], f['doc']['name']))
-                    # Update the existing file document's content details, append a possible corruption warning.
-                    now = int(time.time())
-                    logging.warning("{0} mismatch from previous scan for {1}".format(check_field,f['doc']['name']))
-                    
-                    # Update the document in the database for the file directly.
-                    # One DB operation per changed file.
-                    # Might be best done in bulk, but first iteration using "easier" method
-                    with Document(self.scandb, document_id=f['key']) as doc:
-                        doc['error'] = "{0} mismatch without filesystem date change. Possible file corruption!".format(check_field)
-                        doc['status'] = {'state': 'ok', 'detail': 'possibly corrupted'}
-                        doc[check_field] = self.file_doc_batch[f['key']][check_field]
-                        doc['size'] = self.file_doc_batch[f['key']]['size']
-                        doc['datescanned'] = int(time.time())
+                self.check_existing_doc(self.file_doc_batch[f['key']], f['doc'])
                         
                 # Remove file's entry from the batch
                 self.file_doc_batch.pop(f['key'], None)
             else:
                 self.ver("  FileID {0} not found in DB and will be inserted.".format(f['key']))
     
+    # Compare a scanned file with its existing document <doc> (either schema version) of the same _id
+    def check_existing_doc(self, filedict, doc):
+        existing = expand_file_doc(doc)
+        # If the deep scan is enabled, validate checksums against existing files in DB. Otherwise use the
+        # strongest value both the scan and the document have: a checksum (from a verification slice), a
+        # fingerprint taken with the same sample settings, or the size
+        comparable = dict(
+            checksum = bool(filedict.get('checksum') and existing.get('checksum')),
+            fingerprint = bool(filedict.get('fingerprint') and existing.get('fingerprint')) and \
+                (filedict['fingerprint'].split(':')[0] == existing['fingerprint'].split(':')[0])
+        )
+        # A deep scan compares checksums unless this one couldn't read the file
+        if ((self.config['ultra_scan'] == True) and filedict.get('checksum')) or comparable['checksum']:
+            check_field = 'checksum'
+        elif comparable['fingerprint']:
+            check_field = 'fingerprint'
+        else:
+            check_field = 'size'
+        
+        # If the contents of the file have changed locally:
+        if existing[check_field] != filedict[check_field]:
+            self.ver("  {0}/{1} has changed locally without change to modified date. Possibly corrupted!".format(existing['path'], existing['name']))
+            # Update the existing file document's content details, append a possible corruption warning.
+            logging.warning("{0} mismatch from previous scan for {1}".format(check_field,existing['name']))
+            if check_field == 'checksum':
+                self.verify_totals['mismatches'] = self.verify_totals['mismatches'] + 1
+            elif check_field == 'fingerprint':
+                self.fingerprint_totals['mismatches'] = self.fingerprint_totals['mismatches'] + 1
+            
+            # Update the document in the database for the file directly, in whichever schema version it has.
+            # One DB operation per changed file.
+            # Might be best done in bulk, but first iteration using "easier" method
+            with Document(self.scandb, document_id=filedict['_id']) as doc:
+                doc[file_field(doc, 'error')] = "{0} mismatch without filesystem date change. Possible file corruption!".format(check_field)
+                doc[file_field(doc, 'status')] = {'state': 'ok', 'detail': 'possibly corrupted'}
+                doc[file_field(doc, check_field)] = filedict[check_field]
+                doc[file_field(doc, 'size')] = filedict['size']
+                doc[file_field(doc, 'datescanned')] = int(time.time())
+                doc[file_field(doc, 'syncIDprefix')] = filedict['syncIDprefix']
+            return
+        
+        # Keep the first checksum or fingerprint taken of the file, for later scans to compare against
+        for field in ['checksum', 'fingerprint']:
+            if filedict.get(field) and (not comparable[field]) and (existing['size'] == filedict['size']):
+                doc[file_field(doc, field)] = filedict[field]
+                self.updated_docs[doc['_id']] = doc
+        
+        # Documents written before the other host's ID prefix was computed from its own sync directory
+        # may carry a wrong one, which the reconcile and content joins would find no match for
+        if existing.get('syncIDprefix') != filedict['syncIDprefix']:
+            doc[file_field(doc, 'syncIDprefix')] = filedict['syncIDprefix']
+            self.updated_docs[doc['_id']] = doc
+        
+        # Bring the target's sync state up to date with the source's latest scan
+        if self.sync_filter != None:
+            self.tag_sync_state(filedict, doc)
+    
     # For each missing file, check to see if it exists somewhere else on the host now.
     # Currently done as one DB operation per file, but this is only for files that have
     # been moved or deleted, so their frequency will be much less
@@ -808,8 +1285,9 @@ class FileScan(object):
         #self.ver("  {0} missing files to check...".format(len(self.missing_files)))
         for missing_file in self.missing_files:
                 with Document(self.scandb, document_id=missing_file) as doc:
-                        doc['status'] = {'state': 'deleted', 'detail': int(time.time())}
-                        self.ver("  {0} not found, marking as deleted.".format(doc['name']))
+                        doc[file_field(doc, 'status')] = {'state': 'deleted', 'detail': int(time.time())}
+                        self.tally_bucket('statuses', 'deleted', doc.get(file_field(doc, 'size'), 0))
+                        self.ver("  {0} not found, marking as deleted.".format(doc[file_field(doc, 'name')]))
         del self.missing_files[:]
     
     # DEPRECATED: Batch-oriented scan model cannot support file movement detection due to duplication problem
@@ -842,24 +1320,269 @@ class FileScan(object):
     #                self.ver("  {0} not found, marking as deleted.".format(doc['name']))
     #    del self.missing_files[:]
     
-    def batch_process(self):
+    # <check> is False when the batch only holds files already known not to be in the database
+    def batch_process(self, check = True):
         # If this is the first in the database, don't bother checking anything.
         # Just insert all the file documents.  (We've just created the database and it's empty)
-        if self.scandoc['firstscan'] == True:
-            self.scandb.bulk_docs(self.file_doc_batch.values())
+        if (self.scandoc['firstscan'] == True) or (check == False):
+            self.verify_new_files()
+            self.tag_new_files()
+            if self.scandoc['firstscan'] == False:
+                self.retire_replaced_versions()
+            self.scandb.bulk_docs(self.stored_file_docs(self.file_doc_batch.values()))
             self.file_doc_batch.clear()
         # Otherwise, check the files against the database
         else:
             # Check existing files for changes against DB, then remove them from the batch
             self.check_existing()
+            self.verify_new_files()
+            self.tag_new_files()
+            self.retire_replaced_versions()
             # Insert remaining "new" documents and clear the batch
             if len(self.file_doc_batch) > 0:
-                self.scandb.bulk_docs(self.file_doc_batch.values())
+                self.scandb.bulk_docs(self.stored_file_docs(self.file_doc_batch.values()))
                 self.file_doc_batch.clear()
         # Update scan document in DB
         self.scandoc.save()
+        # Let the indexes catch up with this batch in the background instead of all at the end
+        self.refresh_indexes()
         self.ver("  Batch processed. Continuing scan.")
     
+    # Mark the documents of the previous versions of the new files in the batch as deleted. A file whose
+    # modified date changed gets a new _id, and the document of its previous version would otherwise stay
+    # "ok" and be counted alongside it
+    def retire_replaced_versions(self):
+        changed_files = dict()
+        for filedict in self.file_doc_batch.values():
+            if filedict.get('goodscan') == True:
+                changed_files[(unicode_name(filedict['path']), unicode_name(filedict['name']))] = filedict['_id']
+        if len(changed_files) > 0:
+            self.retire_versions(changed_files)
+    
+    # With --verify-slice, checksum the new and changed files left in the batch once the existing ones
+    # have been checked, so they have a checksum to be verified against from the start
+    def verify_new_files(self):
+        if self.verify_position == None:
+            return
+        for filedict in self.file_doc_batch.values():
+            if (filedict.get('goodscan') == True) and (not filedict.get('checksum')):
+                try:
+                    filedict['checksum'] = self.compute_file_checksum(filedict['path'], filedict['name'])
+                except (IOError, OSError) as e:
+                    self.verify_totals['unreadable'] = self.verify_totals['unreadable'] + 1
+                    logging.warning("Unable to checksum {0}/{1}: {2}".format(filedict['path'], filedict['name'], e))
+    
+    # Whether the file with ID prefix <idprefix> is in the slice this scan verifies. Slices are taken by
+    # a hash of the prefix rather than the prefix itself, since locality IDs share their leading characters
+    def in_verify_slice(self, idprefix):
+        if self.verify_position == None:
+            return False
+        return int(hashlib.md5(idprefix).hexdigest()[:8], 16) % self.config['verify_cycle'] == self.verify_position
+    
+    # Slice following the one verified by this host's most recent successful scan with the same cycle.
+    # Scans run without --verify-slice in between don't restart the cycle
+    def next_verify_position(self):
+        for row in iter_view(self.config['main_db_name'], self.maindb_views['recent_scans'], [self.config['host_id'], True, {}], [self.config['host_id'], True, 0], page_size = 50, include_docs = True, descending = True):
+            verify = row['doc'].get('verify', {})
+            if verify.get('cycle') == self.config['verify_cycle']:
+                return (verify['position'] + 1) % self.config['verify_cycle']
+        return 0
+    
+    # Tag the sync state of the new files in the batch, confirming any the filter can't settle, and write
+    # out the existing documents whose sync state changed
+    def tag_new_files(self):
+        if self.sync_filter != None:
+            for filedict in self.file_doc_batch.values():
+                self.tag_sync_state(filedict, filedict)
+        self.flush_sync_tags()
+    
+    # Tag the sync state of a target file (fields orphaned and sourcemodified) in <doc>, which is either the
+    # new <filedict> itself or the file's existing document. The source's filter settles most files at once:
+    #   path not in the filter - definitely orphaned
+    #   path, size and date modified in the filter - up to date (or, rarely, a false positive)
+    #   path in the filter but not that version - confirmed against the source's documents (confirm_sync_tags)
+    def tag_sync_state(self, filedict, doc):
+        if self.config['is_source'] or (filedict.get('goodscan') != True):
+            return
+        keys = sync_filter_keys(filedict)
+        if keys[0] not in self.sync_filter:
+            changed = set_sync_tags(doc, 'yes', None)
+        elif keys[1] in self.sync_filter:
+            changed = set_sync_tags(doc, 'no', filedict['datemodified'])
+        else:
+            self.pending_sync_tags.append((filedict['syncIDprefix'], doc))
+            return
+        if changed and ('_rev' in doc):
+            self.updated_docs[doc['_id']] = doc
+    
+    # Look up the source documents of the files the filter couldn't settle. A file without one was a false
+    # positive for its path and is orphaned; otherwise the source's date modified tells up to date from stale
+    def confirm_sync_tags(self):
+        if len(self.pending_sync_tags) == 0:
+            return
+        keys = [[self.config['rsync_source'], prefix] for prefix, doc in self.pending_sync_tags]
+        sourcemodified = dict()
+        for row in self.view_docs_by_keys(self.scandb_views['source_prefixes'], keys, False, self.sync_filter_db):
+            sourcemodified[row['key'][1]] = max(row['value'], sourcemodified.get(row['key'][1], row['value']))
+        for prefix, doc in self.pending_sync_tags:
+            if prefix in sourcemodified:
+                changed = set_sync_tags(doc, 'no', sourcemodified[prefix])
+            else:
+                changed = set_sync_tags(doc, 'yes', None)
+            if changed and ('_rev' in doc):
+                self.updated_docs[doc['_id']] = doc
+        del self.pending_sync_tags[:]
+    
+    # Confirm pending sync states and write the existing documents the scan changed
+    def flush_sync_tags(self):
+        self.confirm_sync_tags()
+        if len(self.updated_docs) > 0:
+            self.scandb.bulk_docs(self.updated_docs.values())
+            self.updated_docs.clear()
+    
+    # Empty sync filter for this source scan, sized from the number of files the previous scan found
+    def new_sync_filter(self):
+        previous = previous_scan_doc(self.config['host_id'])
+        if previous != None:
+            files = previous['filecount']
+        else:
+            files = self.config['sync_filter_files']
+        # Two keys per file, with some room for growth since the previous scan
+        return bloom.BloomFilter(int(files * 2.2) + 1000, self.config['sync_filter_error_rate'])
+    
+    # Attach the sync filter to the scan document in chunks and record its parameters there
+    def publish_sync_filter(self):
+        self.scandoc.save()
+        data = self.sync_filter.tostring()
+        chunks = []
+        for start in range(0, len(data), manifest.chunk_bytes):
+            name = 'syncfilter-{0:05d}'.format(len(chunks))
+            self.attach(name, data[start:start + manifest.chunk_bytes])
+            chunks.append(name)
+        self.scandoc.fetch()
+        self.scandoc['syncfilter'] = dict(
+            bits = self.sync_filter.bits,
+            hashes = self.sync_filter.hashes,
+            keys = self.sync_filter.count,
+            chunks = chunks
+        )
+        self.ver("  Sync filter of {0} keys published".format(self.sync_filter.count))
+    
+    # Sync filter published by the source's most recent successful scan, or None if it hasn't published one
+    def load_sync_filter(self):
+        source_scan = previous_scan_doc(self.config['rsync_source'])
+        if (source_scan == None) or ('syncfilter' not in source_scan):
+            return None
+        params = source_scan['syncfilter']
+        url = 'https://{0}.cloudant.com/{1}/{2}'.format(self.config['cloudant_account'], self.config['main_db_name'], source_scan['_id'])
+        data = []
+        for name in params['chunks']:
+            r = requests.get(url + '/' + name, auth = (self.config['cloudant_user'], self.config['cloudant_auth']))
+            if r.status_code != 200:
+                logging.warning("Unable to load the source's sync filter: HTTP {0}".format(r.status_code))
+                return None
+            data.append(r.content)
+        self.sync_filter_db = source_scan['database']
+        self.ver("  Sync filter of the source's scan {0} loaded".format(source_scan['_id']))
+        return bloom.BloomFilter(bits = params['bits'], hashes = params['hashes'], data = ''.join(data))
+    
+    # Remove the sync filter and manifest attachments of this host's earlier scans once this scan has
+    # published its own, so the main database doesn't grow by a filter and a manifest per scan. Manifest
+    # index documents of the pruned manifests are deleted with them
+    def prune_scan_attachments(self):
+        prefixes = []
+        if 'syncfilter' in self.scandoc:
+            prefixes.append('syncfilter-')
+        if 'manifestindex' in self.scandoc:
+            prefixes.append('manifest-')
+        if len(prefixes) == 0:
+            return
+        docs = []
+        index_ids = []
+        thisview = self.maindb_views['recent_scans']
+        for row in iter_view(self.config['main_db_name'], thisview, [self.config['host_id'], False, 0], [self.config['host_id'], True, {}], include_docs = True):
+            doc = row['doc']
+            if (doc == None) or (doc['_id'] == self.scandoc['_id']):
+                continue
+            attachments = doc.get('_attachments', {})
+            pruned = [name for name in attachments if len([prefix for prefix in prefixes if name.startswith(prefix)]) > 0]
+            if len(pruned) == 0:
+                continue
+            for name in pruned:
+                del attachments[name]
+            if len(attachments) == 0:
+                doc.pop('_attachments', None)
+            if 'syncfilter-' in prefixes:
+                doc.pop('syncfilter', None)
+            if ('manifest-' in prefixes) and ('manifestindex' in doc):
+                index_ids.append(doc.pop('manifestindex'))
+            docs.append(doc)
+        if len(docs) == 0:
+            return
+        scans = len(docs)
+        for row in iter_all_docs_by_keys(self.config['main_db_name'], index_ids):
+            if row.get('doc') != None:
+                docs.append({'_id': row['id'], '_rev': row['doc']['_rev'], '_deleted': True})
+        if bulk_write(self.config['main_db_name'], docs) > 0:
+            logging.warning("Some earlier scans' attachments couldn't be removed. The next scan will try again")
+        self.ver("  Attachments of {0} earlier scans removed".format(scans))
+    
+    # Attach <data> to the (saved) scan document as <name>, keeping track of its revision. Fetch the scan
+    # document once all attachments are written, so that saving it later keeps them
+    def attach(self, name, data):
+        url = 'https://{0}.cloudant.com/{1}/{2}/{3}'.format(
+            self.config['cloudant_account'],
+            self.config['main_db_name'],
+            self.scandoc['_id'],
+            name
+        )
+        try:
+            r = requests.put(
+                url,
+                auth = (self.config['cloudant_user'], self.config['cloudant_auth']),
+                params = {'rev': self.scandoc['_rev']},
+                headers = {'Content-Type': 'application/octet-stream'},
+                data = data
+            )
+            r.raise_for_status()
+        except Exception as e:
+            logging.fatal("Unable to attach {0}: {1}".format(name, e))
+            sys.exit("Unable to attach {0}: {1}".format(name, e))
+        self.scandoc['_rev'] = r.json()['rev']
+    
+    # File documents as written to the database, in the configured schema version. The batch itself keeps
+    # version 1 field names for the checks made against it
+    def stored_file_docs(self, filedicts):
+        if self.config['file_schema'] == 2:
+            return [compact_file_doc(d) for d in filedicts]
+        return filedicts
+    
+    # Query each scan database design document with update=lazy so Cloudant brings its index up to date
+    # in the background after answering. Failures only cost index freshness, so they don't stop the scan
+    def refresh_indexes(self):
+        refreshed = []
+        for thisview in self.scandb_views.values():
+            if thisview[0] in refreshed:
+                continue
+            refreshed.append(thisview[0])
+            params = {'limit': 0, 'stable': 'true', 'update': 'lazy'}
+            if thisview[3] != None:
+                params['reduce'] = 'false'
+            try:
+                r = requests.get(
+                    'https://{0}.cloudant.com/{1}/{2}/_view/{3}'.format(
+                        self.config['cloudant_account'],
+                        self.scan_db_name,
+                        thisview[0],
+                        thisview[1]
+                    ),
+                    auth = (self.config['cloudant_user'], self.config['cloudant_auth']),
+                    params = params
+                )
+                r.raise_for_status()
+            except Exception as e:
+                logging.warning("Unable to refresh index {0}: {1}".format(thisview[0], e))
+    
     def check_excluded(self, file_path):
         for exclude in self.config['rsync_excluded']: # TO-DO: May have to switch to using a regular expression here
             if exclude in file_path:
@@ -881,7 +1604,8 @@ class FileScan(object):
 
         # Values stored regardless of OS detail check
         filedict['IDprefix'] = self.get_file_id(self.config['host_id'], os.path.join(root,name), self.scandoc['directory'], 0)
-        filedict['syncIDprefix'] = self.get_file_id(self.config['other_host_id'], os.path.join(root,name), other_host_scan_dir, 0)
+        relative_path = os.path.join(root,name)[len(self.scandoc['directory']):]
+        filedict['syncIDprefix'] = self.get_file_id(self.config['other_host_id'], os.path.join(other_host_scan_dir, relative_path), other_host_scan_dir, 0)
         filedict['name'] = name
         filedict['scanID'] = self.scandoc['_id'] # this will not update unless the file changes
         filedict['host'] = self.config['host_id']
@@ -893,6 +1617,8 @@ class FileScan(object):
         filedict['syncpath'] = self.trim_sync_path(os.path.join(root,name))
         
         # Values from detail check
+        self.file_budget.consume()
+        self.governor.wait()
         try:
             stat = os.stat(os.path.join(root,name))
             filedict['size'] = int(stat.st_size)
@@ -903,10 +1629,16 @@ class FileScan(object):
             filedict['goodscan'] = True
             # Construct it's custom ID
             filedict['_id'] = self.get_file_id(self.config['host_id'], os.path.join(root,name), self.scandoc['directory'], int(stat.st_mtime))
-            if (self.config['ultra_scan'] == True):
-                filedict['checksum'] = self.compute_file_checksum(root,name)
-            else:
-                filedict['checksum'] = 0
+            filedict['checksum'] = 0
+            if (self.config['ultra_scan'] == True) or self.in_verify_slice(filedict['IDprefix']):
+                # A file that can be stat'ed may still not be readable (permissions, sockets, deleted since)
+                try:
+                    filedict['checksum'] = self.compute_file_checksum(root,name)
+                except (IOError, OSError) as e:
+                    self.verify_totals['unreadable'] = self.verify_totals['unreadable'] + 1
+                    logging.warning("Unable to checksum {0}: {1}".format(os.path.join(root,name), e))
+            if self.config['fingerprint_scan'] == True:
+                filedict['fingerprint'] = self.compute_file_fingerprint(root, name, filedict['size'])
             # Handle cases where the filename / path can't be properly encoded due to Unicode issues
             if '-ERROR' in filedict['_id']:
                 filedict['status'] = {'state': 'error', 'detail': 'Path encode error'}
@@ -916,8 +1648,10 @@ class FileScan(object):
             # Increment size of directory in scan document
             self.scandoc['directorysize'] = self.scandoc['directorysize'] + filedict['size']
         
-        except OSError as e:
-            # Store as bad scan of file and iterate errors. Also set ID without a timestamp
+        except (IOError, OSError) as e:
+            # Store as bad scan of file and iterate errors. Also set ID without a timestamp. Files that can be
+            # stat'ed but not opened for their fingerprint (permissions, sockets, deleted since) end up here too
+            filedict['goodscan'] = False
             filedict['_id'] = self.get_file_id(config['host_id'], os.path.join(root,name), self.scandoc['directory'], 0)
             self.scandoc['errorcount'] = self.scandoc['errorcount'] + 1
             filedict['status'] = {'state': 'error', 'detail': "OS error: {0} {1}".format(e.errno, e.strerror)}
@@ -927,7 +1661,14 @@ class FileScan(object):
         
     def sweep(self):
         
+        # With locality IDs, each directory's documents are read with one _all_docs range and checked as the
+        # directory is swept, so the batch only collects new files
+        by_directory = (self.config['id_scheme'] == 'locality') and (self.scandoc['firstscan'] == False)
+        
         for root, dirs, files in os.walk(self.scandoc['directory'], topdown=False):
+            digest_entries = []
+            if by_directory:
+                existing_docs = self.directory_file_docs(root)
             for name in files:
                 
                 # Skip excluded files / directories - BROKEN
@@ -936,40 +1677,182 @@ class FileScan(object):
                 
                 # Obtain detailed information on the file from the filesystem and add it to the batch
                 thisfile = self.get_filesystem_metadata(root, name)
-                self.file_doc_batch[thisfile['_id']] = thisfile
                 self.scandoc['filecount'] = self.scandoc['filecount'] + 1
+                self.tally(thisfile)
+                digest_entries.append(self.digest_entry(thisfile))
+                if self.config['is_source'] and (self.sync_filter != None):
+                    for key in sync_filter_keys(thisfile):
+                        self.sync_filter.add(key)
+                if by_directory and (thisfile['_id'] in existing_docs):
+                    self.check_existing_doc(thisfile, existing_docs[thisfile['_id']])
+                else:
+                    self.file_doc_batch[thisfile['_id']] = thisfile
                 
                 # Process once we have the threshold number of docs
                 if len(self.file_doc_batch) >= self.config['doc_threshold']:
                     self.ver("  Scanning... Total files so far: {0}".format(self.scandoc['filecount']))
-                    self.batch_process()
+                    self.batch_process(not by_directory)
+                    
+            # Record this directory's digest now that all of its files and subdirectories are known
+            self.record_directory(root, dirs, digest_entries)
                     
             # Iterate through directory tree, checking for any missing files
-            if (self.scandoc['firstscan'] == False):
+            if by_directory:
+                self.missing_directory_files(files, existing_docs)
+            elif (self.scandoc['firstscan'] == False):
                 self.missing_file_sweep(root, '')
             
         # Process any remaining files in the batch
         if len(self.file_doc_batch) > 0:
             self.ver("  Scanning... Total files so far: {0}".format(self.scandoc['filecount']))
-            self.batch_process()
+            self.batch_process(not by_directory)
+        self.flush_sync_tags()
+        if len(self.dir_doc_batch) > 0:
+            self.directory_batch_process()
     
-    def missing_file_sweep(self, root, directory):
-        view = self.scandb_views['check_for_delete']
-        result = self.scandb.get_view_result(
-            view[0],
-            view[1],
-            reduce=False
-        )
+    # Sweep the filesystem into a sorted manifest of the whole scan (see manifest.py), spooled to a temporary
+    # file, then attach it to the scan document. No file or directory documents are written, so even very
+    # large trees cost only a few requests per manifest chunk. Each scan stores a complete manifest, so
+    # there's nothing to check for deleted files
+    def manifest_sweep(self):
+        spool = tempfile.TemporaryFile()
+        count = manifest.write_sorted_manifest(self.manifest_entries(), spool)
+        self.ver("  {0} manifest entries written. Uploading.".format(count))
+        spool.seek(0)
+        self.upload_manifest(spool)
+        spool.close()
+    
+    # Manifest entries for every file under the sync directory, tallied and digested the same way as sweep
+    def manifest_entries(self):
+        for root, dirs, files in os.walk(self.scandoc['directory'], topdown=False):
+            digest_entries = []
+            for name in files:
+                
+                # Skip excluded files / directories - BROKEN
+                if self.check_excluded(os.path.join(root,name)) == True:
+                    continue
+                
+                thisfile = self.get_filesystem_metadata(root, name)
+                self.scandoc['filecount'] = self.scandoc['filecount'] + 1
+                self.tally(thisfile)
+                digest_entries.append(self.digest_entry(thisfile))
+                if self.config['is_source'] and (self.sync_filter != None):
+                    for key in sync_filter_keys(thisfile):
+                        self.sync_filter.add(key)
+                if thisfile.get('goodscan') == True:
+                    yield (thisfile['syncpath'], thisfile['size'], thisfile['datemodified'], thisfile['checksum'] or '', 0)
+                else:
+                    yield (thisfile['syncpath'], 0, 0, '', manifest.FLAG_ERROR)
+                
+                if self.scandoc['filecount'] % self.config['doc_threshold'] == 0:
+                    self.ver("  Scanning... Total files so far: {0}".format(self.scandoc['filecount']))
             
-        # Get all files marked as "ok" in database for this directory
-        this_dir_path = os.path.join(root,directory)
-        this_dir_result = result[[self.config['host_id'],this_dir_path,None]:[self.config['host_id'],this_dir_path,{}]]
-        #expected_files = []
-        #for expected_file in this_dir_result:
-        #        expected_files.append(expected_file['key'][2])
-        #ver(" Files expected in {0}:".format(this_dir_path))
-        #ver(this_dir_result)
-        #ver(" Files actual:")
+            self.record_directory(root, dirs, digest_entries)
+    
+    # Attach the sorted manifest in <spool> to the scan document as chunks of whole frames
+    # (manifest.split_manifest), then write an index document listing each chunk's path range and entry count
+    def upload_manifest(self, spool):
+        self.scandoc.save()
+        chunks = []
+        for data, first, last, count in manifest.split_manifest(spool):
+            name = 'manifest-{0:05d}'.format(len(chunks))
+            self.attach(name, data)
+            chunks.append(dict(name = name, first = unicode_name(first), last = unicode_name(last), entries = count, bytes = len(data)))
+        
+        # Pick up the attachment stubs, so that saving the scan document later keeps the chunks
+        self.scandoc.fetch()
+        
+        indexdoc = Document(self.maindb, document_id = self.scandoc['_id'] + '-manifest')
+        indexdoc['type'] = 'manifestindex'
+        indexdoc['scanID'] = self.scandoc['_id']
+        indexdoc['hostID'] = self.config['host_id']
+        indexdoc['entries'] = sum([chunk['entries'] for chunk in chunks])
+        indexdoc['chunks'] = chunks
+        indexdoc.create()
+        self.scandoc['manifestindex'] = indexdoc['_id']
+        self.ver("  Manifest stored in {0} chunks".format(len(chunks)))
+    
+    # Line describing a file in its directory's digest. Only host-independent values are used so that
+    # identical subtrees on the source and target produce identical digests
+    def digest_entry(self, filedict):
+        name = unicode_name(filedict['name'])
+        if filedict.get('goodscan') != True:
+            return u"{0}\0error".format(name)
+        if self.config['ultra_scan'] == True:
+            return u"{0}\0{1}\0{2}".format(name, filedict['size'], filedict['checksum'])
+        return u"{0}\0{1}\0{2}".format(name, filedict['size'], filedict['datemodified'])
+    
+    # Compute the Merkle digest of a directory from its file entries and its subdirectories' digests.
+    # os.walk is bottom-up here, so each subdirectory has already been recorded when its parent is reached
+    def record_directory(self, root, dirs, digest_entries):
+        digest_entries.sort()
+        filedigest = hashlib.sha1(u"\n".join(digest_entries).encode('utf-8')).hexdigest()
+        subdirs = dict()
+        for d in dirs:
+            child = os.path.join(root, d)
+            if child in self.dir_digests:
+                subdirs[unicode_name(d)] = self.dir_digests.pop(child)
+        dirhash = hashlib.sha1(filedigest)
+        for d in sorted(subdirs):
+            dirhash.update(u"\n{0}\0{1}".format(d, subdirs[d]).encode('utf-8'))
+        self.dir_digests[root] = dirhash.hexdigest()
+        if self.config['storage_mode'] != 'documents':
+            return
+        
+        dirdoc = dict()
+        dirdoc['_id'] = 'dir-' + self.get_file_id(self.config['host_id'], root, self.scandoc['directory'], 0)
+        dirdoc['type'] = 'directory'
+        dirdoc['host'] = self.config['host_id']
+        dirdoc['relationship'] = self.config['relationship']
+        dirdoc['scanID'] = self.scandoc['_id']
+        dirdoc['syncpath'] = self.trim_sync_path(root)
+        dirdoc['digest'] = self.dir_digests[root]
+        dirdoc['filedigest'] = filedigest
+        dirdoc['subdirs'] = subdirs
+        dirdoc['files'] = len(digest_entries)
+        dirdoc['deep'] = self.config['ultra_scan']
+        dirdoc['datescanned'] = int(time.time())
+        self.dir_doc_batch[dirdoc['_id']] = dirdoc
+        if len(self.dir_doc_batch) >= self.config['doc_threshold']:
+            self.directory_batch_process()
+    
+    # Write directory digest documents, skipping any whose digest is unchanged since the last scan
+    def directory_batch_process(self):
+        if self.scandoc['firstscan'] == False:
+            result = self.scandb.all_docs(
+                include_docs = True,
+                keys = self.dir_doc_batch.keys()
+            )
+            for row in result['rows']:
+                if ('doc' not in row) or (row['doc'] == None):
+                    continue
+                if row['doc']['digest'] == self.dir_doc_batch[row['key']]['digest']:
+                    self.dir_doc_batch.pop(row['key'], None)
+                else:
+                    self.dir_doc_batch[row['key']]['_rev'] = row['doc']['_rev']
+        if len(self.dir_doc_batch) > 0:
+            self.scandb.bulk_docs(self.dir_doc_batch.values())
+        self.dir_doc_batch.clear()
+    
+    # Add a scanned file to the summary aggregates stored in the scan document at the end of the run.
+    # Extensions and size buckets only cover files that could be read, matching the file_types view
+    def tally(self, filedict):
+        size = filedict.get('size', 0)
+        self.tally_bucket('statuses', filedict['status']['state'], size)
+        if filedict.get('goodscan') == True:
+            self.summary['files']['count'] = self.summary['files']['count'] + 1
+            self.summary['files']['sum'] = self.summary['files']['sum'] + size
+            self.tally_bucket('extensions', file_extension(filedict['name']), size)
+            self.tally_bucket('sizes', size_bucket(size), size)
+
+    def tally_bucket(self, aggregate, key, size):
+        bucket = self.summary[aggregate].setdefault(key, dict(count = 0, sum = 0))
+        bucket['count'] = bucket['count'] + 1
+        bucket['sum'] = bucket['sum'] + size
+
+    def missing_file_sweep(self, root, directory):
+        # Documents store the directory exactly as os.walk reported it, without a trailing slash
+        this_dir_path = os.path.join(root,directory) if len(directory) > 0 else root
         
         # Get all files currently in the filesystem directory
         try:
@@ -977,14 +1860,36 @@ class FileScan(object):
             #ver(actual_files)
         except OSError as e:
             self.ver("  Couldn't open {0}: {1}".format(this_dir_path, e))
+            return
             
+        # Get all files marked as "ok" in database for this directory, then check the filesystem for
+        # any missing locally. Store the IDs of any that aren't there so we can process them after the sweep is finished
+        selector = {'host': self.config['host_id'], 'path': this_dir_path, 'status.state': 'ok'}
+        for d in find_files(self.scan_db_name, selector, ['_id', 'name'], self.file_schemas):
+            if d['name'] not in actual_files:
+                self.missing_files.append(d['_id'])
+                self.ver("  Missing file logged for check: {0}".format(d['_id']))
             
-        # check filesystem for any missing files locally.
-        # Store the IDs of any that aren't there so we can process them after the sweep is finished
-        for d in this_dir_result:
-            if d['key'][2] not in actual_files:
-                self.missing_files.append(d['id'])
-                self.ver("  Missing file logged for check: {0}".format(d['id']))
+    # Existing documents of the files directly in <root>, by _id, read with a single _all_docs range over
+    # the directory's locality ID prefix
+    def directory_file_docs(self, root):
+        relative = unicode_name(root[len(self.scandoc['directory']):]).encode('utf-8')
+        prefix = directory_id_prefix(self.config['host_id'], relative)
+        docs = dict()
+        for row in iter_all_docs(self.scan_db_name, prefix, prefix + u'\ufff0', include_docs = True):
+            doc = expand_file_doc(row['doc'])
+            # Guard against another directory whose hash shares the prefix
+            if (doc.get('type') == 'file') and (doc['path'] == unicode_name(root)):
+                docs[row['id']] = row['doc']
+        return docs
+    
+    # Log the documents among <existing_docs> marked "ok" whose file isn't in <files> any more
+    def missing_directory_files(self, files, existing_docs):
+        actual_files = set([unicode_name(name) for name in files])
+        for d in [expand_file_doc(doc) for doc in existing_docs.values()]:
+            if (d['status']['state'] == 'ok') and (d['name'] not in actual_files):
+                self.missing_files.append(d['_id'])
+                self.ver("  Missing file logged for check: {0}".format(d['_id']))
             
     def get_file_id(self, host_id, full_path, top_dir, timestamp):
         # trim the top_dir from the full path
@@ -996,7 +1901,7 @@ class FileScan(object):
             appender = str(timestamp)
         try:
             f1 = relative_path.decode('utf-8', errors='replace')
-            filehash = hashlib.sha1(host_id + f1.encode('utf-8', errors='replace')).hexdigest() + appender
+            filehash = document_id(host_id, f1.encode('utf-8', errors='replace'), self.config['id_scheme']) + appender
             logging.debug("Hashing input: {0},{1}{2}, {3} Output:{4}".format(host_id,top_dir,full_path,timestamp,filehash))
         except UnicodeDecodeError:
             logging.error("Can't decode: " + relative_path)
@@ -1013,73 +1918,25 @@ class FileScan(object):
             return(re.sub('^{0}'.format(self.config['rsync_target_dir']),'',fullpath))
         
     def compute_file_checksum(self, root, fname):
-        path = os.path.join(root,fname)
-        filehash = hashlib.md5()
-        with open(path, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                filehash.update(chunk)
-        return filehash.hexdigest()
+        checksum, read = file_checksum(os.path.join(root,fname), self.byte_budget)
+        self.verify_totals['files'] = self.verify_totals['files'] + 1
+        self.verify_totals['bytes'] = self.verify_totals['bytes'] + read
+        return checksum
+
+    def compute_file_fingerprint(self, root, fname, size):
+        fingerprint, read = file_fingerprint(os.path.join(root,fname), size, self.config['fingerprint_blocks'], self.config['fingerprint_block_size'], self.byte_budget)
+        self.fingerprint_totals['files'] = self.fingerprint_totals['files'] + 1
+        self.fingerprint_totals['bytes'] = self.fingerprint_totals['bytes'] + read
+        return fingerprint
 
     def ver(self, string):
         if self.config['be_verbose'] == True:
             print string
         logging.info(string)
 
-    # Check database views in database with <dbname> using client <c>, and the set of <views>
+    # Check database views in database with <dbname>, and the set of <views>
     def check_views(self, dbname, views):
-        
-        def updater():
-            # Open each ddoc / view combo for existing
-            for thisview in views.values():
-                ddoc = DesignDocument(db,thisview[0])
-                if ddoc.exists() == False:
-                    # Create ddoc and view
-                    logging.info("Creating {0}/{1}".format(thisview[0],thisview[1]))
-                    self.ver("  Creating {0}/{1}".format(thisview[0],thisview[1]))
-                    ddoc = DesignDocument(db, document_id=thisview[0])
-                    ddoc.add_view(thisview[1], thisview[2], reduce_func = thisview[3])
-                    ddoc.save()
-                else:
-                    # doc exists, check view
-                    ddoc.fetch()
-                    oldview = ddoc.get_view(thisview[1])
-                    # if view not there
-                    if oldview == None:
-                        # insert it
-                        logging.info("Inserting {1} into {0}".format(thisview[0],thisview[1]))
-                        self.ver("  Inserting {1} into {0}".format(thisview[0],thisview[1]))
-                        ddoc.add_view(thisview[1],thisview[2],thisview[3])
-                        ddoc.save()
-                    # if view function is different
-                    elif (oldview['map'] != thisview[2]):
-                        # Update
-                        logging.info("Updating {0}/{1}".format(thisview[0],thisview[1]))
-                        self.ver("  Updating {0}/{1}".format(thisview[0],thisview[1]))
-                        ddoc.update_view(thisview[1],thisview[2],thisview[3])
-                        ddoc.save()
-                    else:
-                        self.ver("  Skipping {0}/{1}".format(thisview[0],thisview[1]))
-                        continue
-        
-        db = self.client[dbname]
-        versiondoc = Document(db,document_id="scanversion")
-        if versiondoc.exists() != True:
-            versiondoc.create()
-            versiondoc['current'] = self.config['viewversion']
-            versiondoc['history']= []
-            versiondoc.save()
-            self.ver("  Database is new")
-            updater()
-        else:
-            versiondoc.fetch()
-        if versiondoc['current'] < self.config['viewversion']:
-            self.ver("  Database is older version. Upgrading views.")
-            updater()
-            versiondoc.update_field(action=versiondoc.list_field_append, field='history', value = versiondoc['current'])
-            versiondoc.update_field(action=versiondoc.field_set, field='current', value = config['viewversion'])
-            versiondoc.save()
-        else:
-            self.ver("  Database is up-to-date!")
+        check_views(dbname, self.client, views, legacy_scandb_ddocs, scandb_json_indexes)
 
 # Print if verbose
 def ver(string):
@@ -1170,7 +2027,82 @@ def list_relationships(db):
 # Output a formatted date/time from UTC timestamp
 def pretty_time(timestamp):
     return (datetime.fromtimestamp(int(timestamp)).ctime())
+
+# Extension of a filename, computed the same way as the file_types view (no dot or leading dot gives '')
+def file_extension(name):
+    dot = name.rfind('.')
+    if dot > 0:
+        return name[dot + 1:]
+    return ''
+
+# Parse one line of rsync itemized output. Returns ('updated', path) for a regular file that was
+# transferred, created or had its attributes changed, ('deleted', path) for a deleted file, or None
+def parse_rsync_itemized(line):
+    match = rsync_itemize_pattern.match(line)
+    if match == None:
+        return None
+    change, path = match.group(1), match.group(2)
+    if path.endswith('/'):
+        return None
+    if change == '*deleting':
+        return ('deleted', path)
+    if change[1] != 'f':
+        return None
+    # A line of dots and spaces is an unchanged file listed because of -ii
+    if (change[0] == '.') and (change[2:].strip('. ') == ''):
+        return None
+    # Hard links are logged as "path => existing file" (rsync's %L)
+    if (change[0] == 'h') and (' => ' in path):
+        path = path.split(' => ', 1)[0]
+    return ('updated', path)
+
+# Path component as unicode, replacing anything that isn't valid UTF-8
+def unicode_name(name):
+    if isinstance(name, str):
+        return name.decode('utf-8', 'replace')
+    return name
+
+# Label of the summary size bucket a file of <size> bytes belongs to
+def size_bucket(size):
+    for bucket in summary_size_buckets:
+        if bucket[1] == None or size < bucket[1]:
+            return bucket[0]
     
+# Fingerprint of the file at <path> of <size> bytes: the SHA-1 of its size and of <blocks> blocks of
+# <block_size> bytes (the first, the last and evenly spaced ones between), prefixed with the sample
+# settings since fingerprints taken with different ones can't be compared. Files no bigger than the
+# samples are hashed whole. Reads are charged to the TokenBucket <budget>, if any.
+# Returns the fingerprint and the number of bytes read
+def file_fingerprint(path, size, blocks, block_size, budget = None):
+    filehash = hashlib.sha1(str(size))
+    read = 0
+    with open(path, "rb") as f:
+        if size <= blocks * block_size:
+            samples = [(0, size)]
+        else:
+            samples = [((size - block_size) * i // max(blocks - 1, 1), block_size) for i in range(blocks)]
+        for offset, length in samples:
+            f.seek(offset)
+            chunk = f.read(length)
+            if budget != None:
+                budget.consume(len(chunk))
+            filehash.update(chunk)
+            read = read + len(chunk)
+    return "{0}x{1}:{2}".format(blocks, block_size, filehash.hexdigest()), read
+
+# MD5 checksum of the whole file at <path>, with reads charged to the TokenBucket <budget>, if any.
+# Returns the checksum and the number of bytes read
+def file_checksum(path, budget = None):
+    filehash = hashlib.md5()
+    read = 0
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(4096), b""):
+            if budget != None:
+                budget.consume(len(chunk))
+            filehash.update(chunk)
+            read = read + len(chunk)
+    return filehash.hexdigest(), read
+
 # Clean up derelict scan databases in the Cloudant account
 def purge_old_dbs(client):
     day = 86400
@@ -1182,7 +2114,7 @@ def purge_old_dbs(client):
         elif ((current_time - int(db[7:])) > day):
             # If the database is older than one day, and has no documents besides ddocs
             empty_db = client[db]
-            if empty_db.doc_count() < (len(scandb_views) + len(search_indexes) + 1):
+            if empty_db.doc_count() < (len(set([v[0] for v in scandb_views.values()])) + len(search_indexes) + 1):
                 ver(" Deleting empty database: " + db)
                 empty_db.delete()
                 dblist.remove(db)
@@ -1202,8 +2134,495 @@ def purge_old_dbs(client):
             doomed_db = client[db]
             doomed_db.delete()
     
-# Check database views in database with <dbname> using client <c>, and the set of <views>
-def check_views(dbname, c, views):
+# Name of the scan database used by <host_id>'s most recent scan, or None if the host has never scanned
+def latest_scan_db(maindb, host_id):
+    thisview = maindb_views['recent_scans']
+    result = maindb.get_view_result(thisview[0], thisview[1], reduce=False, descending=True)
+    lastscan = result[[host_id,{},{}]:[host_id,None,0]]
+    if (lastscan != None) and (len(lastscan) > 0):
+        return lastscan[0]['value']
+    return None
+
+# Take this host's lock file for the relationship and lower the scanner's priority as configured. Scans,
+# reconciles and ID migrations all hold it. Exits if another of them holds the lock
+def scan_lock():
+    lock = scheduler.ScanLock(os.path.join(config['lock_dir'], 'dirscan-{0}-{1}.lock'.format(config['relationship'], config['host_id'])))
+    if not lock.acquire():
+        logging.fatal("Another scan of relationship {0} is running (process {1})".format(config['relationship'], lock.holder()))
+        sys.exit(" Another scan of this relationship is running (process {0}). Exiting.".format(lock.holder()))
+    for problem in scheduler.set_priority(config['scan_nice'], config['scan_ionice']):
+        logging.warning(problem)
+    return lock
+
+# Document of <host_id>'s most recent successful scan, or None if it has none
+def previous_scan_doc(host_id):
+    thisview = maindb_views['recent_scans']
+    response = requests.get(
+        "https://{0}.cloudant.com/{1}/{2}/_view/{3}".format(config['cloudant_account'], config['main_db_name'], thisview[0], thisview[1]),
+        auth = (config['cloudant_user'], config['cloudant_auth']),
+        params = {
+            'startkey': json.dumps([host_id, True, {}]),
+            'endkey': json.dumps([host_id, True, 0]),
+            'descending': 'true',
+            'reduce': 'false',
+            'include_docs': 'true',
+            'limit': 1
+        }
+    )
+    if response.status_code != 200:
+        logging.fatal("Unable to read {0}/{1}: HTTP {2}".format(thisview[0], thisview[1], response.status_code))
+        sys.exit("Unable to read {0}/{1}: HTTP {2}".format(thisview[0], thisview[1], response.status_code))
+    rows = response.json()['rows']
+    if len(rows) == 0:
+        return None
+    return rows[0]['doc']
+
+# Keys of a file in the source's sync filter: its sync path, then (for files that could be read) its
+# sync path with its size and date modified
+def sync_filter_keys(filedict):
+    path = unicode_name(filedict['syncpath']).encode('utf-8')
+    keys = ['p\0' + path]
+    if filedict.get('goodscan') == True:
+        keys.append('f\0{0}\0{1}\0{2}'.format(path, filedict['size'], filedict['datemodified']))
+    return keys
+
+# Set the sync state fields of a target file document (either schema version). Returns whether they changed
+def set_sync_tags(doc, orphaned, sourcemodified):
+    if (doc.get(file_field(doc, 'orphaned')) == orphaned) and (doc.get(file_field(doc, 'sourcemodified')) == sourcemodified):
+        return False
+    doc[file_field(doc, 'orphaned')] = orphaned
+    doc[file_field(doc, 'sourcemodified')] = sourcemodified
+    return True
+
+# File document schema versions that scan database <db> may hold (see FileScan.__init__)
+def file_schemas(db):
+    versiondoc = Document(db, document_id="scanversion")
+    if versiondoc.exists() != True:
+        return [1]
+    versiondoc.fetch()
+    return versiondoc.get('fileschemas', [1])
+
+# Iterate over the rows of <view> between <startkey> and <endkey>, a page of <page_size> rows per request.
+# Each page resumes from the key and document ID of the row following the last one returned
+def iter_view(dbname, view, startkey, endkey, page_size = None, include_docs = False, descending = False):
+    if page_size == None:
+        page_size = config['doc_threshold']
+    url = "https://{0}.cloudant.com/{1}/{2}/_view/{3}".format(
+        config['cloudant_account'],
+        dbname,
+        view[0],
+        view[1]
+    )
+    params = dict(
+        reduce = 'false',
+        startkey = json.dumps(startkey),
+        endkey = json.dumps(endkey),
+        limit = page_size + 1
+    )
+    if include_docs == True:
+        params['include_docs'] = 'true'
+    if descending == True:
+        params['descending'] = 'true'
+    while True:
+        response = requests.get(
+            url,
+            auth = (config['cloudant_user'], config['cloudant_auth']),
+            params = params
+        )
+        if response.status_code not in (200,201,202):
+            logging.fatal("Unable to read {0}/{1}: HTTP {2}".format(view[0], view[1], response.status_code))
+            sys.exit("Unable to read {0}/{1}: HTTP {2}".format(view[0], view[1], response.status_code))
+        rows = response.json()['rows']
+        for row in rows[:page_size]:
+            yield row
+        if len(rows) <= page_size:
+            return
+        params['startkey'] = json.dumps(rows[page_size]['key'])
+        params['startkey_docid'] = rows[page_size]['id']
+
+# Write this host's files from its most recent scan database to a binary manifest (see manifest.py)
+def export_manifest(client, filename):
+    scan_db_name = latest_scan_db(client[config['main_db_name']], config['host_id'])
+    if scan_db_name == None:
+        sys.exit(" No scans found for this host.")
+    check_views(scan_db_name, client, scandb_views, legacy_scandb_ddocs, scandb_json_indexes)
+    ver(" Exporting {0} from {1}".format(config['host_id'], scan_db_name))
+    
+    def entries():
+        view = scandb_views['manifest_entries']
+        for row in iter_view(scan_db_name, view, [config['host_id'], None], [config['host_id'], {}]):
+            if row['value'] == None:
+                yield (row['key'][1], 0, 0, '', manifest.FLAG_ERROR)
+            else:
+                yield (row['key'][1], row['value'][0], row['value'][1], row['value'][2] or '', 0)
+    
+    try:
+        output = open(filename, 'wb')
+    except IOError as e:
+        print "I/O error({0}): {1}".format(e.errno, e.strerror)
+        sys.exit(2)
+    count = manifest.write_sorted_manifest(entries(), output)
+    output.close()
+    ver(" {0} entries written to {1}".format(count, filename))
+    logging.info("Exported {0} manifest entries to {1}".format(count, filename))
+
+# Report the groups of identical files in this host's last scan, with the space that removing all but one
+# copy of each would reclaim. The size_groups view is streamed in size order, so files whose size no other
+# file has are never read. Files sharing a size are told apart by fingerprint, and only those sharing a
+# fingerprint are hashed in full (see duplicate_groups)
+def find_duplicates(client):
+    scan_db_name = latest_scan_db(client[config['main_db_name']], config['host_id'])
+    if scan_db_name == None:
+        sys.exit(" No scans found for this host.")
+    check_views(scan_db_name, client, scandb_views, legacy_scandb_ddocs, scandb_json_indexes)
+    if config['is_source'] == True:
+        directory = unicode_name(config['rsync_source_dir'])
+    else:
+        directory = unicode_name(config['rsync_target_dir'])
+    ver(" Looking for duplicates in {0} from {1}".format(config['host_id'], scan_db_name))
+    
+    totals = dict(groups = 0, files = 0, reclaimable = 0, read = 0)
+    rows = iter_view(scan_db_name, scandb_views['size_groups'], [config['host_id'], 1], [config['host_id'], {}])
+    for size, group in itertools.groupby(rows, lambda row: row['key'][1]):
+        # Every version document of a file is in the view until the file is found deleted, so a file
+        # rewritten at the same size appears more than once. Its latest version counts
+        files = dict()
+        for row in group:
+            if (row['value'][0] not in files) or (row['value'][3] > files[row['value'][0]][3]):
+                files[row['value'][0]] = row['value']
+        if len(files) < 2:
+            continue
+        for copies in duplicate_groups(directory, size, files.values(), totals):
+            totals['groups'] = totals['groups'] + 1
+            totals['files'] = totals['files'] + len(copies)
+            totals['reclaimable'] = totals['reclaimable'] + size * (len(copies) - 1)
+            print " {0} copies of {1:,} bytes:".format(len(copies), size)
+            for syncpath in sorted(copies):
+                print u"   /{0}".format(syncpath.lstrip('/'))
+    print " {0:,} groups of duplicates holding {1:,} files. {2:,} bytes reclaimable, {3:,} bytes read to find them.".format(totals['groups'], totals['files'], totals['reclaimable'], totals['read'])
+    logging.info("Found {0} groups of duplicate files, {1} bytes reclaimable".format(totals['groups'], totals['reclaimable']))
+
+# Split the <files> ([syncpath, checksum, fingerprint, datemodified] from size_groups, one per syncpath)
+# of <size> bytes under <directory> into groups with identical content, yielding the syncpaths of each
+# group of two or more files. Checksums and fingerprints the scan recorded are used as they are, the
+# others are read from the files, counting the bytes read into <totals>. Files that can't be read, or
+# whose size or modified date has changed since the scan, are left out
+def duplicate_groups(directory, size, files, totals):
+    settings = "{0}x{1}:".format(config['fingerprint_blocks'], config['fingerprint_block_size'])
+    by_fingerprint = dict()
+    for syncpath, checksum, fingerprint, datemodified in files:
+        try:
+            stat = os.stat(directory + syncpath)
+        except OSError as e:
+            logging.warning("Unable to stat {0}: {1}".format(syncpath, e))
+            continue
+        if (stat.st_size != size) or (int(stat.st_mtime) != datemodified):
+            continue
+        if not (fingerprint or '').startswith(settings):
+            try:
+                fingerprint, read = file_fingerprint(directory + syncpath, size, config['fingerprint_blocks'], config['fingerprint_block_size'])
+            except (IOError, OSError) as e:
+                logging.warning("Unable to fingerprint {0}: {1}".format(syncpath, e))
+                continue
+            totals['read'] = totals['read'] + read
+        by_fingerprint.setdefault(fingerprint, []).append((syncpath, checksum))
+    
+    for candidates in by_fingerprint.values():
+        if len(candidates) < 2:
+            continue
+        # The fingerprint of a file no bigger than its samples already covers all of it
+        if size <= config['fingerprint_blocks'] * config['fingerprint_block_size']:
+            yield [syncpath for syncpath, checksum in candidates]
+            continue
+        by_checksum = dict()
+        for syncpath, checksum in candidates:
+            if not checksum:
+                try:
+                    checksum, read = file_checksum(directory + syncpath)
+                except (IOError, OSError) as e:
+                    logging.warning("Unable to checksum {0}: {1}".format(syncpath, e))
+                    continue
+                totals['read'] = totals['read'] + read
+            by_checksum.setdefault(checksum, []).append(syncpath)
+        for copies in by_checksum.values():
+            if len(copies) > 1:
+                yield copies
+
+# Iterate over the rows of _all_docs in <dbname> from <startkey> to <endkey> (the whole database if None),
+# a page of <page_size> rows per request
+def iter_all_docs(dbname, startkey = None, endkey = None, page_size = None, include_docs = False):
+    if page_size == None:
+        page_size = config['doc_threshold']
+    url = "https://{0}.cloudant.com/{1}/_all_docs".format(config['cloudant_account'], dbname)
+    params = dict(limit = page_size + 1)
+    if startkey != None:
+        params['startkey'] = json.dumps(startkey)
+    if endkey != None:
+        params['endkey'] = json.dumps(endkey)
+    if include_docs == True:
+        params['include_docs'] = 'true'
+    while True:
+        response = requests.get(
+            url,
+            auth = (config['cloudant_user'], config['cloudant_auth']),
+            params = params
+        )
+        if response.status_code != 200:
+            logging.fatal("Unable to read {0}: HTTP {1}".format(dbname, response.status_code))
+            sys.exit("Unable to read {0}: HTTP {1}".format(dbname, response.status_code))
+        rows = response.json()['rows']
+        for row in rows[:page_size]:
+            yield row
+        if len(rows) <= page_size:
+            return
+        params['startkey'] = json.dumps(rows[page_size]['id'])
+
+# Write <docs> to <dbname> with one _bulk_docs request. Returns the number of documents that were rejected,
+# typically because someone else updated them first
+def bulk_write(dbname, docs):
+    r = requests.post(
+        'https://{0}.cloudant.com/{1}/_bulk_docs'.format(config['cloudant_account'], dbname),
+        auth = (config['cloudant_user'], config['cloudant_auth']),
+        headers = {'Content-Type': 'application/json'},
+        data = json.dumps({'docs': docs})
+    )
+    if r.status_code not in (201,202):
+        logging.fatal("Unable to write to {0}: HTTP {1}".format(dbname, r.status_code))
+        sys.exit("Unable to write to {0}: HTTP {1}".format(dbname, r.status_code))
+    rejected = 0
+    for result in r.json():
+        if 'error' in result:
+            rejected = rejected + 1
+            logging.warning("Unable to write {0}: {1}".format(result['id'], result['error']))
+    return rejected
+
+# Fill in the sync state (orphaned and sourcemodified) of the target's file documents from the source's.
+# Runs once both hosts have a successful scan: the source's files, by IDprefix, and the target's, by
+# syncIDprefix, are streamed in key order a page at a time and merge-joined. Only the documents whose
+# sync state changed are read and written back
+def reconcile(client):
+    source_scan = previous_scan_doc(config['rsync_source'])
+    target_scan = previous_scan_doc(config['rsync_target'])
+    if (source_scan == None) or (target_scan == None):
+        ver(" Both hosts need a successful scan before their sync state can be reconciled.")
+        return
+    check_views(source_scan['database'], client, scandb_views, legacy_scandb_ddocs, scandb_json_indexes)
+    if target_scan['database'] != source_scan['database']:
+        check_views(target_scan['database'], client, scandb_views, legacy_scandb_ddocs, scandb_json_indexes)
+    ver(" Reconciling {0} with {1}".format(target_scan['_id'], source_scan['_id']))
+    
+    source_rows = iter_view(
+        source_scan['database'],
+        scandb_views['source_prefixes'],
+        [config['rsync_source'], None],
+        [config['rsync_source'], {}]
+    )
+    target_rows = iter_view(
+        target_scan['database'],
+        scandb_views['sync_targets'],
+        [config['rsync_target'], None],
+        [config['rsync_target'], {}]
+    )
+    # Pending writes by scan database: _id -> sync state, or None for a superseded version
+    changes = {source_scan['database']: dict(), target_scan['database']: dict()}
+    counts = dict(no = 0, yes = 0)
+    totals = dict(written = 0, conflicts = 0)
+    
+    def flush(dbname, limit):
+        if len(changes[dbname]) > limit:
+            rejected = write_sync_states(dbname, changes[dbname])
+            totals['written'] = totals['written'] + len(changes[dbname]) - rejected
+            totals['conflicts'] = totals['conflicts'] + rejected
+            changes[dbname].clear()
+    
+    source_files = latest_versions(source_rows, changes[source_scan['database']])
+    source = next(source_files, None)
+    # Consecutive target rows may share a prefix, one document per version of a file
+    for prefix, versions in itertools.groupby(target_rows, lambda row: row['key'][1]):
+        versions = list(versions)
+        # Skip the source files the target doesn't have
+        while (source != None) and (source[0] < prefix):
+            source = next(source_files, None)
+        if (source != None) and (source[0] == prefix):
+            state = ['no', source[1]]
+            source = next(source_files, None)
+        else:
+            state = ['yes', None]
+        counts[state[0]] = counts[state[0]] + 1
+        # Only the target's latest version is tagged. Earlier ones left "ok" by scans made before they
+        # retired replaced versions (see FileScan.retire_replaced_versions) are marked deleted
+        latest = max(versions, key = lambda row: row['value'][2])
+        for target in versions:
+            if target is not latest:
+                changes[target_scan['database']][target['id']] = None
+            elif target['value'][:2] != state:
+                changes[target_scan['database']][target['id']] = state
+        for dbname in changes:
+            flush(dbname, config['doc_threshold'] - 1)
+    # The rest of the source's files, for their superseded versions
+    for source in source_files:
+        flush(source_scan['database'], config['doc_threshold'] - 1)
+    for dbname in changes:
+        flush(dbname, 0)
+    ver(" {0} target files synced, {1} orphaned. {2} documents updated, {3} conflicts left for the next run.".format(counts['no'], counts['yes'], totals['written'], totals['conflicts']))
+
+# Iterate over (IDprefix, latest datemodified) of each file in <rows> of source_prefixes, adding the _ids
+# of its earlier versions to <superseded> as None, the change write_sync_states marks deleted. Scans made
+# before replaced versions were retired (see FileScan.retire_replaced_versions) left them "ok"
+def latest_versions(rows, superseded):
+    for prefix, versions in itertools.groupby(rows, lambda row: row['key'][1]):
+        versions = list(versions)
+        latest = max(versions, key = lambda row: row['value'])
+        for row in versions:
+            if row is not latest:
+                superseded[row['id']] = None
+        yield (prefix, latest['value'])
+
+# Set the sync states <changes> (_id -> [orphaned, sourcemodified], or None to mark a superseded version
+# deleted) on their documents in <dbname>. Returns the number of documents that couldn't be written
+def write_sync_states(dbname, changes):
+    docs = []
+    now = int(time.time())
+    for row in iter_all_docs_by_keys(dbname, changes.keys()):
+        if row.get('doc') != None:
+            state = changes[row['id']]
+            if state == None:
+                row['doc'][file_field(row['doc'], 'status')] = {'state': 'deleted', 'detail': now}
+                docs.append(row['doc'])
+            elif set_sync_tags(row['doc'], state[0], state[1]):
+                docs.append(row['doc'])
+    if len(docs) == 0:
+        return 0
+    return bulk_write(dbname, docs)
+
+# Rows of _all_docs, with documents, for an exact list of document IDs
+def iter_all_docs_by_keys(dbname, keys):
+    keys = list(keys)
+    for start in range(0, len(keys), config['post_threshold']):
+        response = requests.post(
+            "https://{0}.cloudant.com/{1}/_all_docs".format(config['cloudant_account'], dbname),
+            auth = (config['cloudant_user'], config['cloudant_auth']),
+            params = {'include_docs': 'true'},
+            headers = {'Content-Type': 'application/json'},
+            data = json.dumps({'keys': keys[start:start + config['post_threshold']]})
+        )
+        if response.status_code != 200:
+            logging.fatal("Unable to read {0}: HTTP {1}".format(dbname, response.status_code))
+            sys.exit("Unable to read {0}: HTTP {1}".format(dbname, response.status_code))
+        for row in response.json()['rows']:
+            yield row
+
+# Rewrite the version 1 file documents in this host's most recent scan database as version 2 documents,
+# a page of _all_docs at a time. Views and readers handle both versions, so scans and sync checks can carry
+# on meanwhile. Documents updated by someone else during the rewrite conflict and are left for another run
+def migrate_file_schema(client):
+    scan_db_name = latest_scan_db(client[config['main_db_name']], config['host_id'])
+    if scan_db_name == None:
+        sys.exit(" No scans found for this host.")
+    db = client[scan_db_name]
+    check_views(scan_db_name, client, scandb_views, legacy_scandb_ddocs, scandb_json_indexes)
+    if file_schemas(db) == [2]:
+        ver(" {0} only holds version 2 file documents.".format(scan_db_name))
+        return
+    converted = 0
+    conflicts = 0
+    batch = []
+    for row in iter_all_docs(scan_db_name, include_docs = True):
+        if (row['doc'].get('type') == 'file'):
+            batch.append(compact_file_doc(row['doc']))
+        if len(batch) >= config['doc_threshold']:
+            rejected = bulk_write(scan_db_name, batch)
+            converted = converted + len(batch) - rejected
+            conflicts = conflicts + rejected
+            batch = []
+            ver(" {0} file documents migrated so far".format(converted))
+    if len(batch) > 0:
+        rejected = bulk_write(scan_db_name, batch)
+        converted = converted + len(batch) - rejected
+        conflicts = conflicts + rejected
+    
+    if conflicts == 0:
+        with Document(db, document_id="scanversion") as versiondoc:
+            versiondoc['fileschemas'] = [2]
+    else:
+        print " {0} documents changed during the migration. Run it again to finish.".format(conflicts)
+    logging.info("Migrated {0} file documents in {1} to schema version 2".format(converted, scan_db_name))
+    ver(" Migrated {0} file documents in {1}".format(converted, scan_db_name))
+
+# Move the relationship to locality document IDs. The file and directory documents of both hosts in their
+# most recent scan databases are copied to their new IDs and the old copies deleted, a page of _all_docs at
+# a time, then the relationship document is switched over so both hosts' scans use the new scheme.
+# Run it between scans. Running it again moves anything written meanwhile, and skips documents already moved
+def migrate_document_ids(client):
+    maindb = client[config['main_db_name']]
+    other_host = {config['rsync_source']: config['rsync_target'], config['rsync_target']: config['rsync_source']}
+    scan_db_names = set([latest_scan_db(maindb, host) for host in other_host.keys()]) - set([None])
+    moved = 0
+    conflicts = 0
+    for scan_db_name in scan_db_names:
+        check_views(scan_db_name, client, scandb_views, legacy_scandb_ddocs, scandb_json_indexes)
+        batch = []
+        for row in iter_all_docs(scan_db_name, include_docs = True):
+            doc = row['doc']
+            newdoc = locality_id_doc(doc, other_host)
+            if newdoc == None:
+                continue
+            batch.append(newdoc)
+            batch.append({'_id': doc['_id'], '_rev': doc['_rev'], '_deleted': True})
+            if len(batch) >= config['doc_threshold']:
+                rejected = bulk_write(scan_db_name, batch)
+                moved = moved + (len(batch) - rejected) / 2
+                conflicts = conflicts + rejected
+                batch = []
+                ver(" {0} documents moved so far".format(moved))
+        if len(batch) > 0:
+            rejected = bulk_write(scan_db_name, batch)
+            moved = moved + (len(batch) - rejected) / 2
+            conflicts = conflicts + rejected
+    
+    # Scans keep looking up documents under the old IDs until every one of them has moved
+    if conflicts > 0:
+        print " {0} documents changed during the migration. Run it again to finish.".format(conflicts)
+    else:
+        with Document(maindb, config['relationship']) as relationshipdoc:
+            relationshipdoc['idscheme'] = 'locality'
+    logging.info("Moved {0} documents to locality IDs in {1}".format(moved, ', '.join(scan_db_names)))
+    ver(" Moved {0} documents to locality IDs".format(moved))
+
+# Copy of file or directory document <doc> under its locality ID, without a revision. Returns None for documents
+# already under their locality ID, of hosts outside <other_host> (host ID -> other host's ID), or other types
+def locality_id_doc(doc, other_host):
+    if doc['_id'].startswith('_design/') or (doc['_id'] == 'scanversion'):
+        return None
+    expanded = expand_file_doc(doc)
+    host = expanded.get('host')
+    if (host not in other_host) or (expanded.get('syncpath') == None):
+        return None
+    syncpath = expanded['syncpath'].encode('utf-8')
+    if expanded.get('type') == 'directory':
+        newid = 'dir-' + document_id(host, syncpath, 'locality')
+    elif expanded.get('type') == 'file':
+        # IDs of paths that couldn't be encoded aren't derived from the path, so they stay as they are
+        if '-ERROR' in doc['_id']:
+            return None
+        newid = document_id(host, syncpath, 'locality') + doc['_id'][id_prefix_length:]
+    else:
+        return None
+    if newid == doc['_id']:
+        return None
+    newdoc = dict(doc)
+    newdoc['_id'] = newid
+    del newdoc['_rev']
+    if expanded['type'] == 'file':
+        newdoc[file_field(doc, 'syncIDprefix')] = document_id(other_host[host], syncpath, 'locality')
+        if 'IDprefix' in doc:
+            newdoc['IDprefix'] = newid[:id_prefix_length]
+    return newdoc
+
+# Check database views in database with <dbname> using client <c>, and the set of <views>.
+# <legacy_ddocs> lists the design documents that <views> replace, if any, and <json_indexes> any
+# Cloudant Query indexes to create along with the views
+def check_views(dbname, c, views, legacy_ddocs = None, json_indexes = None):
     def updater():
         # Open each ddoc / view combo for existing
         for thisview in views.values():
@@ -1236,6 +2655,8 @@ def check_views(dbname, c, views):
                 else:
                     ver(" Skipping {0}/{1}".format(thisview[0],thisview[1]))
                     continue
+        if json_indexes != None:
+            create_json_indexes(dbname, json_indexes)
 
     db = c[dbname]
     versiondoc = Document(db,document_id="scanversion")
@@ -1251,21 +2672,241 @@ def check_views(dbname, c, views):
     if versiondoc['current'] < config['viewversion']:
         ver(" Database is older version. Upgrading views.")
         updater()
+        # Moving to the consolidated design documents: readers keep using the old ones (chosen by the
+        # version below) until the new indexes are fully built, and only then are the old ones removed
+        migrating = (legacy_ddocs != None) and (versiondoc['current'] < config['consolidated_viewversion'])
+        if migrating:
+            build_indexes(dbname, views)
         versiondoc.update_field(action=versiondoc.list_field_append, field='history', value = versiondoc['current'])
         versiondoc.update_field(action=versiondoc.field_set, field='current', value = config['viewversion'])
         versiondoc.save()
+        if migrating:
+            remove_design_docs(db, legacy_ddocs.values())
     else:
         ver(" Database is up-to-date!")
 
+# Query every design document of <views> in <dbname> without allowing stale results, which returns once
+# its index has caught up with the database. Long builds time out on Cloudant's side, so keep asking
+def build_indexes(dbname, views):
+    built = []
+    for thisview in views.values():
+        if thisview[0] in built:
+            continue
+        built.append(thisview[0])
+        ver(" Building index {0}".format(thisview[0]))
+        params = {'limit': 0}
+        if thisview[3] != None:
+            params['reduce'] = 'false'
+        # Timeouts and server errors mean the index is still building; anything else will not go away by waiting
+        deadline = time.time() + config['index_build_timeout']
+        while True:
+            try:
+                r = requests.get(
+                    'https://{0}.cloudant.com/{1}/{2}/_view/{3}'.format(config['cloudant_account'], dbname, thisview[0], thisview[1]),
+                    auth = (config['cloudant_user'], config['cloudant_auth']),
+                    params = params
+                )
+                if r.status_code == 200:
+                    break
+                if r.status_code < 500:
+                    logging.fatal("Unable to build index {0} in {1}: HTTP {2} {3}".format(thisview[0], dbname, r.status_code, r.text))
+                    sys.exit("Unable to build index {0} in {1}: HTTP {2}".format(thisview[0], dbname, r.status_code))
+                problem = "HTTP {0}".format(r.status_code)
+            except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+                problem = str(e)
+            if time.time() > deadline:
+                logging.fatal("Index {0} in {1} still not built after {2} seconds: {3}".format(thisview[0], dbname, config['index_build_timeout'], problem))
+                sys.exit("Index {0} in {1} still not built after {2} seconds".format(thisview[0], dbname, config['index_build_timeout']))
+            logging.info("Index {0} not ready yet: {1}".format(thisview[0], problem))
+            time.sleep(10)
+
+# Create the Cloudant Query indexes in <indexes> in <dbname>. Cloudant leaves identical existing indexes alone
+def create_json_indexes(dbname, indexes):
+    for thisindex in indexes.values():
+        r = requests.post(
+            'https://{0}.cloudant.com/{1}/_index'.format(config['cloudant_account'], dbname),
+            auth = (config['cloudant_user'], config['cloudant_auth']),
+            headers = {'Content-Type': 'application/json'},
+            data = json.dumps({
+                'index': {'fields': thisindex[2]},
+                'ddoc': thisindex[0][len('_design/'):],
+                'name': thisindex[1],
+                'type': 'json'
+            })
+        )
+        if r.status_code in (200,201):
+            ver(" Index {0}/{1}: {2}".format(thisindex[0], thisindex[1], r.json()['result']))
+        else:
+            logging.error("Unable to create index {0}/{1}: HTTP {2} {3}".format(thisindex[0], thisindex[1], r.status_code, r.text))
+
+# JSON index best suited to <selector>: of the indexes whose fields are all constrained by it (the only
+# ones Cloudant Query can use), the one with the most fields, ties going to the first by name.
+# Selector fields must use dotted names ('status.state'). Returns None if no index applies
+def choose_json_index(selector, indexes = None):
+    if indexes == None:
+        indexes = scandb_json_indexes
+    best = None
+    for name in sorted(indexes):
+        thisindex = indexes[name]
+        if len([field for field in thisindex[2] if field not in selector]) > 0:
+            continue
+        if (best == None) or (len(thisindex[2]) > len(best[2])):
+            best = thisindex
+    return best
+
+# Iterate over the documents in <dbname> matching a Cloudant Query <selector>, returning only <fields>
+# (all fields if None). The index is picked by choose_json_index, and pages are followed by bookmark
+def find_docs(dbname, selector, fields = None, page_size = None):
+    if page_size == None:
+        page_size = config['doc_threshold']
+    query = dict(selector = selector, limit = page_size)
+    if fields != None:
+        query['fields'] = fields
+    thisindex = choose_json_index(selector)
+    if thisindex != None:
+        query['use_index'] = [thisindex[0], thisindex[1]]
+    while True:
+        r = requests.post(
+            'https://{0}.cloudant.com/{1}/_find'.format(config['cloudant_account'], dbname),
+            auth = (config['cloudant_user'], config['cloudant_auth']),
+            headers = {'Content-Type': 'application/json'},
+            data = json.dumps(query)
+        )
+        if r.status_code != 200:
+            logging.fatal("Unable to query {0}: HTTP {1} {2}".format(dbname, r.status_code, r.text))
+            sys.exit("Unable to query {0}: HTTP {1}".format(dbname, r.status_code))
+        result = r.json()
+        for doc in result['docs']:
+            yield doc
+        if len(result['docs']) < page_size:
+            return
+        query['bookmark'] = result['bookmark']
+
+# Iterate over the file documents in <dbname> matching <selector>, given with version 1 field names, in each
+# file document schema version of <schemas>. Documents come back with version 1 field names
+def find_files(dbname, selector, fields = None, schemas = (1, 2)):
+    for schema in schemas:
+        thisselector = dict([(query_field(field, schema), value) for field, value in selector.items()])
+        thisfields = None
+        if fields != None:
+            thisfields = [query_field(field, schema) for field in fields] + ['v']
+        for doc in find_docs(dbname, thisselector, thisfields):
+            yield expand_file_doc(doc)
+
+# Build each query pattern of scandb_json_indexes both as a JavaScript view and as a JSON index in freshly
+# named design documents of this host's scan database, time how long each takes to build and to answer
+# sample queries, then remove them again
+def benchmark_indexes(client, samples = 20):
+    scan_db_name = latest_scan_db(client[config['main_db_name']], config['host_id'])
+    if scan_db_name == None:
+        sys.exit(" No scans found for this host.")
+    db = client[scan_db_name]
+    base_url = 'https://{0}.cloudant.com/{1}'.format(config['cloudant_account'], scan_db_name)
+    auth = (config['cloudant_user'], config['cloudant_auth'])
+    json_header = {'Content-Type': 'application/json'}
+    
+    # Sample file documents to take query values from. The JSON indexes are benchmarked on the
+    # newest file document schema in the database
+    schema = max(file_schemas(db))
+    sample_docs = []
+    for d in find_files(scan_db_name, {'host': config['host_id']}, None, [schema]):
+        sample_docs.append(d)
+        if len(sample_docs) >= samples:
+            break
+    if len(sample_docs) == 0:
+        sys.exit(" No file documents for this host in {0}".format(scan_db_name))
+    
+    # <pattern> = [<map function>, <view query parameters for a doc>, <selector for a doc>]
+    patterns = dict(
+        status_by_host = [
+            file_map('if (f.type === "file") { emit([f.host, f.status.state], null); }'),
+            lambda d: {'key': json.dumps([d['host'], d['status']['state']]), 'limit': 100},
+            lambda d: {'host': d['host'], 'status.state': d['status']['state']}
+        ],
+        sync_prefixes = [
+            file_map('if (f.type === "file") { emit([f.IDprefix, f.syncIDprefix], null); }'),
+            lambda d: {'key': json.dumps([d['IDprefix'], d['syncIDprefix']]), 'limit': 100},
+            lambda d: {'IDprefix': d['IDprefix'], 'syncIDprefix': d['syncIDprefix']}
+        ],
+        files_by_path = [
+            file_map('if (f.type === "file") { emit([f.host, f.path, f.name], null); }'),
+            lambda d: {'startkey': json.dumps([d['host'], d['path']]), 'endkey': json.dumps([d['host'], d['path'], {}]), 'limit': 100},
+            lambda d: {'host': d['host'], 'path': d['path']}
+        ]
+    )
+    
+    suffix = str(int(time.time()))
+    print "| {0:15} | {1:>10} | {2:>10} | {3:>11} | {4:>11} |".format("Query pattern", "View build", "JSON build", "View query", "JSON query")
+    for name, pattern in patterns.items():
+        thisindex = scandb_json_indexes[name]
+        json_fields = [query_field(field, schema) for field in thisindex[2]]
+        json_selector = lambda d: dict([(query_field(field, schema), value) for field, value in pattern[2](d).items()])
+        view_ddoc = '_design/bench-view-{0}-{1}'.format(name, suffix)
+        json_ddoc = 'bench-json-{0}-{1}'.format(name, suffix)
+        view_url = base_url + '/' + view_ddoc + '/_view/bench'
+        try:
+            # JavaScript view: build time is the time until the first query returns
+            ddoc = DesignDocument(db, document_id=view_ddoc)
+            ddoc.add_view('bench', pattern[0])
+            ddoc.save()
+            started = time.time()
+            requests.get(view_url, auth = auth, params = {'limit': 0}).raise_for_status()
+            view_build = time.time() - started
+            view_times = []
+            for d in sample_docs:
+                started = time.time()
+                requests.get(view_url, auth = auth, params = pattern[1](d)).raise_for_status()
+                view_times.append(time.time() - started)
+            
+            # JSON index over the same fields
+            requests.post(base_url + '/_index', auth = auth, headers = json_header, data = json.dumps(
+                {'index': {'fields': json_fields}, 'ddoc': json_ddoc, 'name': 'bench', 'type': 'json'})).raise_for_status()
+            started = time.time()
+            requests.post(base_url + '/_find', auth = auth, headers = json_header, data = json.dumps(
+                {'selector': json_selector(sample_docs[0]), 'use_index': [json_ddoc, 'bench'], 'limit': 1})).raise_for_status()
+            json_build = time.time() - started
+            json_times = []
+            for d in sample_docs:
+                started = time.time()
+                requests.post(base_url + '/_find', auth = auth, headers = json_header, data = json.dumps(
+                    {'selector': json_selector(d), 'use_index': [json_ddoc, 'bench'], 'limit': 100})).raise_for_status()
+                json_times.append(time.time() - started)
+        finally:
+            remove_design_docs(db, [view_ddoc, '_design/' + json_ddoc])
+        print "| {0:15} | {1:>9.1f}s | {2:>9.1f}s | {3:>9.1f}ms | {4:>9.1f}ms |".format(
+            name, view_build, json_build, median(view_times) * 1000, median(json_times) * 1000)
+
+def median(values):
+    ordered = sorted(values)
+    middle = len(ordered) / 2
+    if len(ordered) % 2 == 1:
+        return ordered[middle]
+    return (ordered[middle - 1] + ordered[middle]) / 2.0
+
+# Delete the design documents named in <ddocs> from <db>, where they exist
+def remove_design_docs(db, ddocs):
+    for ddocname in set(ddocs):
+        ddoc = DesignDocument(db, ddocname)
+        if ddoc.exists():
+            ddoc.fetch()
+            ddoc.delete()
+            logging.info("Removed {0}".format(ddocname))
+            ver(" Removed {0}".format(ddocname))
+
+# Save search design document <searchddoc> to <dbname> unless it's already there as defined. Saving it
+# again would make Cloudant rebuild the index
 def insert_search_indexes(dbname, client, searchddoc):
     db = client[dbname]
-    with Document(db, searchddoc[0]) as doc:
-            doc['views'] = {}
-            doc['language'] = 'javascript'
-            doc['indexes'] = dict()
-            doc['indexes']['newSearch'] = dict()
-            doc['indexes']['newSearch']['analyzer'] = "standard"
-            doc['indexes']['newSearch']['index'] = searchddoc[1]
+    index = dict(analyzer = searchddoc[2], index = searchddoc[1])
+    doc = Document(db, searchddoc[0])
+    if doc.exists():
+        doc.fetch()
+        if doc.get('indexes', {}).get('newSearch') == index:
+            return
+    doc['views'] = {}
+    doc['language'] = 'javascript'
+    doc['indexes'] = dict(newSearch = index)
+    doc.save()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+# File document schemas for rsync-checkpoint scan databases
+#
+# Version 1 documents carry long field names plus values that are the same for every file of a scan
+# ("type": "file", relationship, source, scanID, IDprefix). Version 2 documents are marked with "v": 2,
+# use the short field names below and leave the per-scan values to the scan document. Their IDprefix
+# is the first 40 characters of the _id. Both versions can live in the same scan database.
+
+# Version 1 field name -> version 2 field name
+file_doc_v2_keys = dict(
+    name = 'n',
+    path = 'p',
+    syncpath = 'sp',
+    size = 's',
+    datemodified = 'm',
+    datescanned = 'ds',
+    checksum = 'c',
+    fingerprint = 'fp',
+    status = 'st',
+    goodscan = 'g',
+    owner = 'o',
+    group = 'gr',
+    permissionsUNIX = 'pm',
+    host = 'h',
+    syncIDprefix = 'x',
+    sourcemodified = 'sm',
+    orphaned = 'or',
+    error = 'e'
+)
+
+# Fields of version 1 documents that version 2 documents leave out
+file_doc_v1_only = ['type', 'relationship', 'source', 'scanID', 'IDprefix']
+
+import hashlib
+
+# Length of the hash part of a file document _id
+id_prefix_length = 40
+
+# Document ID schemes, chosen per relationship since each host computes the other's IDs:
+#   hash - SHA-1 of the host ID and the path relative to the sync directory
+#   locality - hash prefixes of the host ID, the relative directory and the file name, so the documents
+#              of one directory share a prefix and can be read with a single _all_docs range
+# IDs of both schemes are id_prefix_length characters long, before the modification time suffix
+id_schemes = ['hash', 'locality']
+
+# Lengths of the host and directory parts of a locality ID. The file name hash fills the rest
+locality_host_length = 8
+locality_dir_length = 12
+
+# Map functions read file documents through <f>, which presents version 2 documents with their
+# version 1 field names so each view indexes both versions the same way
+file_doc_js = 'var f = (doc.v === 2) ? {type: "file", IDprefix: doc._id.substr(0, ' + str(id_prefix_length) + '), ' + \
+    ', '.join(['{0}: doc.{1}'.format(field, file_doc_v2_keys[field]) for field in sorted(file_doc_v2_keys)]) + \
+    '} : doc;'
+
+# Map function over file documents, with <body> referring to the document as <f>
+def file_map(body):
+    return 'function (doc) { ' + file_doc_js + ' ' + body + ' }'
+
+# Version 2 document for a version 1 document (or a file dictionary built by the scanner)
+def compact_file_doc(doc):
+    if doc.get('v') == 2:
+        return doc
+    compact = dict(v = 2)
+    for field, value in doc.items():
+        if field in file_doc_v2_keys:
+            compact[file_doc_v2_keys[field]] = value
+        elif field not in file_doc_v1_only:
+            compact[field] = value
+    return compact
+
+# Document with version 1 field names, whichever version <doc> is
+def expand_file_doc(doc):
+    if doc.get('v') != 2:
+        return doc
+    expanded = dict(type = 'file')
+    long_names = dict([(short, field) for field, short in file_doc_v2_keys.items()])
+    for field, value in doc.items():
+        if field == 'v':
+            continue
+        expanded[long_names.get(field, field)] = value
+    if '_id' in doc:
+        expanded['IDprefix'] = doc['_id'][:id_prefix_length]
+    return expanded
+
+# Name under which <doc> stores the version 1 field <field>
+def file_field(doc, field):
+    if (doc.get('v') == 2) and (field in file_doc_v2_keys):
+        return file_doc_v2_keys[field]
+    return field
+
+# Cloudant Query field path for the version 1 field path <field> ('status.state') in version <schema> documents
+def query_field(field, schema):
+    if schema != 2:
+        return field
+    parts = field.split('.')
+    parts[0] = file_doc_v2_keys.get(parts[0], parts[0])
+    return '.'.join(parts)
+
+# Hash part of the _id of the document for <relative_path> (UTF-8, relative to the sync directory) on <host_id>
+def document_id(host_id, relative_path, scheme = 'hash'):
+    if scheme == 'locality':
+        directory, slash, name = relative_path.rpartition('/')
+        name_length = id_prefix_length - locality_host_length - locality_dir_length
+        return directory_id_prefix(host_id, directory) + hashlib.sha1(utf8(name)).hexdigest()[:name_length]
+    return hashlib.sha1(host_id + relative_path).hexdigest()
+
+# Prefix shared by the locality IDs of all files directly in <directory> (relative to the sync directory) on <host_id>
+def directory_id_prefix(host_id, directory):
+    return hashlib.sha1(utf8(host_id)).hexdigest()[:locality_host_length] + hashlib.sha1(utf8(directory)).hexdigest()[:locality_dir_length]
+
+def utf8(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+
+# Compact binary scan manifests for rsync-checkpoint
+#
+# A manifest holds one entry per file, sorted by syncpath (byte order of the UTF-8 encoded path):
+#   <MAGIC> followed by frames of <4-byte big-endian length><zlib-compressed block>
+# Each block holds up to frame_entries records, each made of varints:
+#   shared prefix length with the previous path in the block, suffix length, suffix bytes,
+#   size, zigzag-encoded date modified, flags, checksum length, raw checksum bytes
+# Prefix compression restarts with every frame, so each frame can be decoded on its own.
+
+import struct, zlib, heapq, tempfile, binascii
+
+MAGIC = 'RSCKMAN1'
+
+# Number of entries per compressed frame
+frame_entries = 4096
+
+# Number of entries sorted in memory at a time when a manifest is built from unsorted input
+sort_run_entries = 500000
+
+# Largest size in bytes of the standalone manifests split_manifest cuts a manifest into, unless a single frame is bigger
+chunk_bytes = 4194304
+
+# Entry flags
+FLAG_ERROR = 1
+
+# Entries are tuples of (syncpath as UTF-8 bytes, size, datemodified, checksum as hex string or '', flags)
+
+def encode_varint(value):
+    out = []
+    while value > 0x7f:
+        out.append(chr((value & 0x7f) | 0x80))
+        value = value >> 7
+    out.append(chr(value))
+    return ''.join(out)
+
+# Decode a varint from <data> at <pos>. Returns the value and the position following it
+def decode_varint(data, pos):
+    result = 0
+    shift = 0
+    while True:
+        b = ord(data[pos])
+        pos = pos + 1
+        result = result | ((b & 0x7f) << shift)
+        if b < 0x80:
+            return result, pos
+        shift = shift + 7
+
+def zigzag(value):
+    if value < 0:
+        return (-value << 1) - 1
+    return value << 1
+
+def unzigzag(value):
+    if value & 1:
+        return -((value + 1) >> 1)
+    return value >> 1
+
+def utf8_path(path):
+    if isinstance(path, unicode):
+        return path.encode('utf-8')
+    return path
+
+class ManifestWriter(object):
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.block = []
+        self.block_previous = ''
+        self.previous = None
+        self.count = 0
+        self.fileobj.write(MAGIC)
+
+    # Append an entry. Entries must arrive in syncpath order
+    def add(self, entry):
+        path = utf8_path(entry[0])
+        if (self.previous != None) and (path < self.previous):
+            raise ValueError("Manifest entries out of order: {0} after {1}".format(path, self.previous))
+        shared = 0
+        limit = min(len(path), len(self.block_previous))
+        while (shared < limit) and (path[shared] == self.block_previous[shared]):
+            shared = shared + 1
+        if entry[3]:
+            checksum = binascii.unhexlify(entry[3])
+        else:
+            checksum = ''
+        self.block.append(''.join([
+            encode_varint(shared),
+            encode_varint(len(path) - shared),
+            path[shared:],
+            encode_varint(entry[1]),
+            encode_varint(zigzag(entry[2])),
+            encode_varint(entry[4]),
+            encode_varint(len(checksum)),
+            checksum
+        ]))
+        self.block_previous = path
+        self.previous = path
+        self.count = self.count + 1
+        if len(self.block) >= frame_entries:
+            self.flush()
+
+    def flush(self):
+        if len(self.block) == 0:
+            return
+        frame = zlib.compress(''.join(self.block))
+        self.fileobj.write(struct.pack('>I', len(frame)))
+        self.fileobj.write(frame)
+        self.block = []
+        self.block_previous = ''
+
+    def close(self):
+        self.flush()
+
+# Iterate over the compressed frames of a manifest read from <fileobj>
+def read_frames(fileobj):
+    if fileobj.read(len(MAGIC)) != MAGIC:
+        raise ValueError("Not an rsync-checkpoint manifest")
+    while True:
+        header = fileobj.read(4)
+        if len(header) == 0:
+            return
+        if len(header) < 4:
+            raise ValueError("Truncated manifest frame header")
+        length = struct.unpack('>I', header)[0]
+        frame = fileobj.read(length)
+        if len(frame) < length:
+            raise ValueError("Truncated manifest frame")
+        yield frame
+
+# Iterate over the decompressed blocks of a manifest read from <fileobj>
+def read_blocks(fileobj):
+    for frame in read_frames(fileobj):
+        yield zlib.decompress(frame)
+
+# Iterate over the entries of a manifest read from <fileobj>, one frame in memory at a time
+def read_manifest(fileobj):
+    for block in read_blocks(fileobj):
+        for entry in block_entries(block):
+            yield entry
+
+# Iterate over the entries of one decompressed block
+def block_entries(block):
+    pos = 0
+    previous = ''
+    end = len(block)
+    while pos < end:
+        shared, pos = decode_varint(block, pos)
+        suffix, pos = decode_varint(block, pos)
+        path = previous[:shared] + block[pos:pos + suffix]
+        pos = pos + suffix
+        size, pos = decode_varint(block, pos)
+        datemodified, pos = decode_varint(block, pos)
+        flags, pos = decode_varint(block, pos)
+        checksum_length, pos = decode_varint(block, pos)
+        checksum = binascii.hexlify(block[pos:pos + checksum_length])
+        pos = pos + checksum_length
+        previous = path
+        yield (path, size, unzigzag(datemodified), checksum, flags)
+
+# Cut a manifest read from <fileobj> into standalone manifests of whole frames, each at most <max_bytes>
+# long unless a single frame is bigger. Their entries remain in order from one to the next.
+# Yields (manifest bytes, first path, last path, number of entries) for each
+def split_manifest(fileobj, max_bytes = None):
+    if max_bytes == None:
+        max_bytes = chunk_bytes
+    frames = []
+    size = len(MAGIC)
+    first = None
+    last = None
+    count = 0
+    for frame in read_frames(fileobj):
+        if (len(frames) > 0) and (size + 4 + len(frame) > max_bytes):
+            yield (join_frames(frames), first, last, count)
+            frames = []
+            size = len(MAGIC)
+            first = None
+            count = 0
+        entries = list(block_entries(zlib.decompress(frame)))
+        if first == None:
+            first = entries[0][0]
+        last = entries[-1][0]
+        count = count + len(entries)
+        frames.append(frame)
+        size = size + 4 + len(frame)
+    if len(frames) > 0:
+        yield (join_frames(frames), first, last, count)
+
+def join_frames(frames):
+    return MAGIC + ''.join([struct.pack('>I', len(frame)) + frame for frame in frames])
+
+# Write <entries> in any order to <fileobj> as a sorted manifest, keeping the most recently modified
+# entry for any repeated syncpath. Runs of sort_run_entries are sorted in memory and spilled to
+# temporary manifests, which are then merged. Returns the number of entries written
+def write_sorted_manifest(entries, fileobj):
+    runs = []
+    run = []
+    try:
+        for entry in entries:
+            run.append((utf8_path(entry[0]),) + tuple(entry[1:]))
+            if len(run) >= sort_run_entries:
+                runs.append(spill_run(run))
+                run = []
+        run.sort()
+        writer = ManifestWriter(fileobj)
+        if len(runs) == 0:
+            merged = iter(run)
+        else:
+            merged = heapq.merge(iter(run), *[read_manifest(r) for r in runs])
+        for entry in latest_entries(merged):
+            writer.add(entry)
+        writer.close()
+        return writer.count
+    finally:
+        for r in runs:
+            r.close()
+
+def spill_run(run):
+    run.sort()
+    spill = tempfile.TemporaryFile()
+    writer = ManifestWriter(spill)
+    for entry in run:
+        writer.add(entry)
+    writer.close()
+    spill.seek(0)
+    return spill
+
+# Keep only the most recently modified entry for each syncpath of a sorted entry stream
+def latest_entries(entries):
+    current = None
+    for entry in entries:
+        if (current != None) and (entry[0] != current[0]):
+            yield current
+            current = None
+        if (current == None) or (entry[2] >= current[2]):
+            current = entry
+    if current != None:
+        yield current
+
+# Merge-join two sorted entry streams, yielding (state, source entry, target entry) for each difference:
+#   missing - on the source only
+#   orphaned - on the target only
+#   stale - target copy is older than the source's
+#   mismatch - checksums (when both sides have one) or sizes differ without the target being older
+def diff_manifests(source_entries, target_entries):
+    source_entries = iter(source_entries)
+    target_entries = iter(target_entries)
+    source = next(source_entries, None)
+    target = next(target_entries, None)
+    while (source != None) or (target != None):
+        if (target == None) or ((source != None) and (source[0] < target[0])):
+            yield ('missing', source, None)
+            source = next(source_entries, None)
+        elif (source == None) or (target[0] < source[0]):
+            yield ('orphaned', None, target)
+            target = next(target_entries, None)
+        else:
+            if target[2] < source[2]:
+                yield ('stale', source, target)
+            elif source[3] and target[3] and (source[3] != target[3]):
+                yield ('mismatch', source, target)
+            elif source[1] != target[1]:
+                yield ('mismatch', source, target)
+            source = next(source_entries, None)
+            target = next(target_entries, None)
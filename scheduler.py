@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+
+# I/O scheduling for rsync-checkpoint scans
+#
+# A scan should finish as fast as the host allows when it's idle and stay out of the way when it's busy:
+#   ScanLock - one scan per relationship at a time, through an flock()ed lock file
+#   TokenBucket - ceiling on a rate (files stat'ed or bytes read per second)
+#   LoadGovernor - pause while the load average or I/O wait is above a threshold
+#   set_priority - nice and ionice the scanning process itself
+
+import os, time, fcntl, subprocess, multiprocessing
+
+class ScanLock(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.fileobj = None
+
+    # Take the lock without waiting. Returns False if another process holds it
+    def acquire(self):
+        self.fileobj = open(self.path, 'a+')
+        try:
+            fcntl.flock(self.fileobj.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            self.fileobj.close()
+            self.fileobj = None
+            return False
+        self.fileobj.seek(0)
+        self.fileobj.truncate()
+        self.fileobj.write("{0}\n".format(os.getpid()))
+        self.fileobj.flush()
+        return True
+
+    # The lock goes with the file descriptor, so it's also released if the process dies
+    def release(self):
+        if self.fileobj != None:
+            fcntl.flock(self.fileobj.fileno(), fcntl.LOCK_UN)
+            self.fileobj.close()
+            self.fileobj = None
+
+    # Process ID recorded by the holder of the lock, if any
+    def holder(self):
+        try:
+            with open(self.path) as f:
+                return int(f.read().strip() or 0) or None
+        except (IOError, ValueError):
+            return None
+
+class TokenBucket(object):
+
+    # <rate> units per second, with bursts of up to <burst> units (one second's worth by default).
+    # A rate of 0 or None is unlimited
+    def __init__(self, rate, burst = None):
+        self.rate = rate
+        self.capacity = burst or rate
+        self.tokens = self.capacity
+        self.last = time.time()
+
+    # Take <amount> units, sleeping until the rate allows it
+    def consume(self, amount = 1):
+        if not self.rate:
+            return
+        now = time.time()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        self.tokens = self.tokens - amount
+        if self.tokens < 0:
+            time.sleep(-self.tokens / float(self.rate))
+
+class LoadGovernor(object):
+
+    # Pause while the 1-minute load average per CPU is above <max_load>, or the share of CPU time spent
+    # waiting on I/O (percent, Linux only) is above <max_iowait>. Either may be 0 to ignore it.
+    # The system is sampled at most every <interval> seconds
+    def __init__(self, max_load = 0, max_iowait = 0, interval = 5):
+        self.max_load = max_load
+        self.max_iowait = max_iowait
+        self.interval = interval
+        self.last = 0
+        self.cpu_times = cpu_times()
+        self.paused = 0
+        try:
+            self.cpus = multiprocessing.cpu_count()
+        except NotImplementedError:
+            self.cpus = 1
+
+    def wait(self):
+        if (not self.max_load) and (not self.max_iowait):
+            return
+        if time.time() - self.last < self.interval:
+            return
+        while self.busy():
+            time.sleep(self.interval)
+            self.paused = self.paused + self.interval
+
+    def busy(self):
+        self.last = time.time()
+        if self.max_load and (os.getloadavg()[0] / self.cpus > self.max_load):
+            return True
+        if self.max_iowait:
+            previous = self.cpu_times
+            self.cpu_times = cpu_times()
+            if (previous != None) and (self.cpu_times != None):
+                total = sum(self.cpu_times) - sum(previous)
+                if (total > 0) and ((self.cpu_times[4] - previous[4]) * 100.0 / total > self.max_iowait):
+                    return True
+        return False
+
+# Cumulative CPU times from the first line of /proc/stat (user, nice, system, idle, iowait, ...), or
+# None where there isn't one
+def cpu_times():
+    try:
+        with open('/proc/stat') as f:
+            return [int(field) for field in f.readline().split()[1:]]
+    except (IOError, ValueError):
+        return None
+
+# ionice scheduling classes by name
+ionice_classes = dict(realtime = 1, besteffort = 2, idle = 3)
+
+# Lower this process' CPU priority by <nice> and set its I/O scheduling class (a name in ionice_classes).
+# Returns the problems encountered, if any, as a list of messages. Neither is available everywhere
+def set_priority(nice = 0, ionice_class = None):
+    problems = []
+    if nice:
+        try:
+            os.nice(nice)
+        except OSError as e:
+            problems.append("Unable to renice: {0}".format(e.strerror))
+    if ionice_class and (ionice_class not in ionice_classes):
+        problems.append("Unknown ionice class {0}, expected one of {1}".format(ionice_class, ', '.join(sorted(ionice_classes))))
+    elif ionice_class:
+        try:
+            subprocess.check_call(['ionice', '-c', str(ionice_classes[ionice_class]), '-p', str(os.getpid())])
+        except (OSError, subprocess.CalledProcessError) as e:
+            problems.append("Unable to ionice: {0}".format(e))
+    return problems
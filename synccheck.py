@@ -21,6 +21,17 @@ from pprint import pprint
 import requests
 import re
 import argparse
+import heapq
+import itertools
+import glob
+import multiprocessing
+import threading
+import BaseHTTPServer
+import SocketServer
+import urlparse
+from StringIO import StringIO
+import manifest
+from fileschema import file_map, file_field, document_id
 
 config = dict(
     # Name of database in Cloudant for everything except file entries
@@ -57,7 +68,47 @@ config = dict(
     host_id = '',
     source_ip = '',
     target_ip = '',
-    viewversion = 0.03
+    viewversion = 0.05,
+    # First view version with the scan database views consolidated into a few design documents
+    consolidated_viewversion = 0.05,
+    # How up-to-date view results must be. One of the policies in view_freshness
+    freshness = 'lazy',
+    # Document ID scheme of the relationship, from its document (see fileschema.py)
+    id_scheme = 'hash',
+    # Print --detail listings as JSON lines instead of text
+    jsonl = False,
+    # Most relationships checked at once with --configs
+    max_workers = 8,
+    # Address the --serve daemon listens on. Local only by default, since it answers without authentication
+    serve_address = '127.0.0.1',
+    # Seconds between background refreshes of the --serve daemon's cache
+    serve_refresh = 300,
+    # Most entries of a detail listing the --serve daemon returns, unless a request asks for fewer
+    serve_detail_limit = 10000
+)
+
+# HTTP session for the requests to Cloudant, so connections are reused. requests.Session isn't safe to
+# share between threads, so each thread (those of the --serve daemon) gets its own on first use
+class ThreadSession(threading.local):
+    
+    def __init__(self):
+        self.session = requests.Session()
+    
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+# Each --configs worker process opens its own (see reset_session)
+http = ThreadSession()
+
+# Query parameters for each view freshness policy. Cloudant's stable/update parameters replace the
+# older stale=ok and stale=update_after
+#   fresh - wait until the index has caught up with every document. Slow right after large bulk inserts
+#   lazy - answer from the index as it stands, then bring it up to date in the background
+#   stale - answer from the index as it stands without triggering an update
+view_freshness = dict(
+    fresh = dict(),
+    lazy = dict(stable = 'true', update = 'lazy'),
+    stale = dict(stable = 'true', update = 'false')
 )
 
 maindb_views = dict(
@@ -75,63 +126,109 @@ maindb_views = dict(
                     "_count"]
 )
 
+# Views in scan database(s), as created by dirscan.py
+# Format is <view> = [<ddocname>,<viewname>,<mapfunction>,<reducefunction>]
+# Version 2 file documents have no scanID, so views with one in their keys are queried across all of it
 scandb_views = dict(
     file_types = [
-        '_design/files',
-        'typesscanned',
-        'function (doc) {if (doc.type === "file" && doc.goodscan === true) { filetype = doc.name.substr((~-doc.name.lastIndexOf(".") >>> 0) + 2); emit([doc.host, doc.scanID, filetype], doc.size); } }',
+        '_design/scanstats',
+        'types',
+        file_map('if (f.type === "file" && f.goodscan === true && f.status.state !== "deleted") { var filetype = f.name.substr((~-f.name.lastIndexOf(".") >>> 0) + 2); emit([f.host, f.scanID, filetype], f.size); }'),
         '_stats'
     ],
-    problem_files = [ 
-        '_design/files',
+    problem_files = [
+        '_design/scanstats',
         'problemfiles',
-        'function (doc) {if (doc.type === "file" && doc.goodscan === false) {emit([doc.scanID,doc.path,doc.name], 1);}}',
+        file_map('if (f.type === "file" && f.goodscan === false && f.status.state !== "deleted") { emit([f.host, f.path, f.name], f.status.detail); }'),
         '_count'
     ],
     source_files = [
-        '_design/sourcefiles',
+        '_design/syncstatus',
         'sourcefiles',
-        'function (doc) { if (doc.type === "file" && doc.goodscan === true && doc.source === true) {emit(doc._id, doc.datemodified); }}',
+        file_map('if (f.type === "file" && f.goodscan === true) { emit([f.host, doc._id], f.datemodified); }'),
+        None
+    ],
+    source_prefixes = [
+        '_design/syncstatus',
+        'prefixes',
+        file_map('if (f.type === "file" && f.goodscan === true && f.status.state !== "deleted") { emit([f.host, f.IDprefix], f.datemodified); }'),
+        '_count'
+    ],
+    content_sources = [
+        '_design/syncstatus',
+        'contentsources',
+        file_map('if (f.type === "file" && f.goodscan === true && f.status.state !== "deleted" && (f.checksum || f.fingerprint)) { emit([f.host, f.IDprefix], [f.checksum, f.fingerprint, f.syncpath, f.datemodified]); }'),
+        None
+    ],
+    content_targets = [
+        '_design/syncstatus',
+        'contenttargets',
+        file_map('if (f.type === "file" && f.goodscan === true && f.status.state !== "deleted" && f.syncIDprefix && (f.checksum || f.fingerprint)) { emit([f.host, f.syncIDprefix], [f.checksum, f.fingerprint, f.syncpath, f.datemodified, f.status.detail]); }'),
         None
     ],
+    sync_tree = [
+        '_design/syncstatus',
+        'tree',
+        file_map('if (f.type === "file" && f.goodscan === true && f.status.state !== "deleted") { var s = f.size; var up = (f.orphaned === "no" && f.datemodified >= f.sourcemodified) ? 1 : 0; var stale = (f.orphaned === "no" && f.datemodified < f.sourcemodified) ? 1 : 0; var orphan = (f.orphaned === "yes") ? 1 : 0; emit([f.host].concat(f.syncpath.split("/").filter(function (c) { return c.length > 0; })), [1, s, up, up * s, stale, stale * s, orphan, orphan * s]); }'),
+        '_sum'
+    ],
+    files_by_size = [
+        '_design/syncstatus',
+        'bysize',
+        file_map('if (f.type === "file" && f.goodscan === true && f.status.state !== "deleted") { var state = null; if (f.orphaned === "yes") { state = "orphaned"; } else if (f.orphaned === "no") { state = (f.datemodified < f.sourcemodified) ? "stale" : "uptodate"; } else if (f.orphaned === "unknown") { state = "unknown"; } emit([f.host, state, -f.size, f.syncpath], f.name); }'),
+        None
+    ],
+    missing_files = [
+        '_design/syncstatus',
+        'missing',
+        file_map('if (f.type === "file" && f.status.state !== "deleted") { emit([f.syncpath, f.name, f.host], f.size); }'),
+        '_stats'
+    ],
     uptodate_files = [
-        '_design/syncstate',
+        '_design/syncstatus',
         'uptodate',
-        'function (doc) {if (doc.type === "file" && doc.goodscan === true && doc.source === false && doc.orphaned === "no" && (doc.datemodified >= doc.sourcemodified)) {emit([doc.host, doc.scanID, doc.datemodified],doc.size);}}',
+        file_map('if (f.type === "file" && f.goodscan === true && f.status.state !== "deleted" && f.orphaned === "no" && (f.datemodified >= f.sourcemodified)) { emit([f.host, f.scanID, f.datemodified], f.size); }'),
         '_stats'
     ],
     stale_files = [
-        '_design/syncstate',
+        '_design/syncstatus',
         'stale',
-        'function (doc) {if (doc.type === "file" && doc.goodscan === true && doc.source === false && doc.orphaned === "no" && (doc.datemodified < doc.sourcemodified)) {emit([doc.host, doc.scanID, doc.datemodified],doc.size);}}',
+        file_map('if (f.type === "file" && f.goodscan === true && f.status.state !== "deleted" && f.orphaned === "no" && (f.datemodified < f.sourcemodified)) { emit([f.host, f.scanID, f.datemodified, f.syncpath], f.size); }'),
         '_stats'
     ],
     orphaned_files = [
-        '_design/syncstate',
+        '_design/syncstatus',
         'orphaned',
-        'function (doc) {if (doc.type === "file" && doc.goodscan === true && doc.source === false && doc.orphaned === "yes") {emit([doc.host, doc.scanID, doc.datemodified],doc.size);}}',
+        file_map('if (f.type === "file" && f.goodscan === true && f.status.state !== "deleted" && f.orphaned === "yes") { emit([f.host, f.scanID, f.datemodified, f.syncpath], f.size); }'),
         '_stats'
     ],
     unknown_files = [
-        '_design/syncstate',
+        '_design/syncstatus',
         'unknown',
-        'function (doc) {if (doc.type === "file" && doc.goodscan === true && doc.source === false && doc.orphaned === "unknown") {emit([doc.host, doc.scanID, doc.datemodified],doc.size);}}',
-        '_stats'
-    ],
-    source_prefixes = [
-        '_design/sourcefiles',
-        'prefixes',
-        'function (doc) {if (doc.type === "file" && doc.goodscan === true && doc.source === true) {emit(doc.IDprefix,doc.datemodified)}}',
-        '_count'
-    ],
-    missing_files = [
-        '_design/syncstate',
-        'missing',
-        'function (doc) {if (doc.type === "file") {emit([doc.syncpath,doc.name,doc.host],doc.size);}',
+        file_map('if (f.type === "file" && f.goodscan === true && f.status.state !== "deleted" && f.orphaned === "unknown") { emit([f.host, f.scanID, f.datemodified], f.size); }'),
         '_stats'
     ]
 )
 
+# Search index dirscan creates in each scan database once its first scan has loaded (see search_indexes in dirscan.py)
+file_search = ['_design/filesearch', 'newSearch']
+
+# Design documents that held these views in scan databases created before consolidated_viewversion.
+# Views without an entry here didn't exist before the consolidation
+legacy_scandb_ddocs = dict(
+    file_types = '_design/filetypes',
+    problem_files = '_design/problemfiles',
+    source_files = '_design/sourcefiles',
+    missing_files = '_design/syncstate'
+)
+
+# View version of each scan database queried so far (see scan_view)
+scandb_versions = dict()
+
+# Difference totals of the last pair of stored manifests compared for each relationship, by relationship:
+# ((source index ID, target index ID), totals). A manifest never changes once stored (see check_relationship)
+manifest_diff_totals = dict()
+
 # Search design documents
 search_indexes = dict(
     files = [
@@ -148,7 +245,7 @@ def main():
     argparser.add_argument(
         '-c',
         metavar='config file',
-        type=file,
+        type=str,
         nargs='?',
         help='Configuration file to use for sync check. Defaults to trying {0}'.format(config['config_file']),
         default = config['config_file']
@@ -168,18 +265,136 @@ def main():
         nargs='?',
         help='Add s for stale files, o for orphaned files, e for files with scan errors, m for missing files. For example, listing all would be [--detail some]'
     )
+    argparser.add_argument(
+        '--jsonl',
+        action='store_true',
+        help='Print the status and --detail listings as one JSON object per line'
+    )
+    argparser.add_argument(
+        '--top',
+        metavar='N',
+        type=int,
+        help='With --detail m or --state, list only the N largest files, largest first'
+    )
+    argparser.add_argument(
+        '--state',
+        choices=['stale', 'missing', 'orphaned', 'unknown'],
+        help='List the largest files in this sync state (10 unless --top is given) from the size-ordered index'
+    )
+    argparser.add_argument(
+        '--freshness',
+        choices=view_freshness.keys(),
+        help='How current view results must be: fresh waits for indexes to catch up, lazy (default) answers immediately and updates indexes afterwards, stale answers immediately without updating',
+        default = config['freshness']
+    )
+    argparser.add_argument(
+        '--configs',
+        metavar='config file',
+        type=str,
+        nargs='+',
+        help='Check the relationships of all these configuration files (or glob patterns) at once and print one table, then exit'
+    )
+    argparser.add_argument(
+        '--json',
+        action='store_true',
+        help='With --configs, print the results as JSON instead of a table'
+    )
+    argparser.add_argument(
+        '--serve',
+        metavar='port',
+        type=int,
+        help='Serve the sync status and detail listings as JSON over HTTP on this port from a cache refreshed in the background'
+    )
+    argparser.add_argument(
+        '--refresh',
+        metavar='seconds',
+        type=int,
+        help='With --serve, seconds between cache refreshes. Defaults to {0}'.format(config['serve_refresh']),
+        default = config['serve_refresh']
+    )
+    argparser.add_argument(
+        '--diff-manifests',
+        metavar='manifest',
+        type=str,
+        nargs=2,
+        help='Compare a source and a target manifest written by dirscan.py --export-manifest, list the differences, then exit'
+    )
+    argparser.add_argument(
+        '--rsync-list',
+        metavar='prefix',
+        type=str,
+        help='With --diff-manifests or --diff-stored, also write <prefix>.files (an rsync --files-from list of files to transfer) and <prefix>.filter (rsync filter rules covering only the differing paths)'
+    )
+    argparser.add_argument(
+        '--diff-stored',
+        action='store_true',
+        help='Compare the manifests stored by both hosts\' last scans (dirscan.py --manifest-storage), list the differences, then exit'
+    )
+    argparser.add_argument(
+        '--find',
+        metavar='PATTERN',
+        type=str,
+        help='Show the sync state on both hosts of the files matching PATTERN, a file name or (with a /) a path relative to the sync directory. * and ? are wildcards'
+    )
+    argparser.add_argument(
+        '--tree',
+        action='store_true',
+        help='Show unsynced data by directory, descending into the heaviest directory at each level'
+    )
+    argparser.add_argument(
+        '--depth',
+        metavar='N',
+        type=int,
+        help='With --tree, the number of directory levels to descend. Defaults to 1',
+        default = 1
+    )
+    argparser.add_argument(
+        '--under',
+        metavar='PATH',
+        type=str,
+        help='With --tree, start from this directory (relative to the sync directory) instead of the root',
+        default = ''
+    )
+    argparser.add_argument(
+        '--verify-content',
+        action='store_true',
+        help='Compare the checksums (or fingerprints) of each file on both hosts, list the target copies whose content differs and mark them as content mismatches'
+    )
+    argparser.add_argument(
+        '--compare-digests',
+        action='store_true',
+        help='Compare the directory digests of both hosts top-down and list only the directories whose contents differ'
+    )
 
     myargs = argparser.parse_args()
-    load_config(myargs.c)
+    config['freshness'] = myargs.freshness
+    config['jsonl'] = myargs.jsonl
+    if myargs.configs != None:
+        check_configs(myargs.configs, myargs.json)
+        sys.exit()
+    try:
+        load_config(open(myargs.c))
+    except IOError as e:
+        print "I/O error({0}): {1}".format(e.errno, e.strerror)
+        sys.exit(2)
+    if myargs.diff_manifests != None:
+        print_manifest_differences(myargs.diff_manifests[0], myargs.diff_manifests[1], myargs.rsync_list)
+        sys.exit()
+    if myargs.diff_stored:
+        print_stored_differences(myargs.rsync_list)
+        sys.exit()
+    if myargs.serve != None:
+        serve_status(myargs.serve, myargs.refresh)
+        sys.exit()
     interval = myargs.r * 60
     
     while (interval != 0):
         results = check_relationship()
-        print_relationship(results)
+        print_status(results)
         time.sleep(interval)
         
     results = check_relationship()
-    print_relationship(results)
+    print_status(results)
     if myargs.detail != None:
         sourcescan = get_scan_db(config['rsync_source'])
         targetscan = get_scan_db(config['rsync_target'])
@@ -192,108 +407,877 @@ def main():
         if 'o' in myargs.detail:
             print_orphans(config['rsync_target'], targetscan)
         if 'm' in myargs.detail:
-            print_missing(sourcescan,targetscan)
+            print_missing(sourcescan,targetscan,myargs.top)
         if 'e' in myargs.detail:
             print_errors(sourcescan,targetscan)
+    if myargs.find != None:
+        print_found(get_scan_db(config['rsync_source']), get_scan_db(config['rsync_target']), myargs.find)
+    if myargs.state != None:
+        print_largest(get_scan_db(config['rsync_source']), get_scan_db(config['rsync_target']), myargs.state, myargs.top or 10)
+    if myargs.tree:
+        print_tree(get_scan_db(config['rsync_source']), get_scan_db(config['rsync_target']), myargs.depth, myargs.under)
+    if myargs.compare_digests:
+        print_digest_differences(get_scan_db(config['rsync_source']), get_scan_db(config['rsync_target']))
+    if myargs.verify_content:
+        print_content_mismatches(get_scan_db(config['rsync_source']), get_scan_db(config['rsync_target']))
 
 # Load configuration from file and database into configuration dictionary
 # Gets us: hostIDs, relationshipID, auth, dirs, host names, rsync flags, threshold, maindbname
 def load_config(config_file):
     config_json = json.load(config_file)
     config_file.close()
-    config['cloudant_auth'] = config_json['cloudant_auth']
-    config['cloudant_user'] = config_json['cloudant_user']
-    config['cloudant_account'] = config_json['cloudant_account']
-    config['relationship'] = config_json['relationship']
-    config['host_id'] = config_json['host_id']
-    config['doc_threshold'] = config_json['threshold']
+    read_config_json(config, config_json)
     
     # Connect to database
     with cloudant(config['cloudant_user'], config['cloudant_auth'], account=config['cloudant_user']) as client:
         db = client[config['main_db_name']]
         #db = CloudantDatabase(client, config['main_db_name'])
-        # Read in configuration of relationship from database
-        with Document(db, config['relationship']) as relationshipdoc:
-            config['rsync_flags'] = relationshipdoc['rsyncflags']
-            # config['rsync_excluded'] = relationshipdoc['excludedfiles']
-            config['rsync_source'] = relationshipdoc['sourcehost']
-            config['rsync_target'] = relationshipdoc['targethost']
-            config['rsync_source_dir'] = relationshipdoc['sourcedir']
-            config['rsync_target_dir'] = relationshipdoc['targetdir']
-        
-        # Get hosts' IP addresses and names
-        with Document(db, config['rsync_source']) as doc:
-            config['source_ip'] = doc['ip4']
-            config['source_name'] = doc['hostname']
-        with Document(db, config['rsync_target']) as doc:
-            config['target_name'] = doc['hostname']
-            config['target_ip'] = doc['ip4']
-        
-def print_errors(sourcescan,targetscan):
-    startkey = '["{0}",{1},{2}]'.format(sourcescan['id'],'null','null')
-    endkey = '["{0}",{1},{2}]'.format(sourcescan['id'],'{}','{}')
-    sourceerrors = get_view(
-        sourcescan['value'],
-        scandb_views['problem_files'][0],
-        scandb_views['problem_files'][1],
-        False,
-        0,
-        startkey,
-        endkey,
-        False
-    )
-    startkey = '["{0}",{1},{2}]'.format(targetscan['id'],'null','null')
-    endkey = '["{0}",{1},{2}]'.format(targetscan['id'],'{}','{}')
-    targeterrors = get_view(
-        targetscan['value'],
-        scandb_views['problem_files'][0],
-        scandb_views['problem_files'][1],
-        False,
-        0,
-        startkey,
-        endkey,
-        False
-    )
-    for row in sourceerrors['rows']:
-        print " Couldn't scan source: {0}{1}".format(row['key'][1],row['key'][2])
-    for row in targeterrors['rows']:
-        print " Couldn't scan target: {0}{1}".format(row['key'][1],row['key'][2])
+        # Read in configuration of relationship from database, then get hosts' IP addresses and names
+        relationshipdoc = Document(db, config['relationship'])
+        relationshipdoc.fetch()
+        sourcedoc = Document(db, relationshipdoc['sourcehost'])
+        sourcedoc.fetch()
+        targetdoc = Document(db, relationshipdoc['targethost'])
+        targetdoc.fetch()
+        apply_relationship(config, relationshipdoc, sourcedoc, targetdoc)
+
+# Settings read from a configuration file into configuration dictionary <settings>
+def read_config_json(settings, config_json):
+    settings['cloudant_auth'] = config_json['cloudant_auth']
+    settings['cloudant_user'] = config_json['cloudant_user']
+    settings['cloudant_account'] = config_json['cloudant_account']
+    settings['relationship'] = config_json['relationship']
+    settings['host_id'] = config_json['host_id']
+    settings['doc_threshold'] = config_json['threshold']
+
+# Settings from the relationship's document and its hosts' documents, into configuration dictionary <settings>
+def apply_relationship(settings, relationshipdoc, sourcedoc, targetdoc):
+    settings['relationship_name'] = relationshipdoc.get('name', relationshipdoc['_id'])
+    settings['rsync_flags'] = relationshipdoc['rsyncflags']
+    # settings['rsync_excluded'] = relationshipdoc['excludedfiles']
+    settings['rsync_source'] = relationshipdoc['sourcehost']
+    settings['rsync_target'] = relationshipdoc['targethost']
+    settings['rsync_source_dir'] = relationshipdoc['sourcedir']
+    settings['rsync_target_dir'] = relationshipdoc['targetdir']
+    settings['id_scheme'] = relationshipdoc.get('idscheme', 'hash')
+    settings['source_ip'] = sourcedoc['ip4']
+    settings['source_name'] = sourcedoc['hostname']
+    settings['target_name'] = targetdoc['hostname']
+    settings['target_ip'] = targetdoc['ip4']
+
+# Check the relationships of every configuration file matching <patterns> at once and print one table
+# (or JSON). Configurations sharing a Cloudant account have their relationship and host documents read
+# together, two requests per account, then each relationship is checked in a pool of worker processes.
+# Processes rather than threads, since the checks read their settings from the global config
+def check_configs(patterns, as_json = False):
+    filenames = []
+    for pattern in patterns:
+        for filename in sorted(glob.glob(pattern)) or [pattern]:
+            if filename not in filenames:
+                filenames.append(filename)
+    settings = []
+    accounts = dict()
+    for filename in filenames:
+        try:
+            with open(filename) as config_file:
+                config_json = json.load(config_file)
+        except (IOError, ValueError) as e:
+            print " Skipping {0}: {1}".format(filename, e)
+            continue
+        relationship = dict(config)
+        read_config_json(relationship, config_json)
+        relationship['config_file'] = filename
+        settings.append(relationship)
+        accounts.setdefault((relationship['cloudant_account'], relationship['cloudant_user'], relationship['cloudant_auth']), []).append(relationship)
+    if len(settings) == 0:
+        sys.exit(" No configuration files found")
+    
+    for account in accounts.values():
+        config.update(account[0])
+        relationshipdocs = get_docs(config['main_db_name'], list(set([r['relationship'] for r in account])))
+        hosts = set()
+        for doc in relationshipdocs.values():
+            hosts.update([doc['sourcehost'], doc['targethost']])
+        hostdocs = get_docs(config['main_db_name'], list(hosts))
+        for relationship in account:
+            doc = relationshipdocs.get(relationship['relationship'])
+            if (doc == None) or (doc['sourcehost'] not in hostdocs) or (doc['targethost'] not in hostdocs):
+                relationship['error'] = "Relationship or host documents not found"
+                continue
+            apply_relationship(relationship, doc, hostdocs[doc['sourcehost']], hostdocs[doc['targethost']])
+    
+    pool = multiprocessing.Pool(min(len(settings), config['max_workers']), reset_session)
+    try:
+        results = pool.map(check_config, settings)
+    finally:
+        pool.close()
+        pool.join()
+    if as_json:
+        print json.dumps(results, sort_keys=True, indent=4, separators=(',', ': '))
+    else:
+        print_relationships(results)
+
+# Fresh HTTP session for a worker process, rather than connections inherited from the parent
+def reset_session():
+    global http
+    http = ThreadSession()
+
+# Status of one relationship for check_configs, run in a worker process with its <settings>
+def check_config(settings):
+    config.update(settings)
+    results = dict(name = settings.get('relationship_name', settings['relationship']), config = settings['config_file'])
+    if 'error' in settings:
+        results['error'] = settings['error']
+        return results
+    try:
+        results.update(check_relationship())
+    except (Exception, SystemExit) as e:
+        results['error'] = str(e) or e.__class__.__name__
+    return results
+
+# One line per relationship checked by check_configs
+def print_relationships(results):
+    line = u" {0:<28} {1:<30} {2:>12} {3:>12} {4:>10} {5:>10} {6:>10}"
+    print line.format("Relationship", "Source > Target", "Up to date", "Missing", "Stale", "Orphaned", "Unknown")
+    print " " + "-" * 118
+    for result in results:
+        if 'error' in result:
+            print u" {0:<28} {1}".format(result['name'], result['error'])
+            continue
+        print line.format(
+            result['name'][:28],
+            u"{0} > {1}".format(result['hostnames'][0], result['hostnames'][1])[:30],
+            result['uptodate'],
+            result['missing'],
+            result['stale'],
+            result['orphaned'],
+            result['unknown']
+        )
     print ""
 
+# List the files that couldn't be scanned on either host, as the rows stream in
+def print_errors(sourcescan,targetscan):
+    for entry in error_entries(sourcescan, targetscan):
+        print_detail(detail_text(entry), **entry)
+    if not config['jsonl']:
+        print ""
+
+# Files that couldn't be scanned on either host, as --detail entries
+def error_entries(sourcescan, targetscan):
+    for scan, host, label in [(sourcescan, config['rsync_source'], 'source'), (targetscan, config['rsync_target'], 'target')]:
+        key = problem_files_key(scan['value'], host, scan['id'])
+        for row in iter_view(scan['value'], 'problem_files', [key, None, None], [key, {}, {}]):
+            yield dict(state = 'error', host = label, path = row['key'][1], name = row['key'][2], detail = row['value'])
+
+# List the target's orphaned files, as the rows stream in
 def print_orphans(host, targetscan):
-    startkey = '["{0}","{1}",{2}]'.format(host, targetscan['id'],'null')
-    endkey = '["{0}","{1}",{2}]'.format(host, targetscan['id'],'{}')
-    orphans = get_view(
-        targetscan['value'],
-        scandb_views['orphaned_files'][0],
-        scandb_views['orphaned_files'][1],
-        False,
-        0,
-        startkey,
-        endkey,
-        True
-    )
-    for row in orphans['rows']:
-        print " Orphaned {0} file on target: {1}/{2}".format(data_size_pretty(row['value']),row['doc']['path'],row['doc']['name'])
-
-def print_missing(sourcescan,targetscan):
-    pass
+    for entry in state_entries('orphaned', host, targetscan):
+        print_detail(detail_text(entry), **entry)
+
+# The target's files in sync <state> (stale or orphaned), as --detail entries
+def state_entries(state, host, targetscan):
+    for row in iter_view(targetscan['value'], state + '_files', [host, None, None], [host, {}, {}]):
+        yield dict(state = state, syncpath = row['key'][3], size = row['value'])
+
+# List the source's files that have no copy on the target as they're found, followed by totals.
+# With <top>, only the <top> largest are kept (in a heap) and listed at the end, largest first
+def print_missing(sourcescan, targetscan, top = None):
+    largest = []
+    count = 0
+    total = 0
+    for syncpath, size in missing_files(sourcescan, targetscan):
+        count = count + 1
+        total = total + size
+        if top == None:
+            print_detail(detail_text(dict(state = 'missing', syncpath = syncpath, size = size)), state = 'missing', syncpath = syncpath, size = size)
+        elif len(largest) < top:
+            heapq.heappush(largest, (size, syncpath))
+        elif top > 0:
+            heapq.heappushpop(largest, (size, syncpath))
+    for size, syncpath in sorted(largest, reverse=True):
+        print_detail(detail_text(dict(state = 'missing', syncpath = syncpath, size = size)), state = 'missing', syncpath = syncpath, size = size)
+    if not config['jsonl']:
+        print " {0:,} files ({1}) missing on target".format(count, data_size_pretty(total))
+        print ""
+
+# Iterate over (syncpath, size) of the source's files without a copy on the target, in syncpath order.
+# The missing_files view is streamed from the source's scan database a page at a time. Its rows for
+# the same file on both hosts are adjacent, so when both hosts share a scan database one pass finds the
+# missing files. Otherwise the files the source's database has no target row for are looked up in the
+# target's database by key, a batch at a time
+def missing_files(sourcescan, targetscan):
+    shared = (sourcescan['value'] == targetscan['value'])
+    candidates = []
+    rows = iter_view(sourcescan['value'], 'missing_files')
+    for path, group in itertools.groupby(rows, lambda row: row['key'][:2]):
+        hosts = dict([(row['key'][2], row['value']) for row in group])
+        if (config['rsync_source'] not in hosts) or (config['rsync_target'] in hosts):
+            continue
+        if shared:
+            yield (path[0], hosts[config['rsync_source']])
+            continue
+        candidates.append((path[0], path[1], hosts[config['rsync_source']]))
+        if len(candidates) >= config['doc_threshold']:
+            for missing in not_on_target(targetscan, candidates):
+                yield missing
+            candidates = []
+    for missing in not_on_target(targetscan, candidates):
+        yield missing
+
+# List the <top> largest files in sync <state>, largest first, from the files_by_size view. Its keys are
+# [host, state, -size, syncpath], so the largest stale, orphaned or unknown files on the target are the
+# first <top> rows of the target's range for that state. Missing files are the source's (whose documents
+# carry no sync state) without a copy on the target, so the source's files are read largest first a page
+# of <top> at a time until <top> of them turn out to be missing
+def print_largest(sourcescan, targetscan, state, top):
+    if state == 'missing':
+        largest = largest_missing(sourcescan, targetscan, top)
+    else:
+        view = scan_view(targetscan['value'], 'files_by_size')
+        response = http.get(
+            "https://{0}.cloudant.com/{1}/{2}/_view/{3}".format(config['cloudant_account'], targetscan['value'], view[0], view[1]),
+            auth = (config['cloudant_user'], config['cloudant_auth']),
+            params = view_params({
+                'startkey': json.dumps([config['rsync_target'], state]),
+                'endkey': json.dumps([config['rsync_target'], state, {}]),
+                'limit': top
+            })
+        )
+        if response.status_code in (201,200,202):
+            jsondata = response.json()
+        else:
+            response.raise_for_status()
+            sys.exit("Bad http request")
+        largest = [(row['key'][3], -row['key'][2]) for row in jsondata['rows']]
+    for syncpath, size in largest:
+        entry = dict(state = state, syncpath = syncpath, size = size)
+        print_detail(detail_text(entry), **entry)
+
+# (syncpath, size) of the <top> largest files missing on the target, largest first
+def largest_missing(sourcescan, targetscan, top):
+    found = []
+    candidates = []
+    rows = iter_view(sourcescan['value'], 'files_by_size', [config['rsync_source'], None], [config['rsync_source'], None, {}], page_size = top)
+    for row in rows:
+        candidates.append((row['key'][3], row['value'], -row['key'][2]))
+        if len(candidates) == top:
+            found.extend(not_on_target(targetscan, candidates))
+            candidates = []
+            if len(found) >= top:
+                break
+    found.extend(not_on_target(targetscan, candidates))
+    return found[:top]
+
+# (syncpath, size) of each of <candidates> (syncpath, name, size) that the target's scan database has no row for
+def not_on_target(targetscan, candidates):
+    if len(candidates) == 0:
+        return
+    view = scan_view(targetscan['value'], 'missing_files')
+    response = http.post(
+        "https://{0}.cloudant.com/{1}/{2}/_view/{3}".format(config['cloudant_account'], targetscan['value'], view[0], view[1]),
+        auth = (config['cloudant_user'], config['cloudant_auth']),
+        params = view_params({'reduce': 'false'}),
+        headers = {'Content-Type': 'application/json'},
+        data = json.dumps({'keys': [[syncpath, name, config['rsync_target']] for syncpath, name, size in candidates]})
+    )
+    if response.status_code in (201,200,202):
+        jsondata = response.json()
+    else:
+        response.raise_for_status()
+        sys.exit("Bad http request")
+    found = set([(row['key'][0], row['key'][1]) for row in jsondata['rows']])
+    for syncpath, name, size in candidates:
+        if (syncpath, name) not in found:
+            yield (syncpath, size)
 
+# List the target's stale files, as the rows stream in
 def print_stales(host, targetscan):
-    startkey = '["{0}","{1}",{2}]'.format(host, targetscan['id'],'null')
-    endkey = '["{0}","{1}",{2}]'.format(host, targetscan['id'],'{}')
-    stales = get_view(
-        targetscan['value'],
-        scandb_views['stale_files'][0],
-        scandb_views['stale_files'][1],
-        False,
-        0,
-        startkey,
-        endkey,
-        True
-    )
-    for row in stales['rows']:
-        print " Stale {0} file on target: {1}/{2}".format(data_size_pretty(row['value']),row['doc']['path'],row['doc']['name'])
+    for entry in state_entries('stale', host, targetscan):
+        print_detail(detail_text(entry), **entry)
+
+# Print the sync status <results> of check_relationship as a table, or as one JSON object with --jsonl
+def print_status(results):
+    if config['jsonl']:
+        print json.dumps(dict(status = results))
+    else:
+        print_relationship(results)
+
+# Print one entry of a --detail listing: <text>, or its <fields> as a line of JSON with --jsonl
+def print_detail(text, **fields):
+    if config['jsonl']:
+        print json.dumps(fields)
+    else:
+        print text
+
+# Text line of a --detail entry
+def detail_text(entry):
+    if entry['state'] == 'error':
+        return u" Couldn't scan {0}: {1}{2}".format(entry['host'], entry['path'], entry['name'])
+    return u" {0} {1} file on target: /{2}".format(entry['state'].capitalize(), data_size_pretty(entry['size']), entry['syncpath'])
+
+# Show each file matching <pattern> on either host with its sync state, from the file search index.
+# Results come a page at a time, following the bookmark of each page
+def print_found(sourcescan, targetscan, pattern):
+    labels = {config['rsync_source']: 'source', config['rsync_target']: 'target'}
+    found = 0
+    for db in sorted(set([sourcescan['value'], targetscan['value']])):
+        for row in search_files(db, find_query(pattern)):
+            fields = row['fields']
+            label = labels.get(fields.get('host'), fields.get('host'))
+            state = found_state(label, fields)
+            found = found + 1
+            print_detail(
+                u" {0:<6} /{1}  {2}  {3}".format(label, fields.get('syncpath'), data_size_pretty(fields.get('size', 0)), state),
+                host = label,
+                syncpath = fields.get('syncpath'),
+                size = fields.get('size'),
+                datemodified = fields.get('datemodified'),
+                state = state
+            )
+    if not config['jsonl']:
+        print " {0:,} matching files".format(found)
+        print ""
+
+# Sync state of a file found in the search index, from its stored fields
+def found_state(label, fields):
+    if fields.get('state') != 'ok':
+        return fields.get('state')
+    if label == 'source':
+        return 'source'
+    if fields.get('orphaned') == 'yes':
+        return 'orphaned'
+    if fields.get('orphaned') == 'no':
+        if fields.get('datemodified') < fields.get('sourcemodified'):
+            return 'stale'
+        return 'uptodate'
+    return 'unknown'
+
+# Lucene query for the files of either host in the relationship whose name, or sync path when <pattern>
+# contains a slash, matches <pattern>. Both fields are indexed whole, so * and ? work as wildcards
+def find_query(pattern):
+    if '/' in pattern:
+        field = 'syncpath'
+    else:
+        field = 'name'
+    escaped = re.sub(r'([+\-&|!(){}\[\]^"~:\\/ ])', r'\\\1', pattern)
+    return '(host:"{0}" OR host:"{1}") AND {2}:{3}'.format(config['rsync_source'], config['rsync_target'], field, escaped)
+
+# Iterate over the rows of file search index results for <query> in scan database <db>, a page at a time
+def search_files(db, query):
+    url = "https://{0}.cloudant.com/{1}/{2}/_search/{3}".format(config['cloudant_account'], db, file_search[0], file_search[1])
+    payload = dict(q = query, limit = 200)
+    while True:
+        response = http.get(
+            url,
+            auth = (config['cloudant_user'], config['cloudant_auth']),
+            params = payload
+        )
+        if response.status_code == 404:
+            message = " No file search index in {0} yet. It's created when a scan into the database finishes.".format(db)
+            # Keep --jsonl output to JSON lines
+            if config['jsonl']:
+                sys.stderr.write(message + "\n")
+            else:
+                print message
+            return
+        elif response.status_code not in (201,200,202):
+            response.raise_for_status()
+            sys.exit("Bad http request")
+        jsondata = response.json()
+        for row in jsondata['rows']:
+            yield row
+        if len(jsondata['rows']) < payload['limit']:
+            return
+        payload['bookmark'] = jsondata['bookmark']
+
+# Results kept by the --serve daemon, by key, each with the time it was loaded. Concurrent requests for
+# a key that's being loaded wait for that load rather than starting their own, so Cloudant sees one set
+# of queries per key however many clients poll
+class StatusCache(object):
+    
+    def __init__(self, max_age):
+        self.max_age = max_age
+        self.entries = dict()
+        self.loaders = dict()
+        self.loading = set()
+        # Keys requested since the last refresh
+        self.requested = set()
+        self.condition = threading.Condition()
+    
+    # (time loaded, value) of <key>, loaded with <loader> when it's missing or older than max_age
+    def get(self, key, loader):
+        with self.condition:
+            self.loaders[key] = loader
+            self.requested.add(key)
+            while True:
+                entry = self.entries.get(key)
+                if (entry != None) and (time.time() - entry[0] < self.max_age):
+                    return entry
+                if key not in self.loading:
+                    break
+                self.condition.wait()
+            self.loading.add(key)
+        return self.load(key)
+    
+    # Load <key> (already marked as loading) and wake up the requests waiting for it
+    def load(self, key):
+        try:
+            entry = (time.time(), self.loaders[key]())
+            with self.condition:
+                self.entries[key] = entry
+            return entry
+        finally:
+            with self.condition:
+                self.loading.discard(key)
+                self.condition.notify_all()
+    
+    # Reload every key requested since the last refresh that isn't already loading, so requests are answered
+    # from the cache. Keys nobody asked for are dropped, and loaded again if they're requested later
+    def refresh(self):
+        with self.condition:
+            for key in [key for key in self.loaders if (key not in self.requested) and (key not in self.loading)]:
+                del self.loaders[key]
+                self.entries.pop(key, None)
+            keys = [key for key in self.loaders if key not in self.loading]
+            self.loading.update(keys)
+            self.requested = set()
+        for key in keys:
+            try:
+                self.load(key)
+            except (Exception, SystemExit) as e:
+                sys.stderr.write(" Unable to refresh {0}: {1}\n".format(key, e))
+
+# Detail listings served by the --serve daemon: /detail/<name>
+def detail_listing(name, limit):
+    sourcescan = get_scan_db(config['rsync_source'])
+    targetscan = get_scan_db(config['rsync_target'])
+    if name == 'errors':
+        entries = error_entries(sourcescan, targetscan)
+    elif name == 'missing':
+        entries = (dict(state = 'missing', syncpath = syncpath, size = size) for syncpath, size in missing_files(sourcescan, targetscan))
+    else:
+        entries = state_entries(name, config['rsync_target'], targetscan)
+    return list(itertools.islice(entries, limit))
+
+detail_listings = ['stale', 'orphaned', 'missing', 'errors']
+
+class StatusRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    
+    # GET /status - the sync status (as check_relationship reports it)
+    # GET /detail/<stale|orphaned|missing|errors>[?limit=N] - the first N entries of a detail listing
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        parts = [part for part in url.path.split('/') if len(part) > 0]
+        try:
+            if parts == ['status']:
+                entry = self.server.cache.get('status', check_relationship)
+            elif (len(parts) == 2) and (parts[0] == 'detail') and (parts[1] in detail_listings):
+                limit = min(int(urlparse.parse_qs(url.query).get('limit', [config['serve_detail_limit']])[0]), config['serve_detail_limit'])
+                # One listing per name is cached, at the largest limit, and cut down to each request's
+                entry = self.server.cache.get(parts[1], lambda: detail_listing(parts[1], config['serve_detail_limit']))
+                entry = (entry[0], entry[1][:max(limit, 0)])
+            else:
+                self.send_json(404, dict(error = "Not found. Try /status or /detail/<{0}>".format('|'.join(detail_listings))))
+                return
+        except ValueError:
+            self.send_json(400, dict(error = "limit must be a number"))
+            return
+        except (Exception, SystemExit) as e:
+            self.send_json(502, dict(error = str(e) or e.__class__.__name__))
+            return
+        self.send_json(200, entry[1], int(time.time() - entry[0]))
+    
+    def send_json(self, status, value, age = None):
+        body = json.dumps(value)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if age != None:
+            self.send_header('Age', str(age))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    # Keep requests out of the terminal
+    def log_message(self, format, *args):
+        pass
+
+class StatusServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+# Serve the sync status and detail listings as JSON on <port>, from a cache refreshed every <refresh>
+# seconds in the background. Clients can poll as often as they like without adding Cloudant queries
+def serve_status(port, refresh):
+    server = StatusServer((config['serve_address'], port), StatusRequestHandler)
+    # Entries stay valid a little longer than the refresh interval, so requests don't race the refresher
+    server.cache = StatusCache(refresh * 2)
+    server.cache.get('status', check_relationship)
+    refresher = threading.Thread(target = refresh_cache, args = (server.cache, refresh))
+    refresher.daemon = True
+    refresher.start()
+    print " Serving sync status on http://{0}:{1}/status".format(config['serve_address'], port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+# Refresh <cache> every <refresh> seconds. Each refresh re-reads the view version of the scan databases,
+# since dirscan may have moved one to the consolidated design documents and removed the old ones meanwhile
+def refresh_cache(cache, refresh):
+    while True:
+        time.sleep(refresh)
+        scandb_versions.clear()
+        cache.refresh()
+
+# Order of the totals in the values of the sync_tree view
+tree_fields = ['files', 'bytes', 'uptodate', 'uptodatebytes', 'stale', 'stalebytes', 'orphaned', 'orphanedbytes']
+
+# Show the unsynced data in each directory under <under>, heaviest first, then descend into the heaviest
+# for <depth> levels. Each level costs one grouped query of the sync_tree view per host, returning one
+# row per subdirectory. Missing totals are the source's less what the target has a synced copy of, so
+# they're approximate when file sizes differ between hosts
+def print_tree(sourcescan, targetscan, depth = 1, under = ''):
+    path = [name for name in unicode_name(under).split(u'/') if len(name) > 0]
+    for level in range(depth):
+        source = tree_totals(sourcescan['value'], config['rsync_source'], path)
+        target = tree_totals(targetscan['value'], config['rsync_target'], path)
+        children = []
+        for name in set(source.keys() + target.keys()):
+            totals = dict(zip(tree_fields, target.get(name, [0] * len(tree_fields))))
+            totals['sourcefiles'] = source.get(name, [0, 0])[0]
+            totals['sourcebytes'] = source.get(name, [0, 0])[1]
+            totals['missing'] = max(0, totals['sourcefiles'] - totals['uptodate'] - totals['stale'])
+            totals['missingbytes'] = max(0, totals['sourcebytes'] - totals['uptodatebytes'] - totals['stalebytes'])
+            totals['unsynced'] = totals['missingbytes'] + totals['stalebytes']
+            children.append((name, totals))
+        if len(children) == 0:
+            break
+        children.sort(key = lambda child: child[1]['unsynced'], reverse = True)
+        if not config['jsonl']:
+            print u" /{0}".format(u'/'.join(path))
+        for name, totals in children:
+            print_detail(
+                u"   {0:<40} {1:>14} unsynced  {2:,} missing, {3:,} stale, {4:,} orphaned".format(
+                    name, data_size_pretty(totals['unsynced']), totals['missing'], totals['stale'], totals['orphaned']),
+                syncpath = u'/'.join(path + [name]),
+                **totals
+            )
+        if children[0][1]['unsynced'] == 0:
+            break
+        path = path + [children[0][0]]
+
+# Totals of the sync_tree view for each entry directly in the directory <path> (a list of path
+# components) on <host>, by entry name
+def tree_totals(db, host, path):
+    view = scan_view(db, 'sync_tree')
+    response = http.get(
+        "https://{0}.cloudant.com/{1}/{2}/_view/{3}".format(config['cloudant_account'], db, view[0], view[1]),
+        auth = (config['cloudant_user'], config['cloudant_auth']),
+        params = view_params({
+            'startkey': json.dumps([host] + path),
+            'endkey': json.dumps([host] + path + [{}]),
+            'group_level': len(path) + 2,
+            'reduce': 'true'
+        })
+    )
+    if response.status_code in (201,200,202):
+        jsondata = response.json()
+    else:
+        response.raise_for_status()
+        sys.exit("Bad http request")
+    totals = dict()
+    for row in jsondata['rows']:
+        if len(row['key']) == len(path) + 2:
+            totals[row['key'][-1]] = row['value']
+    return totals
+
+def unicode_name(name):
+    if isinstance(name, str):
+        return name.decode('utf-8', 'replace')
+    return name
+
+# Walk the Merkle directory digests of both hosts from the root down, descending only into
+# subdirectories whose digests differ. Each level of the tree costs one lookup per host
+def print_digest_differences(sourcescan, targetscan):
+    source_root = sourcescan['doc'].get('rootdigest')
+    target_root = targetscan['doc'].get('rootdigest')
+    if (source_root == None) or (target_root == None):
+        print " Directory digests unavailable. Both hosts need a completed scan by a current version of dirscan."
+        return
+    if sourcescan['doc'].get('deepscan') != targetscan['doc'].get('deepscan'):
+        print " Warning: only one host used --deep, so file digests use checksums on one side and dates on the other."
+    if source_root == target_root:
+        print " Source and target are in sync (root digest {0})".format(source_root)
+        return
+    
+    lookups = 0
+    level = [u'']
+    while len(level) > 0:
+        source_dirs = get_docs(sourcescan['value'], [directory_doc_id(config['rsync_source'], path) for path in level])
+        target_dirs = get_docs(targetscan['value'], [directory_doc_id(config['rsync_target'], path) for path in level])
+        lookups = lookups + 2
+        next_level = []
+        for path in level:
+            source_dir = source_dirs.get(directory_doc_id(config['rsync_source'], path))
+            target_dir = target_dirs.get(directory_doc_id(config['rsync_target'], path))
+            if (source_dir == None) or (target_dir == None):
+                print " No digest recorded for /{0}".format(path)
+                continue
+            if source_dir['filedigest'] != target_dir['filedigest']:
+                print " Files differ in: /{0}".format(path)
+            for name in sorted(source_dir['subdirs']):
+                child = sync_path_join(path, name)
+                if name not in target_dir['subdirs']:
+                    print " Directory missing on target: /{0}".format(child)
+                elif source_dir['subdirs'][name] != target_dir['subdirs'][name]:
+                    next_level.append(child)
+            for name in sorted(target_dir['subdirs']):
+                if name not in source_dir['subdirs']:
+                    print " Orphaned directory on target: /{0}".format(sync_path_join(path, name))
+        level = next_level
+    print " {0} directory lookups".format(lookups)
+
+# List the target's files whose content differs from the source's as they're found, and mark their
+# documents as content mismatches a batch at a time, followed by totals
+def print_content_mismatches(sourcescan, targetscan):
+    totals = dict(compared = 0, mismatches = 0, marked = 0)
+    unmarked = []
+    for entry in content_mismatches(sourcescan, targetscan, totals):
+        print_detail(u" Content mismatch ({0}) on target: /{1}".format(entry['compared'], entry['syncpath']), **entry)
+        if not entry['marked']:
+            unmarked.append(entry['id'])
+        if len(unmarked) >= config['doc_threshold']:
+            totals['marked'] = totals['marked'] + mark_content_mismatches(targetscan['value'], unmarked)
+            unmarked = []
+    if len(unmarked) > 0:
+        totals['marked'] = totals['marked'] + mark_content_mismatches(targetscan['value'], unmarked)
+    if not config['jsonl']:
+        print " {0:,} files compared, {1:,} content mismatches ({2:,} newly marked)".format(totals['compared'], totals['mismatches'], totals['marked'])
+        print ""
+
+# Iterate over the target's files whose checksum (or fingerprint, when they have no checksums to compare)
+# differs from the source's copy, counting into <totals>. The source's rows, by IDprefix, and the target's,
+# by syncIDprefix, are streamed in key order a page at a time and merge-joined, so memory use doesn't grow
+# with the number of files. Only copies with the same modification time as the source's latest checksummed
+# version are compared: a stale copy is expected to differ, and a newer version scanned without a checksum
+# leaves no row here, so an older one would otherwise be compared against the current copy
+def content_mismatches(sourcescan, targetscan, totals):
+    source_rows = iter_view(sourcescan['value'], 'content_sources', [config['rsync_source'], None], [config['rsync_source'], {}])
+    target_rows = iter_view(targetscan['value'], 'content_targets', [config['rsync_target'], None], [config['rsync_target'], {}])
+    source = next(source_rows, None)
+    last_prefix = None
+    for target in target_rows:
+        prefix = target['key'][1]
+        # Consecutive rows may share a prefix, one per version of a file. The latest version counts
+        if prefix != last_prefix:
+            while (source != None) and (source['key'][1] < prefix):
+                source = next(source_rows, None)
+            latest = None
+            while (source != None) and (source['key'][1] == prefix):
+                if (latest == None) or (source['value'][3] > latest[3]):
+                    latest = source['value']
+                source = next(source_rows, None)
+            last_prefix = prefix
+        if (latest == None) or (target['value'][3] != latest[3]):
+            continue
+        compared = compared_content(latest, target['value'])
+        if compared == None:
+            continue
+        totals['compared'] = totals['compared'] + 1
+        if compared[1]:
+            totals['mismatches'] = totals['mismatches'] + 1
+            yield dict(state = 'mismatch', compared = compared[0], syncpath = target['value'][2], id = target['id'], marked = (target['value'][4] == 'content mismatch'))
+
+# Compare the content values [checksum, fingerprint, ...] of a source and a target file. Returns the
+# field compared and whether they differ, or None when they have nothing in common to compare
+def compared_content(source, target):
+    if source[0] and target[0]:
+        return ('checksum', source[0] != target[0])
+    if source[1] and target[1] and (source[1].split(':')[0] == target[1].split(':')[0]):
+        return ('fingerprint', source[1] != target[1])
+    return None
+
+# Mark the file documents <ids> in <db> as content mismatches with one _bulk_docs request.
+# Returns the number marked. Documents updated by someone else first are left for the next run
+def mark_content_mismatches(db, ids):
+    docs = get_docs(db, ids).values()
+    for doc in docs:
+        doc[file_field(doc, 'status')] = {'state': 'ok', 'detail': 'content mismatch'}
+    response = http.post(
+        "https://{0}.cloudant.com/{1}/_bulk_docs".format(config['cloudant_account'], db),
+        auth = (config['cloudant_user'], config['cloudant_auth']),
+        headers = {'Content-Type': 'application/json'},
+        data = json.dumps({'docs': docs})
+    )
+    if response.status_code not in (201,202):
+        response.raise_for_status()
+        sys.exit("Bad http request")
+    return len([result for result in response.json() if 'error' not in result])
+
+# _id of the digest document dirscan writes for the directory at <path> (relative to the sync root) on <host>
+def directory_doc_id(host, path):
+    if config['id_scheme'] == 'hash':
+        return 'dir-' + hashlib.sha1((host + path).encode('utf-8')).hexdigest()
+    return 'dir-' + document_id(host, path.encode('utf-8'), config['id_scheme'])
+
+def sync_path_join(path, name):
+    if len(path) > 0:
+        return path + u'/' + name
+    return name
+
+# Fetch documents by _id, a batch of keys per request. Returns a dict of _id to document for those found
+def get_docs(db, ids):
+    url = "https://{0}.cloudant.com/{1}/_all_docs".format(
+        config['cloudant_account'],
+        db
+    )
+    docs = dict()
+    for start in range(0, len(ids), config['doc_threshold']):
+        response = http.post(
+            url,
+            auth = (config['cloudant_user'], config['cloudant_auth']),
+            params = {"include_docs": 'true'},
+            headers = {'Content-Type': 'application/json'},
+            data = json.dumps({'keys': ids[start:start + config['doc_threshold']]})
+        )
+        if response.status_code in (201,200,202):
+            jsondata = response.json()
+        else:
+            response.raise_for_status()
+            sys.exit("Bad http request")
+        for row in jsondata['rows']:
+            if ('doc' in row) and (row['doc'] != None):
+                docs[row['key']] = row['doc']
+    return docs
+
+# Stream a merge-join of two manifest files and print each difference, followed by totals.
+# With <rsync_prefix>, the differences are also streamed into rsync file lists (see RsyncFileList)
+def print_manifest_differences(source_file, target_file, rsync_prefix = None):
+    try:
+        source = open(source_file, 'rb')
+        target = open(target_file, 'rb')
+    except IOError as e:
+        print "I/O error({0}): {1}".format(e.errno, e.strerror)
+        sys.exit(2)
+    print_entry_differences(manifest.read_manifest(source), manifest.read_manifest(target), rsync_prefix)
+    source.close()
+    target.close()
+
+# Same as print_manifest_differences, for the manifests both hosts' last scans stored in Cloudant
+def print_stored_differences(rsync_prefix = None):
+    sourcescan = get_scan_db(config['rsync_source'])
+    targetscan = get_scan_db(config['rsync_target'])
+    source_index = stored_manifest_index(sourcescan)
+    target_index = stored_manifest_index(targetscan)
+    if (source_index == None) or (target_index == None):
+        sys.exit(" Both hosts' last scans must be stored as manifests (dirscan.py --manifest-storage).")
+    print_entry_differences(stored_manifest_entries(sourcescan, source_index), stored_manifest_entries(targetscan, target_index), rsync_prefix)
+
+# Index document of the manifest stored by <scan> (a recent_scans row with its doc), or None if it has none
+def stored_manifest_index(scan):
+    indexid = scan['doc'].get('manifestindex')
+    if indexid == None:
+        return None
+    return get_docs(config['main_db_name'], [indexid]).get(indexid)
+
+# Iterate over the entries of the manifest stored by <scan>, downloading one chunk at a time
+def stored_manifest_entries(scan, indexdoc):
+    url = "https://{0}.cloudant.com/{1}/{2}".format(
+        config['cloudant_account'],
+        config['main_db_name'],
+        scan['id']
+    )
+    for chunk in indexdoc['chunks']:
+        response = http.get(
+            url + '/' + chunk['name'],
+            auth = (config['cloudant_user'], config['cloudant_auth'])
+        )
+        if response.status_code != 200:
+            response.raise_for_status()
+            sys.exit("Bad http request")
+        for entry in manifest.read_manifest(StringIO(response.content)):
+            yield entry
+
+# Counts of each difference between two sorted manifest entry streams
+def manifest_totals(source_entries, target_entries):
+    totals = dict(missing = 0, orphaned = 0, stale = 0, mismatch = 0)
+    for state, source_entry, target_entry in manifest.diff_manifests(source_entries, target_entries):
+        totals[state] = totals[state] + 1
+    return totals
+
+# Print each difference between two sorted manifest entry streams, followed by totals
+def print_entry_differences(source_entries, target_entries, rsync_prefix = None):
+    labels = dict(
+        missing = "Missing on target",
+        orphaned = "Orphaned on target",
+        stale = "Stale on target",
+        mismatch = "Content mismatch"
+    )
+    totals = dict(missing = 0, orphaned = 0, stale = 0, mismatch = 0)
+    if rsync_prefix != None:
+        rsync_list = RsyncFileList(rsync_prefix)
+    for state, source_entry, target_entry in manifest.diff_manifests(source_entries, target_entries):
+        entry = source_entry or target_entry
+        totals[state] = totals[state] + 1
+        print " {0}: {1} ({2})".format(labels[state], entry[0], data_size_pretty(entry[1]))
+        if rsync_prefix != None:
+            rsync_list.add(state, entry[0])
+    print ""
+    for state in ('missing', 'stale', 'orphaned', 'mismatch'):
+        print " {0}: {1:,}".format(labels[state], totals[state])
+    if rsync_prefix != None:
+        rsync_list.close()
+        rsync_list.print_usage()
+
+# Streams sync differences into rsync input files, relative to the relationship's source directory:
+#   <prefix>.files - missing, stale and mismatched files, for rsync --files-from
+#   <prefix>.filter - include rules for every differing path (orphans too) and its parent directories,
+#                     then an exclude for everything else, for rsync --filter='merge <prefix>.filter'
+# Paths must arrive in sorted order, which lets each parent directory be written only once
+class RsyncFileList(object):
+    
+    def __init__(self, prefix):
+        self.files_name = prefix + '.files'
+        self.filter_name = prefix + '.filter'
+        try:
+            self.files = open(self.files_name, 'w')
+            self.filter = open(self.filter_name, 'w')
+        except IOError as e:
+            print "I/O error({0}): {1}".format(e.errno, e.strerror)
+            sys.exit(2)
+        # Parent directories of the previous path, which already have include rules
+        self.directories = []
+        self.count = 0
+    
+    def add(self, state, path):
+        components = path.split('/')[:-1]
+        common = 0
+        while (common < len(components)) and (common < len(self.directories)) and (components[common] == self.directories[common]):
+            common = common + 1
+        for depth in range(common, len(components)):
+            self.filter.write("+ /{0}/\n".format(filter_escape('/'.join(components[:depth + 1]))))
+        self.directories = components
+        self.filter.write("+ /{0}\n".format(filter_escape(path)))
+        # Orphans only exist on the target, so they're only reachable through the filter for --delete
+        if state != 'orphaned':
+            self.files.write(path + "\n")
+        self.count = self.count + 1
+    
+    def close(self):
+        self.filter.write("- *\n")
+        self.files.close()
+        self.filter.close()
+    
+    def print_usage(self):
+        print ""
+        print " {0:,} paths written to {1} and {2}".format(self.count, self.files_name, self.filter_name)
+        print " Transfer only the differing files:"
+        print "   rsync -a --files-from={0} {1} {2}:{3}".format(self.files_name, config['rsync_source_dir'], config['target_ip'], config['rsync_target_dir'])
+        print " Transfer and delete using only the differing paths:"
+        print "   rsync -a --delete --filter='merge {0}' {1} {2}:{3}".format(self.filter_name, config['rsync_source_dir'], config['target_ip'], config['rsync_target_dir'])
+
+# Escape the characters rsync would otherwise treat as wildcards in a filter rule
+def filter_escape(path):
+    return re.sub(r'([\\*?\[])', r'\\\1', path)
 
 # Print the status of the relationship with pretty formatting
 def print_relationship(data):
@@ -325,7 +1309,8 @@ def print_relationship(data):
         ["Files",'filecount'],
         ["Directory size",'dirsize'],
         ["Scanning errors", 'errors'],
-        ["Scan database", 'scandbs']
+        ["Scan database", 'scandbs'],
+        ["Index lag (updates)", 'indexlag']
     ]
     for line in lines:
         label = line[0]
@@ -370,8 +1355,11 @@ def get_view(db,ddoc,view,reduce,group_level,startkey,endkey,include_docs):
 
     if include_docs == True:
         url = url + '&' + '{0}={1}'.format('include_docs','true')
+    
+    for param, value in view_freshness[config['freshness']].items():
+        url = url + '&' + '{0}={1}'.format(param,value)
   
-    response = requests.get(
+    response = http.get(
         url,
         auth = (config['cloudant_user'], config['cloudant_auth'])
     )
@@ -382,6 +1370,127 @@ def get_view(db,ddoc,view,reduce,group_level,startkey,endkey,include_docs):
         sys.exit("Bad http request")
     return(jsondata)
 
+# Iterate over the rows of view <name> in scan database <db> between <startkey> and <endkey> (the whole view
+# when they're None), a page of <page_size> (doc_threshold by default) rows per request. Each page resumes
+# from the key and document ID of the row following the previous page, so memory use doesn't grow with the view.
+# Rows are parsed as each page streams in (see stream_rows)
+def iter_view(db, name, startkey = None, endkey = None, include_docs = False, page_size = None):
+    if page_size == None:
+        page_size = config['doc_threshold']
+    view = scan_view(db, name)
+    url = "https://{0}.cloudant.com/{1}/{2}/_view/{3}".format(
+        config['cloudant_account'],
+        db,
+        view[0],
+        view[1]
+    )
+    payload = view_params({
+        "reduce": 'false',
+        "limit": page_size + 1
+    })
+    if startkey != None:
+        payload['startkey'] = json.dumps(startkey)
+    if endkey != None:
+        payload['endkey'] = json.dumps(endkey)
+    if include_docs == True:
+        payload['include_docs'] = 'true'
+    while True:
+        response = http.get(
+            url,
+            auth = (config['cloudant_user'], config['cloudant_auth']),
+            params = payload,
+            stream = True
+        )
+        if response.status_code not in (201,200,202):
+            response.raise_for_status()
+            sys.exit("Bad http request")
+        returned = 0
+        following = None
+        for row in stream_rows(response):
+            if returned == page_size:
+                following = row
+                break
+            returned = returned + 1
+            yield row
+        response.close()
+        if following == None:
+            return
+        payload['startkey'] = json.dumps(following['key'])
+        payload['startkey_docid'] = following['id']
+
+# Iterate over the rows of a streamed view response as they arrive. Views answer with one row per line
+# between a header line ending in "rows":[ and a closing line. Responses laid out any other way are
+# parsed whole
+def stream_rows(response):
+    lines = response.iter_lines()
+    header = next(lines, '')
+    if not header.rstrip().endswith('"rows":['):
+        for row in json.loads(header + ''.join(lines))['rows']:
+            yield row
+        return
+    for line in lines:
+        line = line.strip().rstrip(',')
+        if line.startswith('{'):
+            yield json.loads(line)
+
+# Definition of view <name> for scan database <db>. Databases from before the views were consolidated
+# keep serving from their old design documents until dirscan has migrated them
+def scan_view(db, name):
+    # Read into a local, since the --serve daemon clears scandb_versions from another thread
+    version = scandb_versions.get(db)
+    if version == None:
+        response = http.get(
+            "https://{0}.cloudant.com/{1}/scanversion".format(config['cloudant_account'], db),
+            auth = (config['cloudant_user'], config['cloudant_auth'])
+        )
+        if response.status_code == 200:
+            version = response.json()['current']
+        else:
+            version = 0
+        scandb_versions[db] = version
+    view = scandb_views[name]
+    if (version < config['consolidated_viewversion']) and (name in legacy_scandb_ddocs):
+        return [legacy_scandb_ddocs[name]] + view[1:]
+    return view
+
+# First element of the problem_files keys of <host>'s scan <scan_id> in <db>. The view's legacy design
+# document keys its rows by scan rather than by host
+def problem_files_key(db, host, scan_id):
+    if scan_view(db, 'problem_files')[0] == legacy_scandb_ddocs['problem_files']:
+        return scan_id
+    return host
+
+# Add the parameters of the configured freshness policy to a view query's parameters
+def view_params(payload):
+    payload.update(view_freshness[config['freshness']])
+    return payload
+
+# How far the index of design document <ddoc> trails the documents in <db>, for display
+def index_lag(db, ddoc):
+    base_url = "https://{0}.cloudant.com/{1}".format(config['cloudant_account'], db)
+    try:
+        dbinfo = http.get(base_url, auth = (config['cloudant_user'], config['cloudant_auth']))
+        ddocinfo = http.get(base_url + '/' + ddoc + '/_info', auth = (config['cloudant_user'], config['cloudant_auth']))
+        dbinfo.raise_for_status()
+        ddocinfo.raise_for_status()
+        db_seq = sequence_number(dbinfo.json()['update_seq'])
+        view_index = ddocinfo.json()['view_index']
+    except Exception:
+        return "unknown"
+    lag = db_seq - sequence_number(view_index['update_seq'])
+    if lag <= 0:
+        return "current"
+    elif view_index.get('updater_running') == True:
+        return "{:,} (upd)".format(lag)
+    return "{:,}".format(lag)
+
+# Numeric part of a database or index update sequence. Clustered sequences are "<number>-<opaque>"
+def sequence_number(seq):
+    try:
+        return int(str(seq).split('-')[0])
+    except ValueError:
+        return 0
+
 # Output a formatted date/time from UTC timestamp
 def pretty_time(timestamp):
     return (datetime.fromtimestamp(int(timestamp)).ctime())
@@ -426,50 +1535,99 @@ def check_relationship():
     # 3. the scan DB each host is using
     results['scandbs'] = [re.sub('scandb-','',sourcescan['value']),re.sub('scandb-','',targetscan['value'])]
     
-    # From each scandb for each host:
-    source_files_so_far = files_scanned(sourcescan['value'], sourcescan['id'], config['rsync_source'])
-    target_files_so_far = files_scanned(targetscan['value'], targetscan['id'], config['rsync_target'])
+    # 4. how far each scan database's sync state index trails its documents
+    results['indexlag'] = [index_lag(sourcescan['value'], scan_view(sourcescan['value'], 'uptodate_files')[0]),index_lag(targetscan['value'], scan_view(targetscan['value'], 'uptodate_files')[0])]
+    
+    # From each scandb for each host. Finished scans carry precomputed totals in their scan document,
+    # so the views are only queried while a scan is still in progress
+    source_summary = scan_summary(sourcescan)
+    target_summary = scan_summary(targetscan)
+    if source_summary != None:
+        source_files_so_far = source_summary['files']
+        source_errors = summary_count(source_summary, 'statuses', 'error')
+    else:
+        source_files_so_far = files_scanned(sourcescan['value'], config['rsync_source'])
+        source_errors = scanning_errors(sourcescan['value'], config['rsync_source'], sourcescan['id'])
+    if target_summary != None:
+        target_files_so_far = target_summary['files']
+        target_errors = summary_count(target_summary, 'statuses', 'error')
+    else:
+        target_files_so_far = files_scanned(targetscan['value'], config['rsync_target'])
+        target_errors = scanning_errors(targetscan['value'], config['rsync_target'], targetscan['id'])
     # number of files scanned
     results['filecount'] = ["{:,}".format(source_files_so_far['count']),"{:,}".format(target_files_so_far['count'])]
     
     # number of errors in scan
-    results['errors'] = [scanning_errors(sourcescan['value'],sourcescan['id']),scanning_errors(targetscan['value'],targetscan['id'])]
+    results['errors'] = [source_errors,target_errors]
     
     # total size of scanned files (directory size)
     results['dirsize'] = [data_size_pretty(source_files_so_far['sum']),data_size_pretty(target_files_so_far['sum'])]
     
+    # Scans stored as manifests have no file documents for the views, so their manifests are diffed instead.
+    # Content mismatches are reported as files whose sync state is unknown
+    source_index = stored_manifest_index(sourcescan)
+    target_index = stored_manifest_index(targetscan)
+    # Both manifests are downloaded and diffed only when either host has stored a new one since the last check
+    if (source_index != None) and (target_index != None):
+        pair = (source_index['_id'], target_index['_id'])
+        cached = manifest_diff_totals.get(config['relationship'])
+        if (cached != None) and (cached[0] == pair):
+            totals = cached[1]
+        else:
+            totals = manifest_totals(stored_manifest_entries(sourcescan, source_index), stored_manifest_entries(targetscan, target_index))
+            manifest_diff_totals[config['relationship']] = (pair, totals)
+        results['uptodate'] = "{:,}".format(source_index['entries'] - totals['missing'] - totals['stale'] - totals['mismatch'])
+        results['missing'] = "{:,}".format(totals['missing'])
+        results['orphaned'] = "{:,}".format(totals['orphaned'])
+        results['stale'] = "{:,}".format(totals['stale'])
+        results['unknown'] = "{:,}".format(totals['mismatch'])
+        return(results)
+    
     # For summary stats:
     # Up to date files
-    uptodate = good_files(config['rsync_target'],targetscan['value'],targetscan['id'])
+    uptodate = good_files(config['rsync_target'],targetscan['value'])
     results['uptodate'] = "{:,}".format(uptodate)
     # missingfiles = sourcefiles - targetfiles from above
     results['missing'] = "{:,}".format(source_files_so_far['count'] - uptodate)
     # orphaned files = from view
-    results['orphaned'] = "{:,}".format(orphan_view(config['rsync_target'],targetscan['value'],targetscan['id']))
+    results['orphaned'] = "{:,}".format(orphan_view(config['rsync_target'],targetscan['value']))
     # stale files = from view
-    results['stale'] = "{:,}".format(stale_view(config['rsync_target'],targetscan['value'],targetscan['id']))
+    results['stale'] = "{:,}".format(stale_view(config['rsync_target'],targetscan['value']))
     # Unknown files
-    results['unknown'] = "{:,}".format(unknown_files(config['rsync_target'],targetscan['value'],targetscan['id']))
+    results['unknown'] = "{:,}".format(unknown_files(config['rsync_target'],targetscan['value']))
     # send back a results dictionary the printer can parse
     return(results)
 
-def good_files(host_id,scan_db,scan_id):
+# Summary aggregates written into the scan document by dirscan when the scan finished.
+# Returns None for scans still in progress (or from older scanners), which must use the views instead
+def scan_summary(scan):
+    if (scan['doc']['ended'] > 0) and ('summary' in scan['doc']):
+        return scan['doc']['summary']
+    return None
+
+# Number of files in one bucket of a scan summary aggregate (statuses, extensions or sizes)
+def summary_count(summary, aggregate, key):
+    if key in summary[aggregate]:
+        return summary[aggregate][key]['count']
+    return 0
+
+def good_files(host_id,scan_db):
     goods = 0
     url = "https://{0}.cloudant.com/{1}/{2}/_view/{3}".format(
         config['cloudant_account'],
         scan_db,
-        scandb_views['uptodate_files'][0],
-        scandb_views['uptodate_files'][1]
+        scan_view(scan_db, 'uptodate_files')[0],
+        scan_view(scan_db, 'uptodate_files')[1]
     )
     payload = {
-        "startkey": '["{0}","{1}",{2}]'.format(host_id,scan_id,'null'),
-        "endkey": '["{0}","{1}",{2}]'.format(host_id,scan_id,'{}'),
+        "startkey": '["{0}",null,null]'.format(host_id),
+        "endkey": '["{0}",{{}},{{}}]'.format(host_id),
         "reduce": 'true',
     }
-    response = requests.get(
+    response = http.get(
         url,
         auth = (config['cloudant_user'], config['cloudant_auth']),
-        params = payload
+        params = view_params(payload)
     )
     if response.status_code in (201,200,202):
         jsondata = response.json()
@@ -481,23 +1639,23 @@ def good_files(host_id,scan_db,scan_id):
     return(goods)
     
 
-def unknown_files(host_id, scan_db, scan_id):
+def unknown_files(host_id, scan_db):
     unknowns = 0
     url = "https://{0}.cloudant.com/{1}/{2}/_view/{3}".format(
         config['cloudant_account'],
         scan_db,
-        scandb_views['unknown_files'][0],
-        scandb_views['unknown_files'][1]
+        scan_view(scan_db, 'unknown_files')[0],
+        scan_view(scan_db, 'unknown_files')[1]
     )
     payload = {
-        "startkey": '["{0}","{1}",{2}]'.format(host_id,scan_id,'null'),
-        "endkey": '["{0}","{1}",{2}]'.format(host_id,scan_id,'{}'),
+        "startkey": '["{0}",null,null]'.format(host_id),
+        "endkey": '["{0}",{{}},{{}}]'.format(host_id),
         "reduce": 'true',
     }
-    response = requests.get(
+    response = http.get(
         url,
         auth = (config['cloudant_user'], config['cloudant_auth']),
-        params = payload
+        params = view_params(payload)
     )
     if response.status_code in (201,200,202):
         jsondata = response.json()
@@ -508,23 +1666,23 @@ def unknown_files(host_id, scan_db, scan_id):
         unknowns = jsondata['rows'][0]['value']['count']
     return(unknowns)
 
-def stale_view(host_id, scan_db, scan_id):
+def stale_view(host_id, scan_db):
     stale_files = 0
     url = "https://{0}.cloudant.com/{1}/{2}/_view/{3}".format(
         config['cloudant_account'],
         scan_db,
-        scandb_views['stale_files'][0],
-        scandb_views['stale_files'][1]
+        scan_view(scan_db, 'stale_files')[0],
+        scan_view(scan_db, 'stale_files')[1]
     )
     payload = {
-        "startkey": '["{0}","{1}",{2}]'.format(host_id,scan_id,'null'),
-        "endkey": '["{0}","{1}",{2}]'.format(host_id,scan_id,'{}'),
+        "startkey": '["{0}",null,null]'.format(host_id),
+        "endkey": '["{0}",{{}},{{}}]'.format(host_id),
         "reduce": 'true',
     }
-    response = requests.get(
+    response = http.get(
         url,
         auth = (config['cloudant_user'], config['cloudant_auth']),
-        params = payload
+        params = view_params(payload)
     )
     if response.status_code in (201,200,202):
         jsondata = response.json()
@@ -535,23 +1693,23 @@ def stale_view(host_id, scan_db, scan_id):
         stale_files = jsondata['rows'][0]['value']['count']
     return(stale_files)
 
-def orphan_view(host_id,scan_db,scan_id):
+def orphan_view(host_id,scan_db):
     orphaned_files = 0
     url = "https://{0}.cloudant.com/{1}/{2}/_view/{3}".format(
         config['cloudant_account'],
         scan_db,
-        scandb_views['orphaned_files'][0],
-        scandb_views['orphaned_files'][1]
+        scan_view(scan_db, 'orphaned_files')[0],
+        scan_view(scan_db, 'orphaned_files')[1]
     )
     payload = {
-        "startkey": '["{0}","{1}",{2}]'.format(host_id,scan_id,'null'),
-        "endkey": '["{0}","{1}",{2}]'.format(host_id,scan_id,'{}'),
+        "startkey": '["{0}",null,null]'.format(host_id),
+        "endkey": '["{0}",{{}},{{}}]'.format(host_id),
         "reduce": 'true',
     }
-    response = requests.get(
+    response = http.get(
         url,
         auth = (config['cloudant_user'], config['cloudant_auth']),
-        params = payload
+        params = view_params(payload)
     )
     if response.status_code in (201,200,202):
         jsondata = response.json()
@@ -578,10 +1736,10 @@ def get_scan_db(host):
         "descending": 'true',
         "include_docs": 'true'
     }
-    response = requests.get(
+    response = http.get(
         url,
         auth = (config['cloudant_user'], config['cloudant_auth']),
-        params = payload
+        params = view_params(payload)
     )
     if response.status_code in (201,200,202):
         jsondata = response.json()
@@ -590,23 +1748,23 @@ def get_scan_db(host):
         sys.exit("Bad http request")
     return jsondata['rows'][0]
 
-def files_scanned(scan_database, scan_id, host_id):
+def files_scanned(scan_database, host_id):
     url = "https://{0}.cloudant.com/{1}/{2}/_view/{3}".format(
         config['cloudant_account'],
         scan_database,
-        scandb_views['file_types'][0],
-        scandb_views['file_types'][1]
+        scan_view(scan_database, 'file_types')[0],
+        scan_view(scan_database, 'file_types')[1]
     )
     payload = {
-        "startkey": '["'+ host_id +'","'+scan_id+'",null]',
-        "endkey": '["'+ host_id +'","'+scan_id+'",{}]',
-        "group_level": 2,
+        "startkey": '["'+ host_id +'",null,null]',
+        "endkey": '["'+ host_id +'",{},{}]',
+        "group_level": 1,
         "reduce": 'true',
     }
-    response = requests.get(
+    response = http.get(
         url,
         auth = (config['cloudant_user'], config['cloudant_auth']),
-        params = payload
+        params = view_params(payload)
     )
     if response.status_code in (201,200,202):
         jsondata = response.json()
@@ -626,8 +1784,8 @@ def files_scanned(scan_database, scan_id, host_id):
         return (zeroes)
     
 def files_scanned_new(scan_db, scan_id, host_id): #Still broken due to cloudant-python "group_level" bug
-    ddoc = scandb_views['file_types'][0]
-    view = scandb_views['file_types'][1]
+    ddoc = scan_view(scan_db, 'file_types')[0]
+    view = scan_view(scan_db, 'file_types')[1]
     stats = dict()
     with cloudant(config['cloudant_user'], config['cloudant_auth'], account=config['cloudant_user']) as client:
         db = client[scan_db]
@@ -652,8 +1810,8 @@ def files_scanned_new(scan_db, scan_id, host_id): #Still broken due to cloudant-
 
 def scanning_errors_new(scan_db, scan_id): #Still broken due to cloudant-python "group_level" bug
     errors = 0
-    ddoc = scandb_views['problem_files'][0]
-    view = scandb_views['problem_files'][1]
+    ddoc = scan_view(scan_db, 'problem_files')[0]
+    view = scan_view(scan_db, 'problem_files')[1]
     with cloudant(config['cloudant_user'], config['cloudant_auth'], account=config['cloudant_user']) as client:
         db = client[scan_db]
         result = db.get_view_result(
@@ -665,24 +1823,25 @@ def scanning_errors_new(scan_db, scan_id): #Still broken due to cloudant-python
         errors = result[[scan_id,None,None]:[scan_id,{},{}]]['value']
     return errors
 
-def scanning_errors(scan_db, scan_id):
+def scanning_errors(scan_db, host_id, scan_id):
     errors = 0
+    key = problem_files_key(scan_db, host_id, scan_id)
     url = "https://{0}.cloudant.com/{1}/{2}/_view/{3}".format(
         config['cloudant_account'],
         scan_db,
-        scandb_views['problem_files'][0],
-        scandb_views['problem_files'][1]
+        scan_view(scan_db, 'problem_files')[0],
+        scan_view(scan_db, 'problem_files')[1]
     )
     payload = {
-        "startkey": '["'+scan_id+'",null,null]',
-        "endkey": '["'+scan_id+'",{},{}]',
+        "startkey": json.dumps([key, None, None]),
+        "endkey": json.dumps([key, {}, {}]),
         "group_level": 1,
         "reduce": 'true',
     }
-    response = requests.get(
+    response = http.get(
         url,
         auth = (config['cloudant_user'], config['cloudant_auth']),
-        params = payload
+        params = view_params(payload)
     )
     if response.status_code in (201,200,202):
         jsondata = response.json()